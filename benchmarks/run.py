@@ -0,0 +1,244 @@
+"""Benchmarks of the ExApp proxy, user provisioning and webhooks sync.
+
+Windmill and Nextcloud are replaced with the stub servers from this folder, the ExApp itself is driven in-process
+through its ASGI interface, so the results show the overhead of the ExApp code and not of the network.
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --output new.json --compare results.json
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+EX_APP_LIB_DIR = BENCHMARKS_DIR.parent.joinpath("ex_app", "lib")
+APP_SECRET = "benchmark"  # noqa: S105
+WORKSPACE = "nextcloud"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--windmill-port", type=int, default=18000)
+    parser.add_argument("--nextcloud-port", type=int, default=18099)
+    parser.add_argument("--latency", type=float, default=0.0, help="latency of the stub servers, in milliseconds")
+    parser.add_argument("--concurrency", type=int, default=32, help="number of concurrent clients")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per HTTP scenario")
+    parser.add_argument("--logins", type=int, default=200, help="users provisioned in the first-login scenario")
+    parser.add_argument("--flows", default="10,1000,10000", help="comma-separated numbers of flows for sync passes")
+    parser.add_argument("--output", type=Path, help="write results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="JSON results of a previous run to compare with")
+    return parser.parse_args()
+
+
+def prepare_environment(args: argparse.Namespace, work_dir: Path) -> None:
+    """ExApp configuration is read on import, so it must be set before `main` is imported."""
+    os.environ.update(
+        {
+            "APP_ID": "flow",
+            "APP_SECRET": APP_SECRET,
+            "APP_VERSION": "1.0.0",
+            "APP_PORT": "23000",
+            "AA_VERSION": "3.0.0",
+            "APP_PERSISTENT_STORAGE": str(work_dir.joinpath("storage")),
+            "NEXTCLOUD_URL": f"http://127.0.0.1:{args.nextcloud_port}",
+            "WINDMILL_URL": f"http://127.0.0.1:{args.windmill_port}",
+        }
+    )
+    work_dir.joinpath("storage").mkdir()
+    sys.path.insert(0, str(EX_APP_LIB_DIR))
+
+
+def create_frontend(frontend_dir: Path) -> None:
+    frontend_dir.joinpath("_app", "immutable").mkdir(parents=True)
+    frontend_dir.joinpath("200.html").write_text("<html><body>" + "Flow " * 1000 + "</body></html>")
+    frontend_dir.joinpath("_app", "immutable", "app.0123abcd.js").write_text("console.log('flow');\n" * 2500)
+
+
+def start_stub(script: str, port: int, latency: float) -> subprocess.Popen:
+    process = subprocess.Popen(  # noqa: S603
+        [sys.executable, str(BENCHMARKS_DIR.joinpath(script)), "--port", str(port), "--latency", str(latency)]
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/docs", timeout=1)
+            return process
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{script} did not start on port {port}")
+
+
+def app_api_headers(user_name: str) -> dict:
+    return {
+        "AUTHORIZATION-APP-API": base64.b64encode(f"{user_name}:{APP_SECRET}".encode()).decode(),
+        "EX-APP-ID": "flow",
+        "EX-APP-VERSION": "1.0.0",
+        "AA-VERSION": "3.0.0",
+    }
+
+
+def summarize(latencies: list[float], errors: int, total_time: float) -> dict:
+    latencies = sorted(latencies)
+    quantiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / total_time, 1),
+        "p50_ms": round(quantiles[49] * 1000, 3),
+        "p99_ms": round(quantiles[98] * 1000, 3),
+    }
+
+
+async def run_http_scenario(client: httpx.AsyncClient, requests: list[tuple[str, dict]], concurrency: int) -> dict:
+    latencies = []
+    errors = 0
+    pending = iter(requests)
+
+    async def _worker():
+        nonlocal errors
+        for url, headers in pending:
+            start_time = time.perf_counter()
+            try:
+                response = await client.get(url, headers=headers)
+                errors += response.status_code >= 400
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start_time)
+
+
+async def run_http_benchmarks(main, args: argparse.Namespace) -> dict:
+    results = {}
+    transport = httpx.ASGITransport(app=main.APP)
+    async with httpx.AsyncClient(transport=transport, base_url="http://exapp", timeout=60) as client:
+        warm_user = app_api_headers("bench_user")
+        await client.get("/api/w/nextcloud/scripts/list", headers=warm_user)  # provisions the user
+        static_headers = {**warm_user, "accept-encoding": "gzip, br"}
+        scenarios = {
+            "frontend_static": [("/_app/immutable/app.0123abcd.js", static_headers)] * args.requests,
+            "proxied_api": [("/api/w/nextcloud/scripts/list", warm_user)] * args.requests,
+            "cached_api": [("/api/version", warm_user)] * args.requests,
+            "first_login": [
+                ("/api/w/nextcloud/scripts/list", app_api_headers(f"bench_login_{time.time_ns()}_{i}"))
+                for i in range(args.logins)
+            ],
+        }
+        for name, requests in scenarios.items():
+            results[name] = await run_http_scenario(client, requests, args.concurrency)
+            print(f"{name}: {results[name]}", flush=True)
+    return results
+
+
+async def run_sync_benchmarks(main, args: argparse.Namespace) -> dict:
+    results = {}
+    async with httpx.AsyncClient() as client:
+        for flows_count in [int(i) for i in args.flows.split(",")]:
+            (await client.post(f"{main.WINDMILL_URL}/_bench/flows", json={"count": flows_count})).raise_for_status()
+            (await client.post(f"{os.environ['NEXTCLOUD_URL']}/_bench/reset")).raise_for_status()
+            # Forget everything learned by previous passes, so the first pass is a full one.
+            main.FLOWS_CACHE.update({}, main.FLOWS_CACHE.paths())
+            main.WEBHOOKS_SYNC_STATE.update({"applied_state": "", "full_sync_time": 0.0})
+            start_time = time.perf_counter()
+            await main.webhooks_sync_pass(WORKSPACE, None)
+            full_pass = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            await main.webhooks_sync_pass(WORKSPACE, None)
+            unchanged_pass = time.perf_counter() - start_time
+            results[str(flows_count)] = {
+                "full_pass_s": round(full_pass, 4),
+                "unchanged_pass_s": round(unchanged_pass, 4),
+                "listeners": len(main.FLOWS_CACHE.listeners()),
+            }
+            print(f"webhooks_sync[{flows_count} flows]: {results[str(flows_count)]}", flush=True)
+    return results
+
+
+async def run_benchmarks(args: argparse.Namespace, work_dir: Path) -> dict:
+    import main  # noqa: PLC0415
+
+    main.LOGGER.setLevel("WARNING")
+    main.STATIC_FRONTEND_PATH = work_dir.joinpath("frontend")
+    main.STATIC_ASSETS.update(main.build_static_assets_index(main.STATIC_FRONTEND_PATH))
+    main.create_upstream_client()
+    try:
+        await main.bootstrap_windmill()
+        return {
+            "startup_phases_s": main.STARTUP_STATE["phases"],
+            "http": await run_http_benchmarks(main, args),
+            "webhooks_sync": await run_sync_benchmarks(main, args),
+        }
+    finally:
+        await main.close_upstream_client()
+
+
+def git_revision() -> str:
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()  # noqa: S607
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--", "ex_app"], text=True).strip()  # noqa
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{revision}-dirty" if dirty else revision
+
+
+def compare_results(previous: dict, current: dict) -> None:
+    print(f"\nCompared to {previous['revision']}:")
+    for section in ("http", "webhooks_sync"):
+        for name, values in current[section].items():
+            for key, value in values.items():
+                old_value = previous.get(section, {}).get(name, {}).get(key)
+                if not key.endswith(("_rps", "_ms", "_s")) or not old_value:
+                    continue
+                print(f"  {section}.{name}.{key}: {old_value} -> {value} ({(value - old_value) / old_value:+.1%})")
+
+
+def main():
+    args = parse_args()
+    with tempfile.TemporaryDirectory(prefix="flow-bench-") as work_dir:
+        work_dir = Path(work_dir)
+        prepare_environment(args, work_dir)
+        create_frontend(work_dir.joinpath("frontend"))
+        stubs = [
+            start_stub("stub_windmill.py", args.windmill_port, args.latency),
+            start_stub("stub_nextcloud.py", args.nextcloud_port, args.latency),
+        ]
+        try:
+            results = asyncio.run(run_benchmarks(args, work_dir))
+        finally:
+            for stub in stubs:
+                stub.terminate()
+                stub.wait()
+    results = {
+        "revision": git_revision(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "parameters": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "logins": args.logins,
+            "latency_ms": args.latency,
+        },
+        **results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+    if args.compare:
+        compare_results(json.loads(args.compare.read_text()), results)
+
+
+if __name__ == "__main__":
+    main()
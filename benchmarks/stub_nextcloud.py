@@ -0,0 +1,89 @@
+"""Stand-in for the Nextcloud OCS API used by the benchmarks: ExApp state and ``webhook_listeners``."""
+
+import argparse
+import asyncio
+import itertools
+
+import uvicorn
+from fastapi import FastAPI, Request
+from starlette.responses import JSONResponse
+
+APP = FastAPI()
+LATENCY = {"value": 0.0}
+LISTENERS: dict[int, dict] = {}
+LISTENERS_COUNTER = itertools.count(1)
+WEBHOOKS_API = "/ocs/v1.php/apps/webhook_listeners/api/v1/webhooks"
+
+
+def ocs_response(data) -> JSONResponse:
+    return JSONResponse({"ocs": {"meta": {"status": "ok", "statuscode": 200, "message": "OK"}, "data": data}})
+
+
+async def _delay() -> None:
+    if LATENCY["value"]:
+        await asyncio.sleep(LATENCY["value"])
+
+
+@APP.post("/_bench/reset")
+async def reset():
+    LISTENERS.clear()
+    return JSONResponse(True)
+
+
+@APP.get("/ocs/v1.php/apps/app_api/ex-app/state")
+async def ex_app_state():
+    return ocs_response(1)
+
+
+@APP.get(WEBHOOKS_API)
+async def list_listeners():
+    await _delay()
+    return ocs_response(list(LISTENERS.values()))
+
+
+@APP.post(WEBHOOKS_API)
+async def register_listener(request: Request):
+    await _delay()
+    data = await request.json()
+    listener_id = next(LISTENERS_COUNTER)
+    LISTENERS[listener_id] = {
+        "id": listener_id,
+        "appId": "flow",
+        "userId": "",
+        "httpMethod": data["httpMethod"],
+        "uri": data["uri"],
+        "event": data["event"],
+        "eventFilter": data.get("eventFilter") or [],
+        "userIdFilter": data.get("userIdFilter") or "",
+        "headers": data.get("headers") or [],
+        "authMethod": data.get("authMethod", "none"),
+        "authData": None,
+    }
+    return ocs_response(LISTENERS[listener_id])
+
+
+@APP.post(WEBHOOKS_API + "/{listener_id}")
+async def update_listener(listener_id: int, request: Request):
+    await _delay()
+    data = await request.json()
+    LISTENERS[listener_id]["eventFilter"] = data.get("eventFilter") or []
+    return ocs_response(LISTENERS[listener_id])
+
+
+@APP.delete(WEBHOOKS_API + "/{listener_id}")
+async def delete_listener(listener_id: int):
+    await _delay()
+    return ocs_response(LISTENERS.pop(listener_id, None) is not None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.0, help="added to each OCS response, in milliseconds")
+    args = parser.parse_args()
+    LATENCY["value"] = args.latency / 1000
+    uvicorn.run(APP, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""Stand-in for the Windmill API used by the benchmarks.
+
+Implements only what the ExApp calls: user provisioning, token checks and flows of a workspace.
+Number of flows is set with ``POST /_bench/flows``, every third of them listens to a Nextcloud event.
+The job queue seen by the workers autoscaling is set with ``POST /_bench/queue``: number of jobs and wait seconds.
+``/ws/echo`` echoes WebSocket messages with the token cookie appended, the message ``close`` closes with code 4000.
+"""
+
+import argparse
+import asyncio
+import itertools
+import time
+from datetime import datetime, timezone
+
+import uvicorn
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from starlette.responses import JSONResponse, PlainTextResponse
+
+APP = FastAPI()
+LATENCY = {"value": 0.0}
+TOKENS: dict[str, str] = {}
+FLOWS: dict[str, dict] = {}
+TOKENS_COUNTER = itertools.count(1)
+QUEUE = {"count": 0, "created": 0.0}
+
+
+async def _delay() -> None:
+    if LATENCY["value"]:
+        await asyncio.sleep(LATENCY["value"])
+
+
+def _flow_definition(index: int) -> dict:
+    if index % 3:
+        return {"value": {"modules": []}}
+    return {
+        "value": {
+            "modules": [
+                {
+                    "summary": "CORE:LISTEN_TO_EVENT",
+                    "value": {
+                        "input_transforms": {
+                            "events": {"type": "static", "value": ["OCP\\Files\\Events\\Node\\NodeCreatedEvent"]},
+                            "filters": {"type": "static", "value": {"event.node.path": f"/flow{index}/"}},
+                        }
+                    },
+                }
+            ]
+        }
+    }
+
+
+@APP.post("/_bench/flows")
+async def set_flows(request: Request):
+    data = await request.json()
+    FLOWS.clear()
+    for i in range(data["count"]):
+        FLOWS[f"f/bench/flow{i:05}"] = {"edited_at": "2024-10-10T00:00:00Z", **_flow_definition(i)}
+    return JSONResponse(len(FLOWS))
+
+
+@APP.post("/_bench/queue")
+async def set_queue(request: Request):
+    data = await request.json()
+    QUEUE.update({"count": data["count"], "created": time.time() - data.get("wait", 0)})
+    return JSONResponse(QUEUE)
+
+
+@APP.get("/api/version")
+async def version(request: Request):
+    await _delay()
+    if request.headers.get("if-none-match") == '"v1.400.0"':
+        return PlainTextResponse(status_code=304, headers={"etag": '"v1.400.0"'})
+    return PlainTextResponse("CE v1.400.0", headers={"etag": '"v1.400.0"'})
+
+
+@APP.post("/api/users/create")
+async def create_user():
+    await _delay()
+    return PlainTextResponse("created", status_code=201)
+
+
+@APP.post("/api/auth/login")
+async def login(request: Request):
+    await _delay()
+    data = await request.json()
+    token = f"token{next(TOKENS_COUNTER)}"
+    TOKENS[token] = data["email"]
+    return PlainTextResponse(token)
+
+
+@APP.post("/api/users/tokens/create")
+async def create_token(request: Request):
+    await _delay()
+    token = f"token{next(TOKENS_COUNTER)}"
+    TOKENS[token] = TOKENS.get(request.cookies.get("token", ""), "")
+    return PlainTextResponse(token, status_code=201)
+
+
+@APP.get("/api/users/whoami")
+async def whoami(request: Request):
+    await _delay()
+    token = request.cookies.get("token") or request.headers.get("authorization", "").removeprefix("Bearer ")
+    if token not in TOKENS:
+        return PlainTextResponse("Unauthorized", status_code=401)
+    return JSONResponse({"email": TOKENS[token], "is_admin": True})
+
+
+@APP.get("/api/w/{workspace}/flows/list")
+async def list_flows(workspace: str, page: int = 1, per_page: int = 100):
+    await _delay()
+    paths = [i for i in FLOWS if not FLOWS[i].get("archived")][(page - 1) * per_page : page * per_page]
+    return JSONResponse([{"workspace_id": workspace, "path": i, "edited_at": FLOWS[i]["edited_at"]} for i in paths])
+
+
+@APP.get("/api/w/{workspace}/flows/get/{flow_path:path}")
+async def get_flow(workspace: str, flow_path: str):
+    await _delay()
+    if flow_path not in FLOWS:
+        return PlainTextResponse("Not found", status_code=404)
+    return JSONResponse({"workspace_id": workspace, "path": flow_path, **FLOWS[flow_path]})
+
+
+@APP.get("/api/w/{workspace}/jobs/queue/count")
+async def queue_count():
+    await _delay()
+    return JSONResponse({"database_length": QUEUE["count"]})
+
+
+@APP.get("/api/w/{workspace}/jobs/queue/list")
+async def queue_list(workspace: str):
+    await _delay()
+    if not QUEUE["count"]:
+        return JSONResponse([])
+    created_at = datetime.fromtimestamp(QUEUE["created"], timezone.utc).isoformat().replace("+00:00", "Z")
+    return JSONResponse(
+        [{"workspace_id": workspace, "id": "job0", "created_at": created_at, "scheduled_for": created_at}]
+    )
+
+
+@APP.websocket("/ws/echo")
+async def websocket_echo(websocket: WebSocket):
+    await websocket.accept(subprotocol=(websocket.scope.get("subprotocols") or [None])[0])
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes") is not None:
+                await websocket.send_bytes(message["bytes"])
+            elif message.get("text") == "close":
+                await websocket.close(code=4000)
+                return
+            else:
+                await websocket.send_text(message.get("text") + " " + websocket.cookies.get("token", ""))
+    except WebSocketDisconnect:
+        return
+
+
+@APP.api_route("/api/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
+async def other_api(path: str):
+    await _delay()
+    return JSONResponse({"path": path, "items": [{"id": i, "name": f"item{i}"} for i in range(20)]})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="added to each API response, in milliseconds")
+    args = parser.parse_args()
+    LATENCY["value"] = args.latency / 1000
+    uvicorn.run(APP, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""CPU and memory limits of the container, read from cgroup v2 with a fallback to the host values.
+
+Only the standard library is used, so the startup scripts that run before the ExApp can import it too.
+"""
+
+import contextlib
+import os
+from pathlib import Path
+
+CGROUP_PATH = Path("/sys/fs/cgroup")
+
+
+def read_cgroup_file(name: str) -> str | None:
+    """Reads a file of the cgroup v2 of the container, ``None`` if it is missing (cgroup v1 or no container)."""
+    try:
+        return CGROUP_PATH.joinpath(name).read_text().strip()
+    except OSError:
+        return None
+
+
+def get_cpu_limit() -> float:
+    """CPUs available to the container: its cgroup quota, or all CPUs of the host."""
+    cpu_max = read_cgroup_file("cpu.max")
+    if cpu_max and not cpu_max.startswith("max"):
+        quota, period = cpu_max.split()
+        return int(quota) / int(period)
+    return float(os.cpu_count() or 1)
+
+
+def read_meminfo() -> dict[str, int]:
+    meminfo = {}
+    with contextlib.suppress(OSError), open("/proc/meminfo", encoding="utf-8") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            meminfo[name] = int(value.split()[0]) * 1024
+    return meminfo
+
+
+def get_memory_limit() -> int | None:
+    """Memory available to the container: its cgroup limit, or the memory of the host."""
+    memory_max = read_cgroup_file("memory.max")
+    if memory_max and memory_max != "max":
+        return int(memory_max)
+    return read_meminfo().get("MemTotal")
+
+
+def get_memory_available() -> int | None:
+    memory_max = read_cgroup_file("memory.max")
+    memory_current = read_cgroup_file("memory.current")
+    if memory_max and memory_max != "max" and memory_current:
+        return int(memory_max) - int(memory_current)
+    return read_meminfo().get("MemAvailable")
+
+
+def read_cpu_time() -> float | None:
+    """CPU seconds used by the container, or by the whole host if the cgroup statistics are not available."""
+    if cpu_stat := read_cgroup_file("cpu.stat"):
+        for line in cpu_stat.splitlines():
+            if line.startswith("usage_usec "):
+                return int(line.split()[1]) / 1_000_000
+    try:
+        with open("/proc/stat", encoding="utf-8") as f:
+            values = [int(i) for i in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    return (sum(values) - values[3] - values[4]) / os.sysconf("SC_CLK_TCK")  # all but `idle` and `iowait`
@@ -1,21 +1,39 @@
 """Windmill as an ExApp"""
 
 import asyncio
+import bisect
+import collections
 import contextlib
+import contextvars
+import copy
+import fcntl
+import gzip
+import hashlib
+import importlib.util
 import json
 import logging
+import mimetypes
 import os
 import random
+import re
+import shlex
+import signal
+import sqlite3
 import string
+import threading
+import time
 import typing
+import zlib
 from base64 import b64decode
 from contextlib import asynccontextmanager
+from datetime import datetime
+from http.cookiejar import CookieJar, DefaultCookiePolicy
 from pathlib import Path
-from time import sleep
+from time import monotonic, perf_counter
 
 import httpx
-from fastapi import BackgroundTasks, Depends, FastAPI, Request, responses
-from nc_py_api import NextcloudApp, NextcloudException
+from fastapi import BackgroundTasks, Depends, FastAPI, Request, WebSocket, WebSocketDisconnect, responses
+from nc_py_api import AsyncNextcloudApp, NextcloudApp
 from nc_py_api.ex_app import (
     nc_app,
     persistent_storage,
@@ -23,7 +41,25 @@ from nc_py_api.ex_app import (
     setup_nextcloud_logging,
 )
 from nc_py_api.ex_app.integration_fastapi import AppAPIAuthMiddleware, fetch_models_task
-from starlette.responses import FileResponse, Response
+from starlette.requests import HTTPConnection
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from container_limits import get_cpu_limit, get_memory_available, read_cpu_time
+
+try:
+    from websockets.asyncio.client import connect as websocket_connect
+    from websockets.exceptions import ConnectionClosed as WebSocketConnectionClosed
+except ImportError:  # WebSocket connections are refused without the `websockets` package (websockets>=13)
+    websocket_connect = None
+    WebSocketConnectionClosed = WebSocketDisconnect
+try:
+    import brotli
+except ImportError:  # proxied responses are compressed with gzip or zstd only
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # proxied responses are compressed with gzip or brotli only
+    zstandard = None
 
 # os.environ["NEXTCLOUD_URL"] = "http://nextcloud.local/index.php"
 # os.environ["APP_HOST"] = "0.0.0.0"
@@ -37,15 +73,1308 @@ logging.basicConfig(
     datefmt="%H:%M:%S",
 )
 LOGGER = logging.getLogger("flow")
-LOGGER.setLevel(logging.DEBUG)
+LOGGER.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())  # DEBUG logs every proxied request
 
 DEFAULT_USER_EMAIL = "admin@windmill.dev"
+WINDMILL_URL = os.environ.get("WINDMILL_URL", "http://127.0.0.1:8000")
+
+# Limits of the shared connection pool to the Windmill backend, see `create_upstream_client`.
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", "60"))
+UPSTREAM_HTTP2 = os.environ.get("UPSTREAM_HTTP2", "0").lower() in ("1", "true", "yes")
+# How many flow definitions are fetched from Windmill at the same time during the webhooks sync.
+WEBHOOKS_SYNC_CONCURRENCY = int(os.environ.get("WEBHOOKS_SYNC_CONCURRENCY", "16"))
+FLOWS_PAGE_SIZE = 100
+# Flow changes made through the ExApp trigger the webhooks sync right away, WEBHOOKS_SYNC_INTERVAL (seconds)
+# is only a safety net for changes made in any other way.
+WEBHOOKS_SYNC_INTERVAL = float(os.environ.get("WEBHOOKS_SYNC_INTERVAL", "300"))
+WEBHOOKS_SYNC_DEBOUNCE = 0.3
+# For how long (seconds) the enabled state of the ExApp in Nextcloud is cached by the webhooks sync.
+NEXTCLOUD_ENABLED_STATE_TTL = float(os.environ.get("NEXTCLOUD_ENABLED_STATE_TTL", "60"))
+# How many listener changes are sent to Nextcloud at the same time, and how many times a failed one is retried.
+WEBHOOKS_APPLY_CONCURRENCY = int(os.environ.get("WEBHOOKS_APPLY_CONCURRENCY", "8"))
+WEBHOOKS_APPLY_RETRIES = 2
+# Listeners registered in Nextcloud are compared with the expected ones at least this often (seconds),
+# even if no flow was changed in Windmill.
+WEBHOOKS_FULL_SYNC_INTERVAL = float(os.environ.get("WEBHOOKS_FULL_SYNC_INTERVAL", "600"))
+# Bounds (seconds) of the growing delay between checks whether Windmill is up during the startup.
+WINDMILL_READY_MIN_DELAY = 0.1
+WINDMILL_READY_MAX_DELAY = 5.0
+# Number of ExApp worker processes. Each of them proxies requests, the webhooks sync runs in one of them.
+EXAPP_WORKERS = max(int(os.environ.get("EXAPP_WORKERS", "1")), 1)
+# How often (seconds) the worker running the webhooks sync checks for sync requests from the other workers,
+# and how often the other workers check whether it is still alive.
+WEBHOOKS_SYNC_REQUESTS_POLL_INTERVAL = 1.0
+WEBHOOKS_SYNC_LEADER_RETRY_INTERVAL = 5.0
+# Webhook deliveries from Nextcloud are queued and sent to Windmill by WEBHOOK_QUEUE_WORKERS tasks. When
+# WEBHOOK_QUEUE_SIZE events are waiting, new ones wait up to WEBHOOK_QUEUE_TIMEOUT seconds for a free place and
+# are then rejected with 503. WEBHOOK_QUEUE_SIZE=0 sends deliveries to Windmill directly.
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "10000"))
+WEBHOOK_QUEUE_WORKERS = int(os.environ.get("WEBHOOK_QUEUE_WORKERS", "8"))
+WEBHOOK_QUEUE_TIMEOUT = float(os.environ.get("WEBHOOK_QUEUE_TIMEOUT", "1"))
+WEBHOOK_DELIVERY_RETRIES = 2
+# With WEBHOOK_BATCH_WINDOW > 0 (seconds), events for one flow that arrive within the window are sent as one job
+# with `{"events": [...]}` arguments, at most WEBHOOK_BATCH_SIZE events per job.
+WEBHOOK_BATCH_WINDOW = float(os.environ.get("WEBHOOK_BATCH_WINDOW", "0"))
+WEBHOOK_BATCH_SIZE = int(os.environ.get("WEBHOOK_BATCH_SIZE", "100"))
+# Admission control of proxied requests: at most ADMISSION_MAX_CONCURRENCY requests wait for Windmill at once,
+# ADMISSION_USER_LIMIT of them from one user. Requests over the limits wait in a queue of their class for up to
+# ADMISSION_QUEUE_TIMEOUT seconds, interactive ones are let through first. ADMISSION_MAX_CONCURRENCY=0 disables it.
+ADMISSION_MAX_CONCURRENCY = int(os.environ.get("ADMISSION_MAX_CONCURRENCY", str(UPSTREAM_MAX_CONNECTIONS)))
+ADMISSION_USER_LIMIT = int(os.environ.get("ADMISSION_USER_LIMIT", "32"))
+ADMISSION_QUEUE_SIZE = int(os.environ.get("ADMISSION_QUEUE_SIZE", "256"))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "30"))
+# class -> (weight in the queue, max share of ADMISSION_MAX_CONCURRENCY)
+ADMISSION_CLASSES = {"interactive": (8, 1.0), "jobs": (2, 0.5), "heavy": (1, 0.25)}
+# WebSocket connections proxied to Windmill are closed after this many seconds without messages.
+WEBSOCKET_IDLE_TIMEOUT = float(os.environ.get("WEBSOCKET_IDLE_TIMEOUT", "300"))
+# Memory for cached GET responses of rarely changing Windmill endpoints, in bytes; 0 disables the cache
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", str(16 * 1024 * 1024)))
+RESPONSE_CACHE_MAX_ENTRY_SIZE = 1024 * 1024
+RESPONSE_CACHE_SYNC_INTERVAL = 1.0  # with several workers, invalidations made by the others are seen this late at most
+# Windmill accounts of the members of a Nextcloud group can be created during `/init`, before their first visit.
+# Only admins can open Flow, so by default this is the `admin` group; `*` means all Nextcloud users.
+PREPROVISION_USERS = os.environ.get("PREPROVISION_USERS", "0").lower() in ("1", "true", "yes")
+PREPROVISION_GROUP = os.environ.get("PREPROVISION_GROUP", "admin")
+PREPROVISION_CONCURRENCY = int(os.environ.get("PREPROVISION_CONCURRENCY", "8"))
+PREPROVISION_PAGE_SIZE = 500
+# Adaptive number of Windmill workers: the Windmill server runs NUM_WORKERS workers itself, up to
+# WINDMILL_WORKERS_MAX workers in total (0: twice the CPU limit) are added as separate `MODE=worker` processes
+# while jobs wait in the queue, and removed when it stays empty.
+WINDMILL_WORKERS_AUTOSCALE = os.environ.get("WINDMILL_WORKERS_AUTOSCALE", "0").lower() in ("1", "true", "yes")
+WINDMILL_BASE_WORKERS = int(os.environ.get("NUM_WORKERS", "1"))
+WINDMILL_WORKERS_MAX = int(os.environ.get("WINDMILL_WORKERS_MAX", "0"))
+WINDMILL_WORKER_COMMAND = shlex.split(os.environ.get("WINDMILL_WORKER_COMMAND", "windmill"))
+WORKERS_SCALING_INTERVAL = float(os.environ.get("WORKERS_SCALING_INTERVAL", "10"))
+WORKERS_SCALING_COOLDOWN = WORKERS_SCALING_INTERVAL * 3  # no other change right after adding or removing a worker
+WORKERS_SCALE_UP_QUEUE = 2  # more queued jobs per worker than this is a busy sample
+WORKERS_SCALE_UP_WAIT = 5.0  # the oldest queued job waiting longer than this is a busy sample
+WORKERS_SCALE_UP_SAMPLES = 2  # consecutive busy samples before a worker is added
+WORKERS_SCALE_DOWN_SAMPLES = 12  # consecutive samples with an empty queue before a worker is removed
+WORKERS_MAX_CPU_USAGE = 0.9  # no workers are added when the container uses more of its CPU limit
+WORKERS_MIN_FREE_MEMORY = 512 * 1024 * 1024  # or when less memory than this is left
+WORKERS_STOP_TIMEOUT = 120.0  # a stopped worker finishes its running job first
+# Pipe request and response bodies through the proxy chunk by chunk instead of buffering them in memory.
+PROXY_STREAMING = os.environ.get("PROXY_STREAMING", "1").lower() in ("1", "true", "yes")
+# Compression of proxied responses that Windmill sent uncompressed, for those of at least PROXY_COMPRESSION_MIN_SIZE
+# bytes (or of unknown size). Compression may use up to PROXY_COMPRESSION_CPU_BUDGET seconds of CPU time per second,
+# responses over the budget are sent uncompressed and streams already compressed wait for the next second.
+PROXY_COMPRESSION = os.environ.get("PROXY_COMPRESSION", "1").lower() in ("1", "true", "yes")
+PROXY_COMPRESSION_MIN_SIZE = int(os.environ.get("PROXY_COMPRESSION_MIN_SIZE", "1024"))
+PROXY_COMPRESSION_CPU_BUDGET = float(os.environ.get("PROXY_COMPRESSION_CPU_BUDGET", "0.25"))
+PROXY_COMPRESSION_ENCODINGS = tuple(
+    i for i, available in (("zstd", zstandard), ("br", brotli), ("gzip", True)) if available and PROXY_COMPRESSION
+)  # in the order of preference
+
+STATIC_FRONTEND_PATH = Path("/static_frontend")
+# Gzip copies of compressible frontend files without a precompressed variant are built after startup and kept here.
+STATIC_CACHE_PATH = Path(persistent_storage()).joinpath("static_cache")
+STATIC_PRECOMPRESS = os.environ.get("STATIC_PRECOMPRESS", "1").lower() in ("1", "true", "yes")
+STATIC_PRECOMPRESS_MIN_SIZE = 1024
+STATIC_COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/wasm")
+
+# Results of `/api/users/whoami` checks: valid tokens are trusted for TOKEN_CACHE_TTL seconds, rejected ones
+# are remembered for TOKEN_CACHE_NEGATIVE_TTL seconds.
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", "60"))
+TOKEN_CACHE_NEGATIVE_TTL = float(os.environ.get("TOKEN_CACHE_NEGATIVE_TTL", "10"))
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", "10000"))
+# Tokens of users active during the last TOKEN_ACTIVE_WINDOW seconds are checked and renewed in the background every
+# TOKEN_REFRESH_INTERVAL seconds, with at most TOKEN_REFRESH_RATE users per second.
+TOKEN_REFRESH_INTERVAL = float(os.environ.get("TOKEN_REFRESH_INTERVAL", "300"))
+TOKEN_ACTIVE_WINDOW = float(os.environ.get("TOKEN_ACTIVE_WINDOW", "86400"))
+TOKEN_REFRESH_RATE = float(os.environ.get("TOKEN_REFRESH_RATE", "5"))
+TOKEN_REVALIDATE_AGE = 3600  # persistent tokens do not expire, but can be revoked
+TOKEN_ACTIVITY_RESOLUTION = 600  # seconds between updates of the time when the user was last active
+USERS_STORAGE_SYNC_INTERVAL = 5.0  # with several workers, users added or changed by the others are reread this often
+# Serve `/metrics` without AppAPI authentication, for scrapers that can reach the ExApp container directly.
+METRICS_PUBLIC = os.environ.get("METRICS_PUBLIC", "0").lower() in ("1", "true", "yes")
+# Span timelines of the last TRACE_BUFFER_SIZE requests are kept in memory (0 disables tracing), requests slower than
+# TRACE_SLOW_THRESHOLD seconds are also kept among the last TRACE_SLOW_BUFFER_SIZE slow ones.
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", "1000"))
+TRACE_SLOW_THRESHOLD = float(os.environ.get("TRACE_SLOW_THRESHOLD", "1"))
+TRACE_SLOW_BUFFER_SIZE = int(os.environ.get("TRACE_SLOW_BUFFER_SIZE", "100"))
+TRACE_MAX_SPANS = 200
+# Traces are appended to this file in the OTLP JSON format, one export request per line, every TRACE_EXPORT_INTERVAL
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH", "")
+TRACE_EXPORT_INTERVAL = 1.0
+TRACE_EXCLUDED_PATHS = ("/heartbeat", "/metrics", "/exapp/")
+
+UPSTREAM_CLIENT: httpx.AsyncClient | None = None
+UPSTREAM_STATS = {"requests": 0, "connections_opened": 0}
+METRICS: list["Counter"] = []
+# Stage is one of: starting, waiting_for_windmill, initializing_windmill, creating_resources, ready, failed.
+STARTUP_STATE = {"stage": "starting", "error": "", "phases": {}}
+STATIC_ASSETS: dict[str, "StaticAsset"] = {}
+NEXTCLOUD_CLIENT: AsyncNextcloudApp | None = None
+NEXTCLOUD_STATS: dict[str, dict] = {}
+NEXTCLOUD_ENABLED_STATE = {"value": False, "time": float("-inf")}
+WEBHOOKS_SYNC_EVENT = asyncio.Event()
+WEBHOOKS_SYNC_REQUESTS: set[str] = set()
+WEBHOOKS_SYNC_STATE = {"applied_state": "", "full_sync_time": 0.0, "leader": False}
+WEBHOOKS_SYNC_FORCE = "*"  # requested "flow path" that makes the next pass compare all listeners with Nextcloud
+FLOW_CHANGE_RE = re.compile(r"^w/nextcloud/flows/(create|update|delete|archive)(?:/(.+))?$")
+STATIC_STATS = {"hits": 0, "not_modified": 0, "proxied": 0, "unindexed": 0}
+WEBSOCKET_STATS = {"opened": 0, "failed": 0, "idle_closed": 0, "active": 0}
+# Raised by the forwarding of WebSocket messages when one side closes, `RuntimeError` on sending after the close.
+WEBSOCKET_CLOSED_ERRORS = (WebSocketConnectionClosed, WebSocketDisconnect, RuntimeError)
+COMPRESSION_STATS = {
+    "zstd": 0,
+    "br": 0,
+    "gzip": 0,
+    "over_budget": 0,
+    "throttled": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+    "cpu_time": 0.0,
+}
+COMPRESSION_BUDGET = {"window_start": 0.0, "used": 0.0}
+WORKERS_SCALING_STATE = {
+    "enabled": WINDMILL_WORKERS_AUTOSCALE,
+    "workers": WINDMILL_BASE_WORKERS,
+    "base_workers": WINDMILL_BASE_WORKERS,
+    "max_workers": WINDMILL_WORKERS_MAX,
+    "queued": 0,
+    "wait_time": 0.0,
+    "cpu_usage": None,
+    "memory_available": None,
+    "busy_samples": 0,
+    "idle_samples": 0,
+    "changed": 0.0,
+    "scaled_up": 0,
+    "scaled_down": 0,
+}
+WORKERS_SCALING_DECISIONS: collections.deque[dict] = collections.deque(maxlen=50)
+WINDMILL_WORKER_PROCESSES: list[asyncio.subprocess.Process] = []
+WINDMILL_WORKERS_STOPPING: set[asyncio.Task] = set()
+WINDMILL_WORKERS_PIDS_PATH = Path(persistent_storage()).joinpath("windmill_workers.pids")
+TRACE_STATS = {"recorded": 0, "slow": 0, "exported": 0, "export_errors": 0}
+RESPONSE_CACHE_STATS = {"hits": 0, "misses": 0, "not_modified": 0, "revalidated": 0, "evicted": 0, "invalidated": 0}
+RESPONSE_CACHE_SYNC: dict = {"checked": 0.0, "generations": {}}
+PREPROVISION_STATE = {"running": False, "source": "", "total": 0, "done": 0, "created": 0, "failed": 0, "error": ""}
+# Requests with a Bearer token to these paths are sent to Windmill without provisioning the Nextcloud user.
+HEAVY_PATH_RE = re.compile(r"^/api/w/[^/]+/(?:jobs/(?:list|completed/list|queue/list)|audit/list)")
+JOBS_PATH_RE = re.compile(r"^w/[^/]+/(?:jobs/run/|jobs_u/)")
+WEBHOOK_PATH_RE = re.compile(r"^w/[^/]+/jobs/run/f/.+")
+WEBHOOK_QUEUE: asyncio.Queue[list["WebhookEvent"]] = asyncio.Queue()
+WEBHOOK_QUEUE_SLOTS = asyncio.Semaphore(WEBHOOK_QUEUE_SIZE)
+WEBHOOK_QUEUE_TASKS: list[asyncio.Task] = []
+WEBHOOK_BATCHES: dict[str, list["WebhookEvent"]] = {}
+WEBHOOK_STATS = {"queued": 0, "delivered": 0, "failed": 0, "dropped": 0, "jobs": 0, "depth": 0}
+STORAGE_DB_PATH = Path(persistent_storage()).joinpath("flow_storage.sqlite3")
+# Users were stored in this file before the SQLite storage, it is migrated automatically.
 USERS_STORAGE_PATH = Path(persistent_storage()).joinpath("windmill_users_config.json")
-USERS_STORAGE = {}
-print("[DEBUG]: USERS_STORAGE_PATH=", str(USERS_STORAGE_PATH), flush=True)
-if USERS_STORAGE_PATH.exists():
-    with open(USERS_STORAGE_PATH, encoding="utf-8") as __f:
-        USERS_STORAGE.update(json.load(__f))
+# Lock files coordinating the worker processes.
+LOCKS_PATH = Path(persistent_storage()).joinpath("locks")
+print("[DEBUG]: STORAGE_DB_PATH=", str(STORAGE_DB_PATH), flush=True)
+
+
+def _upstream_client_options() -> dict:
+    http2 = UPSTREAM_HTTP2
+    if http2 and importlib.util.find_spec("h2") is None:
+        LOGGER.warning("UPSTREAM_HTTP2 is set, but the `h2` package is not installed, falling back to HTTP/1.1")
+        http2 = False
+    return {
+        "base_url": WINDMILL_URL,
+        "limits": httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(UPSTREAM_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+        # The client is shared between all users, it must never remember cookies set by Windmill.
+        "cookies": CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+        # Windmill listens on plain HTTP, so HTTP/2 can only be used with "prior knowledge".
+        "http1": not http2,
+        "http2": http2,
+    }
+
+
+async def _on_upstream_request(request: httpx.Request) -> None:
+    UPSTREAM_STATS["requests"] += 1
+    request.extensions["trace"] = _upstream_trace
+
+
+async def _upstream_trace(event_name: str, _info: dict) -> None:
+    if event_name == "connection.connect_tcp.started":
+        UPSTREAM_STATS["connections_opened"] += 1
+    if event_name in UPSTREAM_TRACE_EVENTS and (current := CURRENT_SPAN.get()) is not None:
+        trace, parent = current
+        name, started = UPSTREAM_TRACE_EVENTS[event_name]
+        if started:
+            trace.pending[name] = perf_counter()
+        elif name in trace.pending:
+            trace.add_span(name, parent, trace.pending.pop(name), perf_counter())
+
+
+def create_upstream_client() -> None:
+    global UPSTREAM_CLIENT
+    UPSTREAM_CLIENT = httpx.AsyncClient(**_upstream_client_options(), event_hooks={"request": [_on_upstream_request]})
+
+
+async def close_upstream_client() -> None:
+    global UPSTREAM_CLIENT
+    if UPSTREAM_CLIENT is not None:
+        await UPSTREAM_CLIENT.aclose()
+        UPSTREAM_CLIENT = None
+    LOGGER.debug("Upstream pool stats: %s", get_upstream_stats())
+
+
+def get_upstream_client() -> httpx.AsyncClient:
+    if UPSTREAM_CLIENT is None:
+        create_upstream_client()
+    return UPSTREAM_CLIENT
+
+
+def get_upstream_stats() -> dict:
+    requests_count = UPSTREAM_STATS["requests"]
+    return {
+        "requests": requests_count,
+        "connections_opened": UPSTREAM_STATS["connections_opened"],
+        "connections_reused": max(requests_count - UPSTREAM_STATS["connections_opened"], 0),
+        "http2": bool(UPSTREAM_CLIENT is not None and UPSTREAM_HTTP2 and importlib.util.find_spec("h2")),
+    }
+
+
+class TTLCache:
+    """Thread-safe LRU cache with an expiration time for each entry."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data: collections.OrderedDict[str, tuple[float, typing.Any]] = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default: typing.Any = None) -> typing.Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] < monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key: str, value: typing.Any, ttl: float) -> None:
+        with self._lock:
+            self._data[key] = (monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class ResponseCacheRule(typing.NamedTuple):
+    path_re: re.Pattern
+    ttl: float
+    per_user: bool  # responses depend on the user, so they are cached for each token separately
+    invalidated_by: re.Pattern | None  # successful changes sent to these paths drop the cached responses
+
+
+class CachedResponse(typing.NamedTuple):
+    rule: str
+    stored: float
+    expires: float
+    status_code: int
+    headers: dict
+    body: bytes
+    etag: str
+
+
+class ResponseCache:
+    """LRU cache of proxied responses, bounded by the total size of their bodies. Used only from the event loop."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._data: collections.OrderedDict[str, CachedResponse] = collections.OrderedDict()
+
+    def get(self, key: str) -> CachedResponse | None:
+        """Returns also expired entries that have an ETag, they can be revalidated instead of being fetched again."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry.expires < monotonic() and not entry.etag:
+            self.pop(key)
+            return None
+        self._data.move_to_end(key)
+        return entry
+
+    def set(self, key: str, entry: CachedResponse) -> None:
+        self.pop(key)
+        if len(entry.body) > min(self.max_size, RESPONSE_CACHE_MAX_ENTRY_SIZE):
+            return
+        self._data[key] = entry
+        self.size += len(entry.body)
+        while self.size > self.max_size:
+            _, evicted = self._data.popitem(last=False)
+            self.size -= len(evicted.body)
+            RESPONSE_CACHE_STATS["evicted"] += 1
+
+    def pop(self, key: str) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.body)
+
+    def invalidate(self, rule: str) -> int:
+        keys = [key for key, entry in self._data.items() if entry.rule == rule]
+        for key in keys:
+            self.pop(key)
+        return len(keys)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+TOKEN_CACHE = TTLCache(TOKEN_CACHE_SIZE)
+RESPONSE_CACHE = ResponseCache(RESPONSE_CACHE_SIZE)
+# Only these GET endpoints are cached, their responses rarely change and are requested on every page load.
+RESPONSE_CACHE_RULES = {
+    "version": ResponseCacheRule(re.compile(r"^/api/version$"), 300, False, None),
+    "hub": ResponseCacheRule(re.compile(r"^/api/(?:scripts|flows|apps|integrations)/hub/"), 300, False, None),
+    "resource_types": ResponseCacheRule(
+        re.compile(r"^/api/w/[^/]+/resources/type/list"), 60, False, re.compile(r"^/api/w/[^/]+/resources/type/")
+    ),
+    "workspace_settings": ResponseCacheRule(
+        re.compile(r"^/api/w/[^/]+/workspaces/get_settings$"), 30, True, re.compile(r"^/api/w/[^/]+/workspaces/")
+    ),
+    "whoami": ResponseCacheRule(
+        re.compile(r"^/api/(?:w/[^/]+/)?users/whoami$"), 10, True, re.compile(r"^/api/(?:(?:w/[^/]+/)?users|auth)/")
+    ),
+}
+TOKEN_CHECKS_IN_FLIGHT: dict[str, asyncio.Task] = {}
+USER_LOCKS: collections.defaultdict[str, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+TOKEN_STATS = {"hits": 0, "misses": 0, "invalidations": 0}
+TOKEN_LIFECYCLE_STATS = {"checked": 0, "upgraded": 0, "renewed": 0, "failed": 0, "request_logins": 0}
+USERS_ACTIVITY: dict[str, float] = {}
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, status_code: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+
+
+class AdmissionController:
+    """Concurrency limits per request class and per user, with weighted queues of the waiting requests.
+
+    Waiting requests are admitted by smooth weighted round-robin between the classes. Within a class the users take
+    turns, FIFO for each user, so a user at the limit does not hold up the requests of the others.
+    """
+
+    def __init__(self, max_concurrency: int, user_limit: int, queue_size: int, classes: dict[str, tuple[int, float]]):
+        self.max_concurrency = max_concurrency
+        self.user_limit = user_limit
+        self.queue_size = queue_size
+        self.weights = {name: weight for name, (weight, _) in classes.items()}
+        self.limits = {name: max(int(max_concurrency * share), 1) for name, (_, share) in classes.items()}
+        self.queues: dict[str, dict[str, collections.deque[asyncio.Future]]] = {i: {} for i in classes}
+        self.current_weights = dict.fromkeys(classes, 0)
+        self.in_flight = 0
+        self.class_in_flight: collections.Counter[str] = collections.Counter()
+        self.user_in_flight: collections.Counter[str] = collections.Counter()
+        self.user_waiting: collections.Counter[str] = collections.Counter()
+        self.stats = {i: {"admitted": 0, "queued": 0, "rejected": 0, "wait_time": 0.0} for i in classes}
+
+    def _can_start(self, request_class: str, user: str) -> bool:
+        return (
+            self.in_flight < self.max_concurrency
+            and self.class_in_flight[request_class] < self.limits[request_class]
+            and (not user or self.user_in_flight[user] < self.user_limit)
+        )
+
+    def _start(self, request_class: str, user: str) -> None:
+        self.in_flight += 1
+        self.class_in_flight[request_class] += 1
+        self.user_in_flight[user] += 1
+        self.stats[request_class]["admitted"] += 1
+
+    def _reject(self, request_class: str, status_code: int, reason: str) -> typing.NoReturn:
+        self.stats[request_class]["rejected"] += 1
+        raise AdmissionRejectedError(status_code, reason)
+
+    def release(self, request_class: str, user: str) -> None:
+        self.in_flight -= 1
+        self.class_in_flight[request_class] -= 1
+        self.user_in_flight[user] -= 1
+        if not self.user_in_flight[user]:
+            del self.user_in_flight[user]
+        self._dispatch()
+
+    def _waiting(self, request_class: str) -> int:
+        return sum(len(i) for i in self.queues[request_class].values())
+
+    def _next_user(self, request_class: str) -> str | None:
+        """First user in turn whose oldest waiting request of the class can start now."""
+        users = self.queues[request_class]
+        for user, futures in list(users.items()):
+            while futures and futures[0].done():  # timed out or cancelled
+                futures.popleft()
+            if not futures:
+                del users[user]
+            elif self._can_start(request_class, user):
+                return user
+        return None
+
+    def _dispatch(self) -> None:
+        while self.in_flight < self.max_concurrency:
+            ready = {i: user for i in self.queues if (user := self._next_user(i)) is not None}
+            if not ready:
+                return
+            for i in ready:
+                self.current_weights[i] += self.weights[i]
+            request_class = max(ready, key=self.current_weights.__getitem__)
+            self.current_weights[request_class] -= sum(self.weights[i] for i in ready)
+            user = ready[request_class]
+            users = self.queues[request_class]
+            future = users[user].popleft()
+            users[user] = users.pop(user)  # the user goes to the end of the turn
+            if not users[user]:
+                del users[user]
+            self._start(request_class, user)
+            future.set_result(None)
+
+    async def acquire(self, request_class: str, user: str, timeout: float) -> None:
+        users = self.queues[request_class]
+        if user not in users and self._can_start(request_class, user):
+            self._start(request_class, user)
+            return
+        if self._waiting(request_class) >= self.queue_size:
+            self._reject(request_class, 503, "Too many requests are waiting for Windmill")
+        if user and self.user_waiting[user] >= self.user_limit:
+            self._reject(request_class, 429, "Too many requests of the user are waiting for Windmill")
+        future = asyncio.get_running_loop().create_future()
+        users.setdefault(user, collections.deque()).append(future)
+        self.stats[request_class]["queued"] += 1
+        self.user_waiting[user] += 1
+        start_time = monotonic()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                self.release(request_class, user)  # admitted at the same moment
+            elif future in users.get(user, ()):
+                users[user].remove(future)
+                if not users[user]:
+                    del users[user]
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self._reject(request_class, 503, "Timed out waiting for Windmill")
+        finally:
+            self.user_waiting[user] -= 1
+            if not self.user_waiting[user]:
+                del self.user_waiting[user]
+            self.stats[request_class]["wait_time"] += monotonic() - start_time
+
+    @asynccontextmanager
+    async def admit(self, request_class: str, user: str) -> typing.AsyncIterator[None]:
+        if not self.max_concurrency:
+            yield
+            return
+        with trace_span("admission", request_class=request_class):
+            await self.acquire(request_class, user, ADMISSION_QUEUE_TIMEOUT)
+        try:
+            yield
+        finally:
+            self.release(request_class, user)
+
+    def get_stats(self) -> dict:
+        return {
+            i: {**stats, "in_flight": self.class_in_flight[i], "waiting": self._waiting(i)}
+            for i, stats in self.stats.items()
+        }
+
+
+class Counter:
+    """Prometheus-like counter, values are kept in the process memory."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: collections.defaultdict[tuple, float] = collections.defaultdict(float)
+        METRICS.append(self)
+
+    def inc(self, *labels: str, value: float = 1.0) -> None:
+        self.values[labels] += value
+
+    def samples(self) -> typing.Iterator[tuple[str, tuple, float]]:
+        for labels, value in self.values.items():
+            yield self.name + ("_total" if self.type == "counter" else ""), labels, value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, *labels: str, value: float) -> None:
+        self.values[labels] = value
+
+
+class Histogram(Counter):
+    type = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (), buckets: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets or self.default_buckets
+        self.counts: dict[tuple, list[int]] = {}  # cumulative, as in Prometheus
+        self.totals: collections.defaultdict[tuple, int] = collections.defaultdict(int)
+
+    def observe(self, value: float, *labels: str) -> None:
+        counts = self.counts.setdefault(labels, [0] * len(self.buckets))
+        for i in range(bisect.bisect_left(self.buckets, value), len(self.buckets)):
+            counts[i] += 1
+        self.totals[labels] += 1
+        self.values[labels] += value
+
+    @contextlib.contextmanager
+    def time(self, *labels: str) -> typing.Iterator[None]:
+        start_time = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start_time, *labels)
+
+    def samples(self) -> typing.Iterator[tuple[str, tuple, float]]:
+        for labels, counts in self.counts.items():
+            for bucket, count in zip(self.buckets, counts, strict=True):
+                yield self.name + "_bucket", (*labels, ("le", str(bucket))), count
+            yield self.name + "_bucket", (*labels, ("le", "+Inf")), self.totals[labels]
+            yield self.name + "_sum", labels, self.values[labels]
+            yield self.name + "_count", labels, self.totals[labels]
+
+
+def escape_label_value(value: typing.Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples():
+            # Extra labels (like `le` of histograms) are passed as (name, value) pairs after the declared ones.
+            label_pairs = list(zip(metric.labelnames, labels[: len(metric.labelnames)], strict=True))
+            label_pairs += labels[len(metric.labelnames) :]
+            label_str = ",".join(f'{k}="{escape_label_value(v)}"' for k, v in label_pairs)
+            lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class LazyJSON:
+    """Serializes the value for a log message only if the message is emitted."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: typing.Any):
+        self.value = value
+
+    def __str__(self) -> str:
+        return json.dumps(self.value, indent=4)
+
+
+class Trace:
+    """Span timeline of one request.
+
+    Each span is ``[name, parent index, start, end, attributes]`` with ``perf_counter`` times, the request is span 0.
+    """
+
+    __slots__ = ("pending", "spans", "trace_id", "wall_time")
+
+    def __init__(self, name: str, attributes: dict):
+        self.trace_id = os.urandom(16).hex()
+        self.wall_time = time.time()
+        self.spans: list[list] = [[name, -1, perf_counter(), 0.0, attributes]]
+        self.pending: dict[str, float] = {}  # start times of spans built from upstream client events
+
+    @property
+    def duration(self) -> float:
+        return self.spans[0][3] - self.spans[0][2]
+
+    def add_span(self, name: str, parent: int, start: float, end: float = 0.0, attributes: dict | None = None) -> int:
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            return -1
+        self.spans.append([name, parent, start, end, attributes or {}])
+        return len(self.spans) - 1
+
+    def to_dict(self) -> dict:
+        start = self.spans[0][2]
+        return {
+            "trace_id": self.trace_id,
+            "name": self.spans[0][0],
+            "time": self.wall_time,
+            "duration_ms": round(self.duration * 1000, 3),
+            "spans": [
+                {
+                    "name": name,
+                    "parent": parent,
+                    "start_ms": round((span_start - start) * 1000, 3),
+                    "duration_ms": round((span_end - span_start) * 1000, 3) if span_end else None,
+                    **({"attributes": attributes} if attributes else {}),
+                }
+                for name, parent, span_start, span_end, attributes in self.spans
+            ],
+        }
+
+    def to_otlp_spans(self) -> list[dict]:
+        start = self.spans[0][2]
+        return [
+            {
+                "traceId": self.trace_id,
+                "spanId": f"{index + 1:016x}",
+                "parentSpanId": f"{parent + 1:016x}" if parent >= 0 else "",
+                "name": name,
+                "kind": 2 if parent < 0 else 1,  # SPAN_KIND_SERVER, SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(int((self.wall_time + span_start - start) * 1e9)),
+                "endTimeUnixNano": str(int((self.wall_time + (span_end or span_start) - start) * 1e9)),
+                "attributes": [
+                    {
+                        "key": key,
+                        "value": {"intValue": str(value)} if type(value) is int else {"stringValue": str(value)},
+                    }
+                    for key, value in attributes.items()
+                ],
+            }
+            for index, (name, parent, span_start, span_end, attributes) in enumerate(self.spans)
+        ]
+
+
+class TracingMiddleware:
+    """Records the span timeline of HTTP requests, the body transfer span ends with the last chunk of the response."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or TRACE_BUFFER_SIZE <= 0 or scope["path"].startswith(TRACE_EXCLUDED_PATHS):
+            await self.app(scope, receive, send)
+            return
+        trace = Trace(
+            f"{scope['method']} {get_proxy_route(scope['path'])}",
+            {"http.method": scope["method"], "http.target": scope["path"]},
+        )
+        body_span = -1
+
+        async def _send(message) -> None:
+            nonlocal body_span
+            if message["type"] == "http.response.start":
+                trace.spans[0][4]["http.status_code"] = message["status"]
+                body_span = trace.add_span("response.body", 0, perf_counter())
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body") and body_span >= 0:
+                trace.spans[body_span][3] = perf_counter()
+
+        context_token = CURRENT_SPAN.set((trace, 0))
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            trace.spans[0][3] = perf_counter()
+            CURRENT_SPAN.reset(context_token)
+            record_trace(trace)
+
+
+CURRENT_SPAN: contextvars.ContextVar[tuple[Trace, int] | None] = contextvars.ContextVar("current_span", default=None)
+TRACES: collections.deque[Trace] = collections.deque(maxlen=max(TRACE_BUFFER_SIZE, 1))
+SLOW_TRACES: collections.deque[Trace] = collections.deque(maxlen=max(TRACE_SLOW_BUFFER_SIZE, 1))
+TRACES_TO_EXPORT: list[Trace] = []
+# Events of the upstream HTTP client that start and end spans of the traced request.
+UPSTREAM_TRACE_EVENTS = {
+    "connection.connect_tcp.started": ("upstream.connect", True),
+    "connection.connect_tcp.complete": ("upstream.connect", False),
+    "http11.send_request_headers.started": ("upstream.first_byte", True),
+    "http11.receive_response_headers.complete": ("upstream.first_byte", False),
+    "http2.send_request_headers.started": ("upstream.first_byte", True),
+    "http2.receive_response_headers.complete": ("upstream.first_byte", False),
+}
+
+
+class FileLock:
+    """Exclusive lock of a file, shared by the worker processes. The OS releases it when the holding process dies."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._fd: int | None = None
+
+    @property
+    def locked(self) -> bool:
+        return self._fd is not None
+
+    def acquire(self, blocking: bool = False) -> bool:
+        if self._fd is not None:
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self) -> None:
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self) -> "FileLock":
+        self.acquire(blocking=True)
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+@asynccontextmanager
+async def workers_lock(name: str) -> typing.AsyncIterator[None]:
+    """Serializes the block between the worker processes, does nothing if there is only one of them."""
+    if EXAPP_WORKERS == 1:
+        yield
+        return
+    lock = FileLock(LOCKS_PATH.joinpath(f"{name}.lock"))
+    delay = 0.01
+    while not lock.acquire():  # polling instead of a blocking call in a thread, so cancellation can not leak the lock
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.2)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+class SQLiteUsersStorage:
+    """Windmill accounts of Nextcloud users, cached in memory and persisted in SQLite.
+
+    Each change is a single-row upsert committed in its own transaction, so its cost does not depend
+    on the number of users and an interrupted write never corrupts the storage. Lookups are served from memory only,
+    changes made by other worker processes are picked up by ``reload`` and ``reload_changed`` run in a thread.
+    """
+
+    def __init__(self, db_path: Path):
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=FULL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS users (email TEXT PRIMARY KEY, password TEXT NOT NULL, token TEXT NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS preprovision_checkpoints "
+                "(source TEXT PRIMARY KEY, last_user_id TEXT NOT NULL)"
+            )
+            self._db.execute("BEGIN IMMEDIATE")  # other worker processes could be adding the same columns
+            columns = {i[1] for i in self._db.execute("PRAGMA table_info(users)")}
+            for column, column_type in (
+                ("persistent", "INTEGER"),
+                ("issued_at", "REAL"),
+                ("validated_at", "REAL"),
+                ("used_at", "REAL"),
+            ):
+                if column not in columns:
+                    self._db.execute(f"ALTER TABLE users ADD COLUMN {column} {column_type} NOT NULL DEFAULT 0")
+            self._db.execute("COMMIT")
+            self._users = self._read_users()
+
+    def _read_users(self) -> dict[str, dict]:
+        self._data_version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        return {
+            email: {"password": password, "token": token, "persistent": bool(persistent)}
+            for email, password, token, persistent in self._db.execute(
+                "SELECT email, password, token, persistent FROM users"
+            )
+        }
+
+    def __contains__(self, user_email: str) -> bool:
+        return user_email in self._users
+
+    def __getitem__(self, user_email: str) -> dict:
+        return self._users[user_email]
+
+    def reload_changed(self) -> bool:
+        """Rereads all users if another worker process wrote to the database since the last check."""
+        with self._lock:
+            if self._db.execute("PRAGMA data_version").fetchone()[0] == self._data_version:
+                return False
+            self._users = self._read_users()
+            return True
+
+    def reload(self, user_email: str) -> dict | None:
+        """Rereads the user from the database, other worker processes could have added or changed it."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT password, token, persistent FROM users WHERE email = ?", (user_email,)
+            ).fetchone()
+            if row is None:
+                self._users.pop(user_email, None)
+                return None
+            self._users[user_email] = {"password": row[0], "token": row[1], "persistent": bool(row[2])}
+            return self._users[user_email]
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def set(self, user_email: str, password: str, token: str, persistent: bool = False) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO users (email, password, token, persistent, issued_at, validated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(email) DO UPDATE SET password=excluded.password, "
+                "token=excluded.token, persistent=excluded.persistent, issued_at=excluded.issued_at, "
+                "validated_at=excluded.validated_at",
+                (user_email, password, token, int(persistent), now, now),
+            )
+            self._users[user_email] = {"password": password, "token": token, "persistent": persistent}
+
+    def mark_validated(self, user_email: str) -> None:
+        with self._lock:
+            self._db.execute("UPDATE users SET validated_at = ? WHERE email = ?", (time.time(), user_email))
+
+    def mark_used(self, user_email: str) -> None:
+        with self._lock:
+            self._db.execute("UPDATE users SET used_at = ? WHERE email = ?", (time.time(), user_email))
+
+    def get_tokens_to_refresh(self) -> list[str]:
+        """Active users with a session token that expires, or with a token that was not checked for a while."""
+        now = time.time()
+        with self._lock:
+            return [
+                i[0]
+                for i in self._db.execute(
+                    "SELECT email FROM users WHERE used_at >= ? AND (persistent = 0 OR validated_at < ?) "
+                    "ORDER BY validated_at",
+                    (now - TOKEN_ACTIVE_WINDOW, now - TOKEN_REVALIDATE_AGE),
+                )
+            ]
+
+    def get_preprovision_progress(self, source: str) -> str:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT last_user_id FROM preprovision_checkpoints WHERE source = ?", (source,)
+            ).fetchone()
+        return row[0] if row else ""
+
+    def set_preprovision_progress(self, source: str, last_user_id: str | None) -> None:
+        """Saves the last handled user ID of the sorted list, ``None`` means that the job is finished."""
+        with self._lock:
+            if last_user_id is None:
+                self._db.execute("DELETE FROM preprovision_checkpoints WHERE source = ?", (source,))
+                return
+            self._db.execute(
+                "INSERT INTO preprovision_checkpoints (source, last_user_id) VALUES (?, ?) "
+                "ON CONFLICT(source) DO UPDATE SET last_user_id=excluded.last_user_id",
+                (source, last_user_id),
+            )
+
+    def migrate_from_json(self, json_path: Path) -> None:
+        if not json_path.exists():
+            return
+        with open(json_path, encoding="utf-8") as f:
+            users = json.load(f)
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT INTO users (email, password, token) VALUES (?, ?, ?) ON CONFLICT(email) DO NOTHING",
+                [(email, i["password"], i.get("token", "")) for email, i in users.items()],
+            )
+            self._db.execute("COMMIT")
+            for email, password, token in self._db.execute("SELECT email, password, token FROM users"):
+                self._users[email] = {"password": password, "token": token, "persistent": False}
+        with contextlib.suppress(FileNotFoundError):  # already migrated by another worker process
+            json_path.rename(json_path.with_suffix(".json.migrated"))
+        LOGGER.info("Migrated %d users from %s", len(users), json_path)
+
+
+class WebhookEvent(typing.NamedTuple):
+    url: str
+    query: str
+    authorization: str
+    content_type: str
+    body: bytes
+
+
+class StaticAsset(typing.NamedTuple):
+    path: Path
+    size: int
+    etag: str
+    content_type: str
+    immutable: bool
+    encodings: dict[str, Path]  # `content-encoding` -> path to the precompressed file
+
+
+class SQLiteFlowsCache:
+    """Webhook listener specs of Windmill flows, keyed by flow path and the flow version they were parsed from."""
+
+    def __init__(self, db_path: Path):
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS flow_specs (path TEXT PRIMARY KEY, version TEXT NOT NULL, spec TEXT)"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS sync_requests (path TEXT PRIMARY KEY)")
+        self.reload()
+
+    def reload(self) -> None:
+        with self._lock:
+            self._flows = {
+                path: (version, json.loads(spec) if spec else None)
+                for path, version, spec in self._db.execute("SELECT path, version, spec FROM flow_specs")
+            }
+
+    def get_version(self, flow_path: str) -> str | None:
+        item = self._flows.get(flow_path)
+        return item[0] if item else None
+
+    def paths(self) -> list[str]:
+        return list(self._flows)
+
+    def listeners(self) -> list[dict]:
+        return [copy.deepcopy(spec) for _, spec in self._flows.values() if spec is not None]
+
+    def get_listener(self, flow_path: str) -> dict | None:
+        item = self._flows.get(flow_path)
+        return copy.deepcopy(item[1]) if item and item[1] is not None else None
+
+    def update(self, changed: dict[str, tuple[str, dict | None]], removed: list[str]) -> None:
+        if not changed and not removed:
+            return
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT INTO flow_specs (path, version, spec) VALUES (?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET version=excluded.version, spec=excluded.spec",
+                [(path, version, json.dumps(spec) if spec else None) for path, (version, spec) in changed.items()],
+            )
+            self._db.executemany("DELETE FROM flow_specs WHERE path = ?", [(i,) for i in removed])
+            self._db.execute("COMMIT")
+            self._flows.update(changed)
+            for i in removed:
+                self._flows.pop(i, None)
+
+    def add_sync_request(self, flow_path: str) -> None:
+        with self._lock:
+            self._db.execute("INSERT INTO sync_requests (path) VALUES (?) ON CONFLICT(path) DO NOTHING", (flow_path,))
+
+    def pop_sync_requests(self) -> set[str]:
+        with self._lock:
+            return {i[0] for i in self._db.execute("DELETE FROM sync_requests RETURNING path")}
+
+
+class SQLiteCacheGenerations:
+    """Generations of the response cache rules, bumped on invalidation so other worker processes drop their copies."""
+
+    def __init__(self, db_path: Path):
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache_generations (rule TEXT PRIMARY KEY, generation INTEGER)"
+            )
+
+    def get_all(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._db.execute("SELECT rule, generation FROM response_cache_generations"))
+
+    def bump(self, rules: list[str]) -> dict[str, int]:
+        with self._lock:
+            return {
+                rule: (
+                    self._db.execute(
+                        "INSERT INTO response_cache_generations (rule, generation) VALUES (?, 1) "
+                        "ON CONFLICT(rule) DO UPDATE SET generation = generation + 1 RETURNING generation",
+                        (rule,),
+                    ).fetchone()[0]
+                )
+                for rule in rules
+            }
+
+
+PROXY_DURATION = Histogram(
+    "flow_proxy_request_duration_seconds",
+    "Time until response headers of requests proxied to Windmill.",
+    ("route", "status"),
+)
+PROVISION_DURATION = Histogram(
+    "flow_provision_request_duration_seconds", "Windmill requests made to provision users.", ("call", "status")
+)
+WEBHOOKS_SYNC_DURATION = Histogram(
+    "flow_webhooks_sync_duration_seconds", "Duration of webhooks sync passes.", ("result",)
+)
+WEBHOOKS_SYNC_FLOWS = Gauge("flow_webhooks_sync_flows", "Number of flows known to the webhooks sync.")
+WEBHOOKS_LISTENER_CHANGES = Counter(
+    "flow_webhooks_listener_changes", "Listener changes made by the webhooks sync.", ("action", "result")
+)
+STARTUP_PHASE_DURATION = Gauge("flow_startup_phase_duration_seconds", "Duration of ExApp startup phases.", ("phase",))
+# Values of these are copied from the stats dictionaries (see `collect_stats_metrics`).
+FRONTEND_REQUESTS = Counter("flow_frontend_requests", "Frontend requests by how they were served.", ("result",))
+UPSTREAM_REQUESTS = Counter("flow_upstream_requests", "Requests sent to Windmill.")
+UPSTREAM_CONNECTIONS = Counter("flow_upstream_connections_opened", "Connections opened to Windmill.")
+TOKEN_CACHE_REQUESTS = Counter("flow_token_cache_requests", "Token cache lookups and invalidations.", ("result",))
+TOKEN_CACHE_ENTRIES = Gauge("flow_token_cache_size", "Tokens in the token cache.")
+TOKEN_LIFECYCLE = Counter("flow_token_lifecycle", "Background token checks and logins by their outcome.", ("result",))
+RESPONSE_CACHE_REQUESTS = Counter("flow_response_cache_requests", "Response cache lookups by outcome.", ("result",))
+COMPRESSION_RESPONSES = Counter(
+    "flow_proxy_compression_responses",
+    "Proxied responses compressed by encoding or not due to the CPU budget, and streamed chunks delayed by it.",
+    ("result",),
+)
+COMPRESSION_BYTES = Counter("flow_proxy_compression_bytes", "Bytes before and after compression.", ("direction",))
+COMPRESSION_CPU_SECONDS = Counter("flow_proxy_compression_cpu_seconds", "CPU time spent compressing responses.")
+RESPONSE_CACHE_BYTES = Gauge("flow_response_cache_bytes", "Size of the responses in the response cache.")
+WEBHOOK_EVENTS = Counter("flow_webhook_events", "Webhook deliveries from Nextcloud by their outcome.", ("result",))
+WEBHOOK_JOBS = Counter("flow_webhook_jobs", "Windmill jobs started for webhook deliveries.")
+WEBHOOK_QUEUE_DEPTH = Gauge("flow_webhook_queue_depth", "Webhook deliveries waiting to be sent to Windmill.")
+ADMISSION_REQUESTS = Counter(
+    "flow_admission_requests", "Proxied requests admitted, queued or rejected by class.", ("class", "result")
+)
+ADMISSION_WAIT_SECONDS = Counter("flow_admission_wait_seconds", "Time spent by requests in the queues.", ("class",))
+ADMISSION_IN_FLIGHT = Gauge("flow_admission_in_flight", "Requests waiting for Windmill by class.", ("class",))
+ADMISSION_QUEUE_DEPTH = Gauge("flow_admission_queue_depth", "Requests waiting in the queue by class.", ("class",))
+WEBSOCKET_DURATION = Histogram(
+    "flow_websocket_connection_duration_seconds",
+    "Lifetime of WebSocket connections proxied to Windmill.",
+    ("route",),
+    buckets=(1.0, 10.0, 60.0, 300.0, 900.0, 3600.0, 14400.0),
+)
+WEBSOCKET_MESSAGES = Counter("flow_websocket_messages", "WebSocket messages proxied, by direction.", ("direction",))
+WEBSOCKET_BYTES = Counter("flow_websocket_bytes", "Size of WebSocket messages proxied, by direction.", ("direction",))
+WEBSOCKET_CONNECTIONS = Counter("flow_websocket_connections", "WebSocket connections by outcome.", ("result",))
+WEBSOCKET_ACTIVE = Gauge("flow_websocket_active_connections", "Open WebSocket connections.")
+NEXTCLOUD_CALLS = Counter("flow_nextcloud_calls", "Nextcloud calls of the webhooks sync.", ("call",))
+NEXTCLOUD_ERRORS = Counter("flow_nextcloud_errors", "Failed Nextcloud calls of the webhooks sync.", ("call",))
+NEXTCLOUD_SECONDS = Counter("flow_nextcloud_seconds", "Time spent in Nextcloud calls of the webhooks sync.", ("call",))
+WINDMILL_WORKERS = Gauge("flow_windmill_workers", "Windmill workers, including the ones added by the autoscaling.")
+WINDMILL_QUEUE_LENGTH = Gauge("flow_windmill_queue_length", "Jobs waiting in the Windmill queue.")
+WINDMILL_QUEUE_WAIT = Gauge("flow_windmill_queue_wait_seconds", "Time the oldest queued Windmill job waits.")
+WINDMILL_WORKERS_SCALING = Counter("flow_windmill_workers_scaling", "Windmill workers added and removed.", ("action",))
+
+USERS_STORAGE = SQLiteUsersStorage(STORAGE_DB_PATH)
+USERS_STORAGE.migrate_from_json(USERS_STORAGE_PATH)
+FLOWS_CACHE = SQLiteFlowsCache(STORAGE_DB_PATH)
+RESPONSE_CACHE_GENERATIONS = SQLiteCacheGenerations(STORAGE_DB_PATH)
+WEBHOOKS_SYNC_LOCK = FileLock(LOCKS_PATH.joinpath("webhooks_sync.lock"))
+ADMISSION = AdmissionController(
+    ADMISSION_MAX_CONCURRENCY, ADMISSION_USER_LIMIT, ADMISSION_QUEUE_SIZE, ADMISSION_CLASSES
+)
+
+
+def cache_token_state(token: str, valid: bool) -> None:
+    TOKEN_CACHE.set(token, valid, TOKEN_CACHE_TTL if valid else TOKEN_CACHE_NEGATIVE_TTL)
+
+
+def invalidate_token(token: str) -> None:
+    TOKEN_STATS["invalidations"] += 1
+    TOKEN_CACHE.pop(token)
+
+
+def get_token_cache_stats() -> dict:
+    return {**TOKEN_STATS, "size": len(TOKEN_CACHE), "lifecycle": TOKEN_LIFECYCLE_STATS}
+
+
+def get_response_cache_stats() -> dict:
+    return {**RESPONSE_CACHE_STATS, "entries": len(RESPONSE_CACHE), "size": RESPONSE_CACHE.size}
+
+
+@contextlib.contextmanager
+def trace_span(name: str, **attributes) -> typing.Iterator[None]:
+    """Adds a span to the trace of the current request, does nothing outside of traced requests."""
+    current = CURRENT_SPAN.get()
+    if current is None:
+        yield
+        return
+    trace, parent = current
+    index = trace.add_span(name, parent, perf_counter(), attributes=attributes)
+    if index < 0:
+        yield
+        return
+    context_token = CURRENT_SPAN.set((trace, index))
+    try:
+        yield
+    finally:
+        trace.spans[index][3] = perf_counter()
+        CURRENT_SPAN.reset(context_token)
+
+
+def record_trace(trace: Trace) -> None:
+    TRACE_STATS["recorded"] += 1
+    TRACES.append(trace)
+    if trace.duration >= TRACE_SLOW_THRESHOLD:
+        TRACE_STATS["slow"] += 1
+        SLOW_TRACES.append(trace)
+    if TRACE_EXPORT_PATH:
+        if not TRACES_TO_EXPORT:
+            asyncio.get_running_loop().call_later(TRACE_EXPORT_INTERVAL, flush_traces_export)
+        TRACES_TO_EXPORT.append(trace)
+
+
+def flush_traces_export() -> None:
+    traces = list(TRACES_TO_EXPORT)
+    TRACES_TO_EXPORT.clear()
+    _t = asyncio.get_running_loop().run_in_executor(None, export_traces, traces)  # noqa
+
+
+def export_traces(traces: list[Trace]) -> None:
+    """Appends the traces as one OTLP JSON ``ExportTraceServiceRequest``, readable by the OpenTelemetry Collector."""
+    data = {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "flow"}}]},
+                "scopeSpans": [{"scope": {"name": "flow"}, "spans": [s for i in traces for s in i.to_otlp_spans()]}],
+            }
+        ]
+    }
+    try:
+        with open(TRACE_EXPORT_PATH, "a", encoding="utf-8") as f:
+            f.write(json.dumps(data, separators=(",", ":")) + "\n")
+        TRACE_STATS["exported"] += len(traces)
+    except OSError as e:
+        TRACE_STATS["export_errors"] += 1
+        LOGGER.warning("Can not export traces to %s: %s", TRACE_EXPORT_PATH, e)
+
+
+def collect_stats_metrics() -> None:
+    for result, value in STATIC_STATS.items():
+        FRONTEND_REQUESTS.values[(result,)] = value
+    UPSTREAM_REQUESTS.values[()] = UPSTREAM_STATS["requests"]
+    UPSTREAM_CONNECTIONS.values[()] = UPSTREAM_STATS["connections_opened"]
+    for result, value in TOKEN_STATS.items():
+        TOKEN_CACHE_REQUESTS.values[(result,)] = value
+    TOKEN_CACHE_ENTRIES.set(value=len(TOKEN_CACHE))
+    for result, value in TOKEN_LIFECYCLE_STATS.items():
+        TOKEN_LIFECYCLE.values[(result,)] = value
+    collect_response_stats_metrics()
+    if WINDMILL_WORKERS_AUTOSCALE:
+        collect_workers_scaling_metrics()
+    for result in ("queued", "delivered", "failed", "dropped"):
+        WEBHOOK_EVENTS.values[(result,)] = WEBHOOK_STATS[result]
+    WEBHOOK_JOBS.values[()] = WEBHOOK_STATS["jobs"]
+    WEBHOOK_QUEUE_DEPTH.set(value=WEBHOOK_STATS["depth"])
+    for result in ("opened", "failed", "idle_closed"):
+        WEBSOCKET_CONNECTIONS.values[(result,)] = WEBSOCKET_STATS[result]
+    WEBSOCKET_ACTIVE.set(value=WEBSOCKET_STATS["active"])
+    for request_class, stats in ADMISSION.get_stats().items():
+        for result in ("admitted", "queued", "rejected"):
+            ADMISSION_REQUESTS.values[(request_class, result)] = stats[result]
+        ADMISSION_WAIT_SECONDS.values[(request_class,)] = stats["wait_time"]
+        ADMISSION_IN_FLIGHT.set(request_class, value=stats["in_flight"])
+        ADMISSION_QUEUE_DEPTH.set(request_class, value=stats["waiting"])
+    for call, stats in NEXTCLOUD_STATS.items():
+        NEXTCLOUD_CALLS.values[(call,)] = stats["calls"]
+        NEXTCLOUD_ERRORS.values[(call,)] = stats["errors"]
+        NEXTCLOUD_SECONDS.values[(call,)] = stats["time"]
+
+
+def collect_response_stats_metrics() -> None:
+    for result, value in RESPONSE_CACHE_STATS.items():
+        RESPONSE_CACHE_REQUESTS.values[(result,)] = value
+    RESPONSE_CACHE_BYTES.set(value=RESPONSE_CACHE.size)
+    for result in ("zstd", "br", "gzip", "over_budget", "throttled"):
+        COMPRESSION_RESPONSES.values[(result,)] = COMPRESSION_STATS[result]
+    COMPRESSION_BYTES.values[("in",)] = COMPRESSION_STATS["bytes_in"]
+    COMPRESSION_BYTES.values[("out",)] = COMPRESSION_STATS["bytes_out"]
+    COMPRESSION_CPU_SECONDS.values[()] = COMPRESSION_STATS["cpu_time"]
+
+
+def collect_workers_scaling_metrics() -> None:
+    WINDMILL_WORKERS.set(value=WORKERS_SCALING_STATE["workers"])
+    WINDMILL_QUEUE_LENGTH.set(value=WORKERS_SCALING_STATE["queued"])
+    WINDMILL_QUEUE_WAIT.set(value=WORKERS_SCALING_STATE["wait_time"])
+    WINDMILL_WORKERS_SCALING.values[("up",)] = WORKERS_SCALING_STATE["scaled_up"]
+    WINDMILL_WORKERS_SCALING.values[("down",)] = WORKERS_SCALING_STATE["scaled_down"]
+
+
+# Known Windmill resources used as route labels of metrics and traces, other paths are labeled `other`.
+WINDMILL_API_ROUTES = frozenset(
+    [
+        "apps",
+        "audit",
+        "auth",
+        "concurrency_groups",
+        "configs",
+        "flows",
+        "groups",
+        "hub",
+        "inputs",
+        "integrations",
+        "jobs",
+        "jobs_u",
+        "oauth",
+        "openapi",
+        "resources",
+        "saml",
+        "schedules",
+        "scripts",
+        "settings",
+        "srch",
+        "users",
+        "variables",
+        "version",
+        "w",
+        "workers",
+        "workspaces",
+    ]
+)
+WINDMILL_WORKSPACE_ROUTES = frozenset(
+    [
+        "acls",
+        "apps",
+        "apps_u",
+        "audit",
+        "capture",
+        "capture_u",
+        "concurrency_groups",
+        "drafts",
+        "embeddings",
+        "favorites",
+        "flow_workers",
+        "flows",
+        "folders",
+        "groups",
+        "http_triggers",
+        "inputs",
+        "job_metrics",
+        "jobs",
+        "jobs_u",
+        "oauth",
+        "raw_apps",
+        "resources",
+        "schedules",
+        "scripts",
+        "users",
+        "variables",
+        "websocket_triggers",
+        "workspaces",
+    ]
+)
+WINDMILL_WEBSOCKET_ROUTES = frozenset(("ws", "ws_debug", "ws_mp"))
+
+
+def get_proxy_route(url: str) -> str:
+    """Route label of the proxied URL from a fixed set of values, so clients can not add new metric series."""
+    segments = url.strip("/").split("/")
+    if segments[0] in WINDMILL_WEBSOCKET_ROUTES:
+        return segments[0]
+    if segments[0] != "api":
+        return "frontend"
+    if segments[1:2] == ["w"] and len(segments) > 3:  # /api/w/{workspace}/{resource}/...
+        return f"api/w/{segments[3]}" if segments[3] in WINDMILL_WORKSPACE_ROUTES else "api/w/other"
+    return f"api/{segments[1]}" if segments[1:2] and segments[1] in WINDMILL_API_ROUTES else "api/other"
 
 
 def get_user_email(user_name: str) -> str:
@@ -53,20 +1382,20 @@ def get_user_email(user_name: str) -> str:
     return f"{user_name}@windmill.dev"
 
 
-def add_user_to_storage(user_email: str, password: str, token: str = "") -> None:
-    USERS_STORAGE[user_email] = {"password": password, "token": token}
-    with open(USERS_STORAGE_PATH, "w", encoding="utf-8") as f:
-        json.dump(USERS_STORAGE, f, indent=4)
+async def add_user_to_storage(user_email: str, password: str, token: str = "", persistent: bool = False) -> None:
+    await asyncio.to_thread(USERS_STORAGE.set, user_email, password, token, persistent)
 
 
 async def create_user(user_name: str) -> str:
     LOGGER.info(user_name)
     password = generate_random_string()
     user_email = get_user_email(user_name)
-    async with httpx.AsyncClient() as client:
-        await client.request(
+    client = get_upstream_client()
+    start_time = perf_counter()
+    with trace_span("create_user"):
+        r = await client.request(
             method="POST",
-            url="http://127.0.0.1:8000/api/users/create",
+            url="/api/users/create",
             json={
                 "email": user_email,
                 "password": password,
@@ -75,100 +1404,273 @@ async def create_user(user_name: str) -> str:
             },
             cookies={"token": USERS_STORAGE["admin@windmill.dev"]["token"]},
         )
-        r = await client.post(
-            url="http://127.0.0.1:8000/api/auth/login",
-            json={"email": user_email, "password": password},
-        )
-        add_user_to_storage(user_email, password, r.text)
-    return r.text
+    PROVISION_DURATION.observe(perf_counter() - start_time, "create", str(r.status_code))
+    return await issue_user_token(user_email, password)
 
 
 async def login_user(user_email: str, password: str) -> str:
     LOGGER.debug(user_email)
-    async with httpx.AsyncClient() as client:
-        r = await client.post(
-            url="http://127.0.0.1:8000/api/auth/login",
+    start_time = perf_counter()
+    with trace_span("login"):
+        r = await get_upstream_client().post(
+            url="/api/auth/login",
             json={"email": user_email, "password": password},
         )
-        if r.status_code >= 400:
-            LOGGER.error("login_user(%s) error: %s", user_email, r.text)
-            raise RuntimeError(f"login_user: {r.text}")
-        return r.text
+    PROVISION_DURATION.observe(perf_counter() - start_time, "login", str(r.status_code))
+    if r.status_code >= 400:
+        LOGGER.error("login_user(%s) error: %s", user_email, r.text)
+        raise RuntimeError(f"login_user: {r.text}")
+    cache_token_state(r.text, True)
+    return r.text
 
 
-def login_user_sync(user_email: str, password: str) -> str:
-    LOGGER.debug(user_email)
-    with httpx.Client() as client:
-        r = client.post(
-            url="http://127.0.0.1:8000/api/auth/login",
-            json={"email": user_email, "password": password},
+async def create_persistent_token(token: str) -> str:
+    """Exchanges a session token for an API token that does not expire, returns an empty string on failure."""
+    start_time = perf_counter()
+    with trace_span("persistent_token"):
+        r = await get_upstream_client().post(
+            url="/api/users/tokens/create",
+            json={"label": "NC_PERSISTENT"},
+            cookies={"token": token},
         )
-        if r.status_code >= 400:
-            LOGGER.error("login_user(%s) error: %s", user_email, r.text)
-            raise RuntimeError(f"login_user: {r.text}")
-        return r.text
+    PROVISION_DURATION.observe(perf_counter() - start_time, "persistent_token", str(r.status_code))
+    if r.status_code >= 400:
+        LOGGER.warning("Can not create a persistent token: %s", r.text)
+        return ""
+    cache_token_state(r.text, True)
+    return r.text
 
 
-async def check_token(token: str) -> bool:
-    async with httpx.AsyncClient() as client:
-        r = await client.get("http://127.0.0.1:8000/api/users/whoami", cookies={"token": token})
-        return bool(r.status_code < 400)
+async def issue_user_token(user_email: str, password: str) -> str:
+    """Logs the user in and stores a persistent token, or the session token if Windmill did not create one."""
+    token = await login_user(user_email, password)
+    persistent_token = await create_persistent_token(token)
+    await add_user_to_storage(user_email, password, persistent_token or token, bool(persistent_token))
+    return persistent_token or token
 
 
-def check_token_sync(token: str) -> bool:
-    with httpx.Client() as client:
-        r = client.get("http://127.0.0.1:8000/api/users/whoami", cookies={"token": token})
-        return bool(r.status_code < 400)
+def note_user_activity(user_email: str) -> None:
+    """Remembers when the user was last active, tokens of active users are renewed in the background."""
+    now = monotonic()
+    if now - USERS_ACTIVITY.get(user_email, float("-inf")) < TOKEN_ACTIVITY_RESOLUTION:
+        return
+    USERS_ACTIVITY[user_email] = now
+    _t = asyncio.get_running_loop().run_in_executor(None, USERS_STORAGE.mark_used, user_email)  # noqa
 
 
-def get_valid_user_token_sync(user_email: str) -> str:
+async def check_token(token: str) -> bool:
+    if not token:
+        return False
+    valid = TOKEN_CACHE.get(token)
+    if valid is not None:
+        TOKEN_STATS["hits"] += 1
+        return valid
+    # Parallel checks of the same token share one `whoami` request, which is not cancelled with the caller.
+    task = TOKEN_CHECKS_IN_FLIGHT.get(token)
+    if task is None:
+        TOKEN_STATS["misses"] += 1
+        task = asyncio.create_task(_check_token(token))
+        TOKEN_CHECKS_IN_FLIGHT[token] = task
+        task.add_done_callback(lambda _: TOKEN_CHECKS_IN_FLIGHT.pop(token, None))
+    return await asyncio.shield(task)
+
+
+async def _check_token(token: str) -> bool:
+    start_time = perf_counter()
+    with trace_span("whoami"):
+        r = await get_upstream_client().get("/api/users/whoami", cookies={"token": token})
+    PROVISION_DURATION.observe(perf_counter() - start_time, "whoami", str(r.status_code))
+    valid = bool(r.status_code < 400)
+    cache_token_state(token, valid)
+    return valid
+
+
+async def get_valid_user_token(user_email: str) -> str:
+    note_user_activity(user_email)
     token = USERS_STORAGE[user_email]["token"]
-    if check_token_sync(token):
+    if await check_token(token):
         return token
-    user_password = USERS_STORAGE[user_email]["password"]
-    token = login_user_sync(user_email, user_password)
-    add_user_to_storage(user_email, user_password, token)
-    return token
+    TOKEN_LIFECYCLE_STATS["request_logins"] += 1
+    return await issue_user_token(user_email, USERS_STORAGE[user_email]["password"])
+
+
+async def has_valid_token(user_email: str) -> bool:
+    return user_email in USERS_STORAGE and await check_token(USERS_STORAGE[user_email]["token"])
 
 
-async def provision_user(request: Request, create_missing_user: bool) -> None:
+async def provision_user(request: HTTPConnection, create_missing_user: bool) -> None:
     if "token" in request.cookies:
-        LOGGER.debug("Token is present: %s", request.cookies["token"])
         if (await check_token(request.cookies["token"])) is True:
             return
-        LOGGER.debug("Token is invalid: %s", request.cookies["token"])
+        LOGGER.debug("Token of the request is invalid")
 
     user_name = get_windmill_username_from_request(request)
     if not user_name:
-        LOGGER.debug("`username` is missing in the request to ExApp. Headers: %s", request.headers)
+        LOGGER.debug("`username` is missing in the request to ExApp")
         return
+    if not await ensure_windmill_user(user_name, create_missing_user):
+        return
+    request.cookies["token"] = USERS_STORAGE[get_user_email(user_name)]["token"]
+
+
+async def ensure_windmill_user(user_name: str, create_missing_user: bool) -> bool:
+    """Makes sure that the Windmill account of the user exists and has a valid token, returns False if it does not."""
     user_email = get_user_email(user_name)
-    if user_email in USERS_STORAGE:
-        windmill_token_valid = await check_token(USERS_STORAGE[user_email]["token"])
-        if not USERS_STORAGE[user_email]["token"] or windmill_token_valid is False:
-            if not create_missing_user:
-                LOGGER.debug("Do not creating user due to specified flag.")
-                return
-            user_password = USERS_STORAGE[user_email]["password"]
-            add_user_to_storage(user_email, user_password, await login_user(user_email, user_password))
-    else:
-        await create_user(user_name)
-    request.cookies["token"] = USERS_STORAGE[user_email]["token"]
-    LOGGER.debug("Adding token(%s) to request", request.cookies["token"])
+    # Parallel requests of one user wait here, so only the first one talks to Windmill, others use its result.
+    async with USER_LOCKS[user_email]:
+        if not await has_valid_token(user_email):
+            # Another worker process could be provisioning the same user, or could have done it already.
+            async with workers_lock(get_user_lock_name(user_email)):
+                if EXAPP_WORKERS > 1:
+                    await asyncio.to_thread(USERS_STORAGE.reload, user_email)
+                if user_email in USERS_STORAGE:
+                    if not await has_valid_token(user_email):
+                        if not create_missing_user:
+                            LOGGER.debug("Do not creating user due to specified flag.")
+                            return False
+                        TOKEN_LIFECYCLE_STATS["request_logins"] += 1
+                        await issue_user_token(user_email, USERS_STORAGE[user_email]["password"])
+                else:
+                    await create_user(user_name)
+    note_user_activity(user_email)
+    return True
+
+
+def get_user_lock_name(user_email: str) -> str:
+    return f"user_{hashlib.blake2b(user_email.encode(), digest_size=8).hexdigest()}"
+
+
+def build_static_assets_index(root: Path) -> dict[str, StaticAsset]:
+    if not root.is_dir():
+        LOGGER.warning("Frontend directory %s is missing, all requests will be routed to Windmill", root)
+        return {}
+    files = {i.relative_to(root).as_posix(): i for i in root.rglob("*") if i.is_file()}
+    assets = {}
+    for rel_path, file_path in files.items():
+        if rel_path.endswith((".br", ".gz")) and rel_path[:-3] in files:
+            continue  # precompressed variant of another file
+        file_hash = hashlib.blake2b(digest_size=16)
+        with open(file_path, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                file_hash.update(chunk)
+        content_type = mimetypes.guess_type(rel_path)[0] or "application/octet-stream"
+        encodings = {}
+        if f"{rel_path}.br" in files:
+            encodings["br"] = files[f"{rel_path}.br"]
+        if f"{rel_path}.gz" in files:
+            encodings["gzip"] = files[f"{rel_path}.gz"]
+        assets[rel_path] = StaticAsset(
+            path=file_path,
+            size=file_path.stat().st_size,
+            etag=file_hash.hexdigest(),
+            content_type=content_type,
+            immutable=rel_path.startswith("_app/immutable/"),
+            encodings=encodings,
+        )
+    if STATIC_PRECOMPRESS:
+        with FileLock(LOCKS_PATH.joinpath("static_cache.lock")):  # all workers share the cache folder
+            _precompress_static_assets(assets)
+    LOGGER.info("Indexed %d frontend files", len(assets))
+    return assets
+
+
+async def load_static_assets_index() -> None:
+    """Indexes the frontend in the background, so hashing and precompressing it does not delay the start."""
+    try:
+        STATIC_ASSETS.update(await asyncio.to_thread(build_static_assets_index, STATIC_FRONTEND_PATH))
+    except Exception:
+        LOGGER.exception("Can not index frontend files, they will be served without the index")
+
+
+def get_unindexed_static_file(path: str) -> Path | None:
+    """Looks up a frontend file on the disk, used until the index of the frontend is ready."""
+    file_path = STATIC_FRONTEND_PATH.joinpath(path)
+    if ".." in Path(path).parts or not file_path.is_file():
+        return None
+    return file_path
+
+
+def _precompress_static_assets(assets: dict[str, StaticAsset]) -> None:
+    STATIC_CACHE_PATH.mkdir(exist_ok=True)
+    used_files = set()
+    for rel_path, asset in assets.items():
+        if (
+            "gzip" in asset.encodings
+            or asset.size < STATIC_PRECOMPRESS_MIN_SIZE
+            or not asset.content_type.startswith(STATIC_COMPRESSIBLE_TYPES)
+        ):
+            continue
+        gz_path = STATIC_CACHE_PATH.joinpath(f"{asset.etag}.gz")
+        if not gz_path.exists():
+            tmp_path = gz_path.with_suffix(".tmp")
+            tmp_path.write_bytes(gzip.compress(asset.path.read_bytes(), compresslevel=9, mtime=0))
+            tmp_path.replace(gz_path)
+        if gz_path.stat().st_size < asset.size:
+            asset.encodings["gzip"] = gz_path
+        used_files.add(gz_path.name)
+        LOGGER.debug("Precompressed %s", rel_path)
+    for i in STATIC_CACHE_PATH.iterdir():  # files from previous versions of the frontend
+        if i.name not in used_files:
+            i.unlink(missing_ok=True)
+
+
+def _accepted_encodings(accept_encoding: str) -> set[str]:
+    accepted = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+def serve_static_asset(request: Request, asset: StaticAsset) -> Response:
+    headers = {
+        "cache-control": "public, max-age=31536000, immutable" if asset.immutable else "no-cache",
+        "vary": "accept-encoding",
+    }
+    file_path = asset.path
+    etag = asset.etag
+    accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+    for encoding in ("br", "gzip"):
+        if encoding in asset.encodings and encoding in accepted:
+            file_path = asset.encodings[encoding]
+            etag = f"{asset.etag}-{encoding}"
+            headers["content-encoding"] = encoding
+            break
+    headers["etag"] = f'"{etag}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match and (
+        if_none_match.strip() == "*"
+        or headers["etag"] in [i.strip().removeprefix("W/") for i in if_none_match.split(",")]
+    ):
+        STATIC_STATS["not_modified"] += 1
+        headers.pop("content-encoding", None)
+        return Response(status_code=304, headers=headers)
+    STATIC_STATS["hits"] += 1
+    return FileResponse(file_path, headers=headers, media_type=asset.content_type)
 
 
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
     setup_nextcloud_logging("flow", logging_level=logging.WARNING)
-    _t = asyncio.create_task(start_background_webhooks_syncing())  # noqa
+    create_upstream_client()
+    _s = asyncio.create_task(load_static_assets_index())  # noqa
+    _t = asyncio.create_task(start_background_tasks())  # noqa
+    if EXAPP_WORKERS > 1:
+        _u = asyncio.create_task(start_background_users_syncing())  # noqa
     yield
+    await drain_webhook_queue(10)
+    await stop_windmill_workers()
+    await close_upstream_client()
 
 
 APP = FastAPI(lifespan=lifespan)
-APP.add_middleware(AppAPIAuthMiddleware)  # noqa
+APP.add_middleware(AppAPIAuthMiddleware, disable_for=["metrics"] if METRICS_PUBLIC else [])  # noqa
+APP.add_middleware(TracingMiddleware)  # noqa
 
 
-def get_windmill_username_from_request(request: Request) -> str:
+def get_windmill_username_from_request(request: HTTPConnection) -> str:
     auth_aa = b64decode(request.headers.get("AUTHORIZATION-APP-API", "")).decode("UTF-8")
     try:
         username, _ = auth_aa.split(":", maxsplit=1)
@@ -176,7 +1678,11 @@ def get_windmill_username_from_request(request: Request) -> str:
         username = ""
     if not username:
         return ""
-    return "wapp_" + username
+    return get_windmill_username(username)
+
+
+def get_windmill_username(nextcloud_user_id: str) -> str:
+    return "wapp_" + nextcloud_user_id
 
 
 def enabled_handler(enabled: bool, nc: NextcloudApp) -> str:
@@ -189,130 +1695,818 @@ def enabled_handler(enabled: bool, nc: NextcloudApp) -> str:
         nc.ui.resources.delete_script("top_menu", "flow", "ex_app/js/flow-main")
         nc.ui.top_menu.unregister("flow")
         nc.webhooks.unregister_all()
+    NEXTCLOUD_ENABLED_STATE["value"] = enabled
+    NEXTCLOUD_ENABLED_STATE["time"] = monotonic()
     return ""
 
 
 @APP.get("/heartbeat")
 async def heartbeat_callback():
-    return responses.JSONResponse(content={"status": "ok"})
+    # AppAPI waits for the "ok" status before it finishes the deployment and sends requests to the ExApp.
+    return responses.JSONResponse(
+        content={
+            "status": "ok" if STARTUP_STATE["stage"] == "ready" else "waiting",
+            "stage": STARTUP_STATE["stage"],
+            "error": STARTUP_STATE["error"],
+            "phases": STARTUP_STATE["phases"],
+        }
+    )
+
+
+@APP.get("/metrics")
+async def metrics_callback():
+    collect_stats_metrics()
+    return responses.PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@APP.get("/exapp/stats")
+async def stats_callback():
+    return responses.JSONResponse(
+        content={
+            "upstream": get_upstream_stats(),
+            "tokens": get_token_cache_stats(),
+            "response_cache": get_response_cache_stats(),
+            "compression": get_compression_stats(),
+            "traces": TRACE_STATS,
+            "static": STATIC_STATS,
+            "nextcloud": NEXTCLOUD_STATS,
+            "startup": STARTUP_STATE,
+            "webhook_queue": WEBHOOK_STATS,
+            "websockets": WEBSOCKET_STATS,
+            "admission": ADMISSION.get_stats(),
+            "preprovision": PREPROVISION_STATE,
+            "windmill_workers": get_workers_scaling_stats(),
+            "worker": {"pid": os.getpid(), "webhooks_sync_leader": WEBHOOKS_SYNC_STATE["leader"]},
+        }
+    )
+
+
+@APP.get("/exapp/traces")
+async def traces_callback(slow: bool = False, limit: int = 50):
+    traces = list(SLOW_TRACES if slow else TRACES)[-limit:]
+    return responses.JSONResponse(
+        content={
+            "stats": TRACE_STATS,
+            "slow_threshold": TRACE_SLOW_THRESHOLD,
+            "traces": [i.to_dict() for i in reversed(traces)],
+        }
+    )
+
+
+@APP.get("/exapp/webhooks/plan")
+async def webhooks_plan_callback():
+    return responses.JSONResponse(content=await plan_webhooks_sync("nextcloud"))
+
+
+@APP.post("/exapp/users/preprovision")
+async def preprovision_callback(b_tasks: BackgroundTasks):
+    b_tasks.add_task(preprovision_users)
+    return responses.JSONResponse(content=PREPROVISION_STATE)
 
 
 @APP.post("/init")
 async def init_callback(b_tasks: BackgroundTasks, nc: typing.Annotated[NextcloudApp, Depends(nc_app)]):
-    b_tasks.add_task(fetch_models_task, nc, {}, 0)
+    if PREPROVISION_USERS:
+        b_tasks.add_task(init_task)
+    else:
+        b_tasks.add_task(fetch_models_task, nc, {}, 0)
     return responses.JSONResponse(content={})
 
 
+async def init_task() -> None:
+    """Pre-provisions users, reporting the progress like ``fetch_models_task``. AppAPI enables the ExApp at 100%."""
+    nc = get_nextcloud_client()
+    await preprovision_users(nc.set_init_status)
+    await nc.set_init_status(100)
+
+
 @APP.put("/enabled")
-def enabled_callback(enabled: bool, nc: typing.Annotated[NextcloudApp, Depends(nc_app)]):
-    return responses.JSONResponse(content={"error": enabled_handler(enabled, nc)})
+async def enabled_callback(enabled: bool, nc: typing.Annotated[NextcloudApp, Depends(nc_app)]):
+    error = await asyncio.to_thread(enabled_handler, enabled, nc)
+    if enabled:
+        # Listeners were removed when the ExApp was disabled, the worker running the sync could not see that.
+        request_webhooks_sync(WEBHOOKS_SYNC_FORCE)
+    return responses.JSONResponse(content={"error": error})
+
+
+def _get_proxy_response_headers(response: httpx.Response) -> dict:
+    response_header = dict(response.headers)
+    response_header.pop("transfer-encoding", None)
+    return response_header
+
+
+class UpstreamStreamingResponse(StreamingResponse):
+    """Streams the body of a Windmill response and returns its connection to the pool when the response ends.
+
+    The upstream response is closed here and not in the body iterator, which is never started if sending
+    the response headers fails because the client is already gone.
+    """
+
+    def __init__(self, upstream: httpx.Response, head: bytes = b"", chunks=None, **kwargs):
+        super().__init__(_iter_upstream_response(upstream, head, chunks), **kwargs)
+        self.upstream = upstream
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.upstream.aclose()
+
+
+async def _iter_upstream_response(
+    response: httpx.Response, head: bytes = b"", chunks=None
+) -> typing.AsyncIterator[bytes]:
+    if head:
+        yield head
+    async for chunk in chunks or response.aiter_raw():
+        yield chunk
+
+
+def compress_proxied_response(request: Request, response: Response) -> Response:
+    """Compresses a response that Windmill sent uncompressed with the best encoding accepted by the client."""
+    headers = response.headers
+    if (
+        request.method == "HEAD"
+        or response.status_code in (204, 206, 304)
+        or "content-encoding" in headers
+        or "no-transform" in headers.get("cache-control", "")
+        or not headers.get("content-type", "").startswith(STATIC_COMPRESSIBLE_TYPES)
+        or headers.get("content-type", "").startswith("text/event-stream")  # events must not wait in the compressor
+        or int(headers.get("content-length", PROXY_COMPRESSION_MIN_SIZE)) < PROXY_COMPRESSION_MIN_SIZE
+    ):
+        return response
+    accepted = _accepted_encodings(request.headers.get("accept-encoding", ""))
+    encoding = next((i for i in PROXY_COMPRESSION_ENCODINGS if i in accepted), None)
+    if encoding is None:
+        return response
+    if not has_compression_budget():
+        COMPRESSION_STATS["over_budget"] += 1
+        return response
+    COMPRESSION_STATS[encoding] += 1
+    headers["content-encoding"] = encoding
+    headers["vary"] = f"{headers['vary']}, accept-encoding" if "vary" in headers else "accept-encoding"
+    if headers.get("etag", "").startswith('"'):
+        headers["etag"] = "W/" + headers["etag"]  # the compressed body is not byte-identical to the upstream one
+    if isinstance(response, StreamingResponse):
+        if "content-length" in headers:
+            del headers["content-length"]
+        response.body_iterator = _iter_compressed(response.body_iterator, encoding)
+    else:
+        compress, _, finish = create_compressor(encoding)
+        response.body = _run_compressor(compress, response.body) + _run_compressor(finish)
+        headers["content-length"] = str(len(response.body))
+    return response
+
+
+def create_compressor(
+    encoding: str,
+) -> tuple[typing.Callable[[bytes], bytes], typing.Callable[[], bytes], typing.Callable[[], bytes]]:
+    """Returns functions compressing the next chunk, flushing what was compressed so far and finishing the stream."""
+    if encoding == "zstd":
+        compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        return compressor.compress, lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), compressor.flush
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=4)
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(5, zlib.DEFLATED, 31)  # 31: gzip container
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def has_compression_budget() -> bool:
+    now = monotonic()
+    if now - COMPRESSION_BUDGET["window_start"] >= 1:
+        COMPRESSION_BUDGET.update({"window_start": now, "used": 0.0})
+    return COMPRESSION_BUDGET["used"] < PROXY_COMPRESSION_CPU_BUDGET
+
+
+def _run_compressor(func: typing.Callable, *chunk: bytes) -> bytes:
+    start_time = time.thread_time()
+    data = func(*chunk)
+    cpu_time = time.thread_time() - start_time
+    COMPRESSION_BUDGET["used"] += cpu_time
+    COMPRESSION_STATS["cpu_time"] += cpu_time
+    COMPRESSION_STATS["bytes_in"] += len(chunk[0]) if chunk else 0
+    COMPRESSION_STATS["bytes_out"] += len(data)
+    return data
+
+
+async def _iter_compressed(chunks: typing.AsyncIterator[bytes], encoding: str) -> typing.AsyncIterator[bytes]:
+    compress, flush, finish = create_compressor(encoding)
+    try:
+        async for chunk in chunks:
+            # The encoding can not change once the headers are sent, so over the budget the stream is slowed down.
+            if not has_compression_budget():
+                COMPRESSION_STATS["throttled"] += 1
+            while not has_compression_budget():
+                await asyncio.sleep(max(COMPRESSION_BUDGET["window_start"] + 1 - monotonic(), 0.01))
+            # Each chunk is flushed, so it reaches the client as soon as Windmill sends it (long polling, job logs).
+            if data := _run_compressor(compress, chunk) + _run_compressor(flush):
+                yield data
+        yield _run_compressor(finish)
+    finally:
+        if hasattr(chunks, "aclose"):
+            await chunks.aclose()
+
+
+def get_compression_stats() -> dict:
+    ratio = COMPRESSION_STATS["bytes_out"] / COMPRESSION_STATS["bytes_in"] if COMPRESSION_STATS["bytes_in"] else None
+    return {**COMPRESSION_STATS, "ratio": ratio, "encodings": PROXY_COMPRESSION_ENCODINGS}
 
 
 async def proxy_request_to_windmill(request: Request, path: str, path_prefix: str = ""):
-    async with httpx.AsyncClient() as client:
-        url = f"http://127.0.0.1:8000{path_prefix}/{path}"
-        headers = {key: value for key, value in request.headers.items() if key.lower() not in ("host", "cookie")}
-        if request.method == "GET":
-            response = await client.get(
-                url,
-                params=request.query_params,
-                cookies=request.cookies,
-                headers=headers,
+    url = f"{path_prefix}/{path}"
+    start_time = perf_counter()
+    status = "error"
+    try:
+        try:
+            if cache_key := get_response_cache_key(request, url):
+                response = await proxy_cached_request_to_windmill(request, url, cache_key)
+            else:
+                # The slot is held until response headers arrive, long streamed responses do not block other requests.
+                async with ADMISSION.admit(get_request_class(request, url), get_request_user(request)):
+                    response = await _proxy_request_to_windmill(request, url)
+        except AdmissionRejectedError as e:
+            response = responses.JSONResponse(
+                content={"error": e.reason}, status_code=e.status_code, headers={"retry-after": "5"}
             )
+        status = str(response.status_code)
+        if request.method not in ("GET", "HEAD") and response.status_code < 400 and RESPONSE_CACHE_SIZE > 0:
+            await invalidate_cached_responses(url)
+        if PROXY_COMPRESSION_ENCODINGS:
+            response = compress_proxied_response(request, response)
+        return response
+    finally:
+        PROXY_DURATION.observe(perf_counter() - start_time, get_proxy_route(url), status)
+
+
+def get_response_cache_key(request: Request, url: str) -> str:
+    """Returns an empty string if the response should not be cached."""
+    if RESPONSE_CACHE_SIZE <= 0 or request.method != "GET":
+        return ""
+    for name, rule in RESPONSE_CACHE_RULES.items():
+        if not rule.path_re.match(url):
+            continue
+        key = [name, url, str(request.query_params)]
+        key += [request.headers.get("accept-encoding", ""), request.headers.get("origin", "")]
+        if rule.per_user:
+            user_token = request.cookies.get("token") or request.headers.get("authorization", "")
+            if not user_token:
+                return ""
+            key.append(user_token)
+        return "\n".join(key)
+    return ""
+
+
+def get_response_cache_ttl(rule: ResponseCacheRule, response: httpx.Response) -> float | None:
+    """TTL of the rule limited by the upstream ``cache-control``, ``None`` if the response must not be cached."""
+    if "set-cookie" in response.headers:
+        return None
+    vary = {i.strip().lower() for i in response.headers.get("vary", "").split(",") if i.strip()}
+    if not vary <= {"accept-encoding", "origin"}:  # both are parts of the cache key
+        return None
+    ttl = rule.ttl
+    for directive in response.headers.get("cache-control", "").lower().split(","):
+        name, _, value = directive.strip().partition("=")
+        if name in ("no-store", "no-cache") or (name == "private" and not rule.per_user):
+            return None
+        if name == "max-age":
+            try:
+                ttl = min(ttl, max(float(value.strip('"')), 0.0))
+            except ValueError:
+                return None
+    return ttl
+
+
+async def invalidate_cached_responses(url: str) -> None:
+    rules = [
+        name
+        for name, rule in RESPONSE_CACHE_RULES.items()
+        if rule.invalidated_by is not None and rule.invalidated_by.match(url)
+    ]
+    for name in rules:
+        RESPONSE_CACHE_STATS["invalidated"] += RESPONSE_CACHE.invalidate(name)
+    if rules and EXAPP_WORKERS > 1:
+        RESPONSE_CACHE_SYNC["generations"].update(await asyncio.to_thread(RESPONSE_CACHE_GENERATIONS.bump, rules))
+
+
+async def sync_response_cache_invalidations() -> None:
+    """Drops cached responses of the rules invalidated by other worker processes."""
+    if EXAPP_WORKERS == 1 or monotonic() - RESPONSE_CACHE_SYNC["checked"] < RESPONSE_CACHE_SYNC_INTERVAL:
+        return
+    RESPONSE_CACHE_SYNC["checked"] = monotonic()
+    generations = await asyncio.to_thread(RESPONSE_CACHE_GENERATIONS.get_all)
+    for name, generation in generations.items():
+        if RESPONSE_CACHE_SYNC["generations"].get(name) != generation:
+            RESPONSE_CACHE_STATS["invalidated"] += RESPONSE_CACHE.invalidate(name)
+    RESPONSE_CACHE_SYNC["generations"].update(generations)
+
+
+def get_cached_response(request: Request, entry: CachedResponse) -> Response:
+    headers = {**entry.headers, "age": str(int(monotonic() - entry.stored))}
+    if_none_match = request.headers.get("if-none-match", "")
+    if entry.etag and entry.etag.removeprefix("W/") in [i.strip().removeprefix("W/") for i in if_none_match.split(",")]:
+        RESPONSE_CACHE_STATS["not_modified"] += 1
+        for i in ("content-length", "content-encoding", "content-type"):
+            headers.pop(i, None)
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, status_code=entry.status_code, headers=headers)
+
+
+async def _read_upstream_body(
+    response: httpx.Response, chunks: typing.AsyncIterator[bytes], limit: int
+) -> tuple[bytes, bool]:
+    """Reads the body up to ``limit`` bytes, the response is closed unless the rest of the body is left to stream."""
+    body = b""
+    try:
+        async for chunk in chunks:
+            body += chunk
+            if len(body) > limit:
+                return body, False
+    except BaseException:
+        await response.aclose()
+        raise
+    await response.aclose()
+    return body, True
+
+
+async def proxy_cached_request_to_windmill(request: Request, url: str, cache_key: str) -> Response:
+    """Answers from the response cache, expired entries are revalidated with their ETag."""
+    await sync_response_cache_invalidations()
+    entry = RESPONSE_CACHE.get(cache_key)
+    if entry is not None and entry.expires > monotonic():
+        RESPONSE_CACHE_STATS["hits"] += 1
+        with trace_span("response_cache"):
+            return get_cached_response(request, entry)
+    client = get_upstream_client()
+    headers = {key: value for key, value in request.headers.items() if key.lower() not in ("host", "cookie")}
+    if entry is not None:
+        headers["if-none-match"] = entry.etag
+    upstream_request = client.build_request(
+        method="GET", url=url, params=request.query_params, headers=headers, cookies=request.cookies
+    )
+    async with ADMISSION.admit(get_request_class(request, url), get_request_user(request)):
+        with trace_span("upstream"):
+            response = await client.send(upstream_request, stream=True)
+    LOGGER.debug("GET %s -> %s (response cache miss)", url, response.status_code)
+    rule_name = cache_key.partition("\n")[0]
+    ttl = get_response_cache_ttl(RESPONSE_CACHE_RULES[rule_name], response)
+    if response.status_code == 304 and entry is not None:
+        await response.aclose()
+        RESPONSE_CACHE_STATS["revalidated"] += 1
+        if ttl is None:
+            RESPONSE_CACHE.pop(cache_key)
         else:
-            response = await client.request(
-                method=request.method,
-                url=url,
-                params=request.query_params,
-                headers=headers,
-                cookies=request.cookies,
-                content=await request.body(),
-            )
-        LOGGER.debug("%s %s/%s -> %s", request.method, path_prefix, path, response.status_code)
-        response_header = dict(response.headers)
-        response_header.pop("transfer-encoding", None)
-        return Response(content=response.content, status_code=response.status_code, headers=response_header)
+            RESPONSE_CACHE.set(cache_key, entry._replace(stored=monotonic(), expires=monotonic() + ttl))
+        return get_cached_response(request, entry)
+    RESPONSE_CACHE_STATS["misses"] += 1
+    if response.status_code == 401 and "token" in request.cookies:
+        invalidate_token(request.cookies["token"])
+    response_headers = _get_proxy_response_headers(response)
+    if response.status_code != 200 or ttl is None:
+        RESPONSE_CACHE.pop(cache_key)
+        return UpstreamStreamingResponse(response, status_code=response.status_code, headers=response_headers)
+    chunks = response.aiter_raw()
+    body, complete = await _read_upstream_body(response, chunks, RESPONSE_CACHE_MAX_ENTRY_SIZE)
+    if not complete:
+        return UpstreamStreamingResponse(response, body, chunks, status_code=200, headers=response_headers)
+    etag = response.headers.get("etag", "")
+    if ttl > 0 or etag:
+        RESPONSE_CACHE.set(
+            cache_key, CachedResponse(rule_name, monotonic(), monotonic() + ttl, 200, response_headers, body, etag)
+        )
+    return Response(content=body, status_code=200, headers=response_headers)
+
+
+def get_request_class(request: Request, url: str) -> str:
+    if HEAVY_PATH_RE.match(url):
+        return "heavy"
+    if JOBS_PATH_RE.match(url.removeprefix("/api/")) and request.headers.get("authorization", "").startswith("Bearer "):
+        return "jobs"
+    return "interactive"
+
+
+def get_request_user(request: Request) -> str:
+    if user_name := get_windmill_username_from_request(request):
+        return user_name
+    if authorization := request.headers.get("authorization", ""):
+        return hashlib.blake2b(authorization.encode(), digest_size=8).hexdigest()
+    return ""
+
+
+async def _proxy_request_to_windmill(request: Request, url: str) -> Response:
+    client = get_upstream_client()
+    headers = {key: value for key, value in request.headers.items() if key.lower() not in ("host", "cookie")}
+    if not PROXY_STREAMING:
+        return await _proxy_request_to_windmill_buffered(request, url, headers)
+
+    upstream_request = client.build_request(
+        method=request.method,
+        url=url,
+        params=request.query_params,
+        headers=headers,
+        cookies=request.cookies,
+        content=None if request.method in ("GET", "HEAD") else request.stream(),
+        # Live job logs and other SSE endpoints can be silent for a long time, they should not hit the read timeout.
+        timeout=(
+            httpx.Timeout(UPSTREAM_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT, read=None)
+            if "text/event-stream" in request.headers.get("accept", "")
+            else httpx.USE_CLIENT_DEFAULT
+        ),
+    )
+    with trace_span("upstream"):
+        response = await client.send(upstream_request, stream=True)
+    LOGGER.debug("%s %s -> %s", request.method, url, response.status_code)
+    if response.status_code == 401 and "token" in request.cookies:
+        invalidate_token(request.cookies["token"])
+    # Raw bytes are passed through as is, so the upstream `content-encoding` and `content-length` stay valid.
+    return UpstreamStreamingResponse(
+        response, status_code=response.status_code, headers=_get_proxy_response_headers(response)
+    )
+
+
+async def _proxy_request_to_windmill_buffered(request: Request, url: str, headers: dict) -> Response:
+    client = get_upstream_client()
+    if request.method == "GET":
+        response = await client.get(
+            url,
+            params=request.query_params,
+            cookies=request.cookies,
+            headers=headers,
+        )
+    else:
+        response = await client.request(
+            method=request.method,
+            url=url,
+            params=request.query_params,
+            headers=headers,
+            cookies=request.cookies,
+            content=await request.body(),
+        )
+    LOGGER.debug("%s %s -> %s", request.method, url, response.status_code)
+    if response.status_code == 401 and "token" in request.cookies:
+        invalidate_token(request.cookies["token"])
+    return Response(
+        content=response.content, status_code=response.status_code, headers=_get_proxy_response_headers(response)
+    )
+
+
+def is_webhook_delivery(request: Request, path: str) -> bool:
+    """Nextcloud delivers webhooks with the token they were registered with (see `register_listener`)."""
+    return (
+        WEBHOOK_QUEUE_SIZE > 0
+        and request.method == "POST"
+        and WEBHOOK_PATH_RE.match(path) is not None
+        and DEFAULT_USER_EMAIL in USERS_STORAGE
+        and request.headers.get("authorization", "") == f"Bearer {USERS_STORAGE[DEFAULT_USER_EMAIL]['token']}"
+    )
+
+
+async def queue_webhook_delivery(request: Request, path: str) -> Response:
+    body = await request.body()
+    try:
+        if WEBHOOK_QUEUE_SLOTS.locked():
+            await asyncio.wait_for(WEBHOOK_QUEUE_SLOTS.acquire(), WEBHOOK_QUEUE_TIMEOUT)
+        else:
+            await WEBHOOK_QUEUE_SLOTS.acquire()
+    except asyncio.TimeoutError:
+        WEBHOOK_STATS["dropped"] += 1
+        LOGGER.warning("Webhook queue is full, rejecting delivery to %s", path)
+        return responses.JSONResponse(content={"error": "Queue is full"}, status_code=503, headers={"retry-after": "5"})
+    event = WebhookEvent(
+        url=f"/api/{path}",
+        query=str(request.query_params),
+        authorization=request.headers["authorization"],
+        content_type=request.headers.get("content-type", "application/json"),
+        body=body,
+    )
+    WEBHOOK_STATS["queued"] += 1
+    WEBHOOK_STATS["depth"] += 1
+    start_webhook_queue_workers()
+    if WEBHOOK_BATCH_WINDOW <= 0:
+        WEBHOOK_QUEUE.put_nowait([event])
+    elif event.url in WEBHOOK_BATCHES:
+        WEBHOOK_BATCHES[event.url].append(event)
+        if len(WEBHOOK_BATCHES[event.url]) >= WEBHOOK_BATCH_SIZE:
+            flush_webhook_batch(event.url)
+    else:
+        WEBHOOK_BATCHES[event.url] = [event]
+        asyncio.get_running_loop().call_later(WEBHOOK_BATCH_WINDOW, flush_webhook_batch, event.url)
+    return responses.JSONResponse(content={"queued": True}, status_code=202)
+
+
+def flush_webhook_batch(url: str) -> None:
+    if batch := WEBHOOK_BATCHES.pop(url, None):
+        WEBHOOK_QUEUE.put_nowait(batch)
+
+
+def start_webhook_queue_workers() -> None:
+    if not WEBHOOK_QUEUE_TASKS:
+        WEBHOOK_QUEUE_TASKS.extend(asyncio.create_task(webhook_queue_worker()) for _ in range(WEBHOOK_QUEUE_WORKERS))
+
+
+async def webhook_queue_worker() -> None:
+    while True:
+        batch = await WEBHOOK_QUEUE.get()
+        try:
+            delivered = await deliver_webhook_events(batch)
+        except Exception:  # noqa
+            LOGGER.exception("Can not deliver webhook events to %s", batch[0].url)
+            delivered = False
+        WEBHOOK_STATS["delivered" if delivered else "failed"] += len(batch)
+        WEBHOOK_STATS["depth"] -= len(batch)
+        for _ in batch:
+            WEBHOOK_QUEUE_SLOTS.release()
+        WEBHOOK_QUEUE.task_done()
+
+
+async def drain_webhook_queue(timeout: float) -> None:
+    for url in list(WEBHOOK_BATCHES):
+        flush_webhook_batch(url)
+    try:
+        await asyncio.wait_for(WEBHOOK_QUEUE.join(), timeout)
+    except asyncio.TimeoutError:
+        LOGGER.warning("%d webhook events were not delivered before the shutdown", WEBHOOK_STATS["depth"])
+
+
+async def deliver_webhook_events(batch: list[WebhookEvent]) -> bool:
+    """Starts one Windmill job for the events, retrying if Windmill is unavailable."""
+    event = batch[0]
+    if len(batch) == 1:
+        content = event.body
+    else:
+        content = json.dumps({"events": [json.loads(i.body or b"null") for i in batch]}).encode()
+    for attempt in range(WEBHOOK_DELIVERY_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+        try:
+            async with ADMISSION.admit("jobs", ""):
+                response = await get_upstream_client().post(
+                    event.url,
+                    params=event.query,
+                    headers={"authorization": event.authorization, "content-type": event.content_type},
+                    content=content,
+                )
+        except (httpx.TransportError, AdmissionRejectedError) as e:
+            LOGGER.warning("Can not deliver webhook events to %s (attempt %d): %s", event.url, attempt + 1, e)
+            continue
+        LOGGER.debug("POST %s (%d events) -> %s", event.url, len(batch), response.status_code)
+        if response.status_code < 500:
+            WEBHOOK_STATS["jobs"] += response.status_code < 400
+            return response.status_code < 400
+    return False
 
 
 @APP.api_route("/api/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH", "TRACE"])
 async def proxy_backend_requests(request: Request, path: str):
-    LOGGER.debug("%s %s\nCookies: %s", request.method, path, request.cookies)
-    await provision_user(request, False)
-    return await proxy_request_to_windmill(request, path, "/api")
+    LOGGER.debug("%s %s", request.method, path)
+    if (not_ready_response := get_not_ready_response()) is not None:
+        return not_ready_response
+    if JOBS_PATH_RE.match(path) and request.headers.get("authorization", "").startswith("Bearer "):
+        # Webhook deliveries and API clients authenticate with their own tokens, there is no user to provision.
+        if is_webhook_delivery(request, path):
+            return await queue_webhook_delivery(request, path)
+        return await proxy_request_to_windmill(request, path, "/api")
+    with trace_span("provision"):
+        await provision_user(request, False)
+    response = await proxy_request_to_windmill(request, path, "/api")
+    if request.method != "GET" and response.status_code < 400 and (flow_change := FLOW_CHANGE_RE.match(path)):
+        request_webhooks_sync(flow_change.group(2) or "")
+    return response
 
 
 @APP.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH", "TRACE"])
 async def proxy_frontend_requests(request: Request, path: str):
-    LOGGER.debug("%s %s\nCookies: %s", request.method, path, request.cookies)
-    await provision_user(request, True)
-    file_server_path = ""
-    if path.startswith("ex_app"):
-        file_server_path = Path("../../" + path)
-    elif not path:
-        file_server_path = Path("/static_frontend/200.html").joinpath(path)
-    elif Path("/static_frontend/").joinpath(path).is_file():
-        file_server_path = Path("/static_frontend/").joinpath(path)
-
-    if file_server_path:
-        LOGGER.debug("proxy_FRONTEND_requests: <OK> Returning: %s", file_server_path)
-        response = FileResponse(str(file_server_path))
+    LOGGER.debug("%s %s", request.method, path)
+    if path and path in STATIC_ASSETS:
+        # Frontend assets are the same for everyone, there is no need to provision the user for them.
+        with trace_span("static"):
+            response = serve_static_asset(request, STATIC_ASSETS[path])
+    elif path and not STATIC_ASSETS and (file_path := get_unindexed_static_file(path)) is not None:
+        STATIC_STATS["unindexed"] += 1
+        response = FileResponse(file_path)
+    elif path.startswith("ex_app"):
+        response = FileResponse(str(Path("../../" + path)))
+    elif (not_ready_response := get_not_ready_response()) is not None:
+        return not_ready_response
     else:
-        LOGGER.debug("proxy_FRONTEND_requests: <LOCAL FILE MISSING> Routing(%s) to the backend", path)
-        response = await proxy_request_to_windmill(request, path)
+        with trace_span("provision"):
+            await provision_user(request, True)
+        if not path:
+            if "200.html" in STATIC_ASSETS:
+                response = serve_static_asset(request, STATIC_ASSETS["200.html"])
+            else:
+                response = FileResponse(str(STATIC_FRONTEND_PATH.joinpath("200.html")))
+        else:
+            LOGGER.debug("proxy_FRONTEND_requests: <LOCAL FILE MISSING> Routing(%s) to the backend", path)
+            STATIC_STATS["proxied"] += 1
+            response = await proxy_request_to_windmill(request, path)
     response.headers["content-security-policy"] = "default-src * 'unsafe-inline' 'unsafe-eval' data: blob:;"
     return response
 
 
-def initialize_windmill() -> None:
-    while True:  # Let's wait until Windmill opens the port.
-        with contextlib.suppress(httpx.ReadError, httpx.ConnectError, httpx.RemoteProtocolError):
-            r = httpx.get("http://127.0.0.1:8000/api/users/whoami")
-            if r.status_code in (401, 403):
-                break
-    if not USERS_STORAGE_PATH.exists():
-        r = httpx.post(
-            url="http://127.0.0.1:8000/api/auth/login", json={"email": "admin@windmill.dev", "password": "changeme"}
-        )
-        if r.status_code >= 400:
-            LOGGER.error("initialize_windmill: can not login with default credentials: %s", r.text)
-            raise RuntimeError(f"initialize_windmill: can not login with default credentials, {r.text}")
-        default_token = r.text
-        new_default_password = generate_random_string()
-        r = httpx.post(
-            url="http://127.0.0.1:8000/api/users/setpassword",
-            json={"password": new_default_password},
-            cookies={"token": default_token},
-        )
-        if r.status_code >= 400:
-            LOGGER.error("initialize_windmill: can not change default credentials password: %s", r.text)
-            raise RuntimeError(f"initialize_windmill: can not change default credentials password, {r.text}")
-        add_user_to_storage(DEFAULT_USER_EMAIL, new_default_password, default_token)
-        r = httpx.post(
-            url="http://127.0.0.1:8000/api/users/tokens/create",
-            json={"label": "NC_PERSISTENT"},
-            cookies={"token": default_token},
-        )
-        if r.status_code >= 400:
-            LOGGER.error("initialize_windmill: can not create persistent token: %s", r.text)
-            raise RuntimeError(f"initialize_windmill: can not create persistent token, {r.text}")
-        default_token = r.text
-        add_user_to_storage(DEFAULT_USER_EMAIL, new_default_password, default_token)
-        r = httpx.post(
-            url="http://127.0.0.1:8000/api/workspaces/create",
-            json={"id": "nextcloud", "name": "nextcloud"},
-            cookies={"token": default_token},
-        )
-        if r.status_code >= 400:
-            LOGGER.error("initialize_windmill: can not create default workspace: %s", r.text)
-            raise RuntimeError(f"initialize_windmill: can not create default workspace, {r.text}")
-        r = httpx.post(
-            url="http://127.0.0.1:8000/api/w/nextcloud/workspaces/edit_auto_invite",
-            json={"operator": False, "invite_all": True, "auto_add": True},
-            cookies={"token": default_token},
+@APP.websocket("/{path:path}")
+async def proxy_websocket_requests(websocket: WebSocket, path: str):
+    LOGGER.debug("WebSocket %s", path)
+    if websocket_connect is None or get_not_ready_response() is not None:
+        await websocket.close(code=1013)  # try again later
+        return
+    await provision_user(websocket, True)
+    await proxy_websocket_to_windmill(websocket, path)
+
+
+async def proxy_websocket_to_windmill(websocket: WebSocket, path: str) -> None:
+    url = WINDMILL_URL.replace("http", "ws", 1) + "/" + path
+    if websocket.url.query:
+        url += "?" + websocket.url.query
+    headers = {"cookie": "; ".join(f"{k}={v}" for k, v in websocket.cookies.items())}
+    if "authorization" in websocket.headers:
+        headers["authorization"] = websocket.headers["authorization"]
+    try:
+        upstream = await websocket_connect(
+            url,
+            additional_headers=headers,
+            subprotocols=websocket.scope.get("subprotocols") or None,
+            open_timeout=UPSTREAM_CONNECT_TIMEOUT,
+            max_size=None,
+            compression=None,
         )
-        if r.status_code >= 400:
-            LOGGER.error("initialize_windmill: can not create default workspace: %s", r.text)
-            raise RuntimeError(f"initialize_windmill: can not create default workspace, {r.text}")
+    except Exception as e:  # noqa
+        LOGGER.warning("Can not open WebSocket connection to %s: %s", path, e)
+        WEBSOCKET_STATS["failed"] += 1
+        await websocket.close(code=1011)
+        return
+    await websocket.accept(subprotocol=upstream.subprotocol)
+    WEBSOCKET_STATS["opened"] += 1
+    WEBSOCKET_STATS["active"] += 1
+    route = get_proxy_route(path)
+    connection_stats = {"in": [0, 0], "out": [0, 0], "last_activity": monotonic()}
+    start_time = perf_counter()
+    tasks = [
+        asyncio.create_task(_forward_websocket_client(websocket, upstream, connection_stats)),
+        asyncio.create_task(_forward_websocket_upstream(websocket, upstream, connection_stats)),
+        asyncio.create_task(_watch_websocket_idle(connection_stats)),
+    ]
+    close_code = 1000
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        if tasks[2] in done:
+            WEBSOCKET_STATS["idle_closed"] += 1
+            close_code = 1001
+        elif tasks[1] in done and upstream.close_code:
+            close_code = upstream.close_code if upstream.close_code != 1006 else 1011
+        for task in done:
+            if task.exception() is not None:
+                LOGGER.error("WebSocket %s forwarding failed", path, exc_info=task.exception())
+                WEBSOCKET_STATS["failed"] += 1
+                close_code = 1011
+    finally:
+        for task in tasks:
+            task.cancel()
+        await upstream.close()
+        with contextlib.suppress(RuntimeError):  # the client is already gone
+            await websocket.close(code=close_code)
+        WEBSOCKET_STATS["active"] -= 1
+        WEBSOCKET_DURATION.observe(perf_counter() - start_time, route)
+        for direction in ("in", "out"):
+            WEBSOCKET_MESSAGES.inc(direction, value=connection_stats[direction][0])
+            WEBSOCKET_BYTES.inc(direction, value=connection_stats[direction][1])
+        LOGGER.debug("WebSocket %s closed, %s", path, connection_stats)
+
+
+async def _forward_websocket_client(websocket: WebSocket, upstream, connection_stats: dict) -> None:
+    with contextlib.suppress(*WEBSOCKET_CLOSED_ERRORS):  # closed by Windmill while sending
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            # Frames are passed on as the received str/bytes objects, without decoding or copying them.
+            data = message["bytes"] if message.get("bytes") is not None else message.get("text", "")
+            connection_stats["in"][0] += 1
+            connection_stats["in"][1] += len(data)
+            connection_stats["last_activity"] = monotonic()
+            await upstream.send(data)
+
+
+async def _forward_websocket_upstream(websocket: WebSocket, upstream, connection_stats: dict) -> None:
+    with contextlib.suppress(*WEBSOCKET_CLOSED_ERRORS):  # closed by Windmill or the client, see `upstream.close_code`
+        async for data in upstream:
+            connection_stats["out"][0] += 1
+            connection_stats["out"][1] += len(data)
+            connection_stats["last_activity"] = monotonic()
+            if isinstance(data, str):
+                await websocket.send({"type": "websocket.send", "text": data})
+            else:
+                await websocket.send({"type": "websocket.send", "bytes": data})
+
+
+async def _watch_websocket_idle(connection_stats: dict) -> None:
+    while (idle_time := monotonic() - connection_stats["last_activity"]) < WEBSOCKET_IDLE_TIMEOUT:
+        await asyncio.sleep(WEBSOCKET_IDLE_TIMEOUT - idle_time)
+
+
+async def bootstrap_windmill() -> None:
+    """Prepares Windmill for the ExApp, retrying until it succeeds. Progress is reported by ``/heartbeat``."""
+    failures = 0
+    while True:
+        try:
+            with startup_phase("waiting_for_windmill"):
+                await wait_for_windmill()
+            async with workers_lock("bootstrap"):  # the first worker does the work, the others only check it
+                with startup_phase("initializing_windmill"):
+                    await initialize_windmill()
+                with startup_phase("creating_resources"):
+                    await create_nextcloud_resource()
+            STARTUP_STATE.update({"stage": "ready", "error": ""})
+            LOGGER.info("Windmill is ready, startup phases: %s", STARTUP_STATE["phases"])
+            return
+        except Exception as e:  # noqa
+            LOGGER.exception("Startup failed during %s", STARTUP_STATE["stage"])
+            STARTUP_STATE.update({"stage": "failed", "error": str(e)})
+            failures += 1
+            await asyncio.sleep(min(2**failures, 60) * random.uniform(0.8, 1.2))  # noqa
+
+
+@contextlib.contextmanager
+def startup_phase(stage: str) -> typing.Iterator[None]:
+    STARTUP_STATE["stage"] = stage
+    start_time = perf_counter()
+    try:
+        yield
+    finally:
+        duration = perf_counter() - start_time
+        STARTUP_STATE["phases"][stage] = round(duration, 3)
+        STARTUP_PHASE_DURATION.set(stage, value=duration)
+        LOGGER.info("Startup phase %s took %.3fs", stage, duration)
+
+
+def get_not_ready_response() -> Response | None:
+    if STARTUP_STATE["stage"] == "ready":
+        return None
+    return responses.JSONResponse(
+        content={"error": "Windmill is starting", "stage": STARTUP_STATE["stage"]},
+        status_code=503,
+        headers={"retry-after": "5"},
+    )
+
+
+async def wait_for_windmill() -> None:
+    """Waits until Windmill opens the port, the polling slows down so that Windmill and Postgres get the CPU."""
+    delay = WINDMILL_READY_MIN_DELAY
+    while True:
+        with contextlib.suppress(httpx.TransportError):
+            r = await get_upstream_client().get("/api/users/whoami")
+            if r.status_code in (401, 403):
+                return
+        await asyncio.sleep(delay * random.uniform(0.5, 1.5))  # noqa
+        delay = min(delay * 2, WINDMILL_READY_MAX_DELAY)
+
+
+async def initialize_windmill() -> None:
+    # Another worker process could have initialized Windmill after this one read the users.
+    if await asyncio.to_thread(USERS_STORAGE.reload, DEFAULT_USER_EMAIL) is not None:
+        return
+    client = get_upstream_client()
+    r = await client.post(url="/api/auth/login", json={"email": "admin@windmill.dev", "password": "changeme"})
+    if r.status_code >= 400:
+        LOGGER.error("initialize_windmill: can not login with default credentials: %s", r.text)
+        raise RuntimeError(f"initialize_windmill: can not login with default credentials, {r.text}")
+    default_token = r.text
+    new_default_password = generate_random_string()
+    r = await client.post(
+        url="/api/users/setpassword",
+        json={"password": new_default_password},
+        cookies={"token": default_token},
+    )
+    if r.status_code >= 400:
+        LOGGER.error("initialize_windmill: can not change default credentials password: %s", r.text)
+        raise RuntimeError(f"initialize_windmill: can not change default credentials password, {r.text}")
+    await add_user_to_storage(DEFAULT_USER_EMAIL, new_default_password, default_token)
+    r = await client.post(
+        url="/api/users/tokens/create",
+        json={"label": "NC_PERSISTENT"},
+        cookies={"token": default_token},
+    )
+    if r.status_code >= 400:
+        LOGGER.error("initialize_windmill: can not create persistent token: %s", r.text)
+        raise RuntimeError(f"initialize_windmill: can not create persistent token, {r.text}")
+    default_token = r.text
+    await add_user_to_storage(DEFAULT_USER_EMAIL, new_default_password, default_token, True)
+    r = await client.post(
+        url="/api/workspaces/create",
+        json={"id": "nextcloud", "name": "nextcloud"},
+        cookies={"token": default_token},
+    )
+    if r.status_code >= 400:
+        LOGGER.error("initialize_windmill: can not create default workspace: %s", r.text)
+        raise RuntimeError(f"initialize_windmill: can not create default workspace, {r.text}")
+    r = await client.post(
+        url="/api/w/nextcloud/workspaces/edit_auto_invite",
+        json={"operator": False, "invite_all": True, "auto_add": True},
+        cookies={"token": default_token},
+    )
+    if r.status_code >= 400:
+        LOGGER.error("initialize_windmill: can not create default workspace: %s", r.text)
+        raise RuntimeError(f"initialize_windmill: can not create default workspace, {r.text}")
 
 
 def generate_random_string(length=10):
@@ -320,65 +2514,529 @@ def generate_random_string(length=10):
     return "".join(random.choice(letters) for i in range(length))  # noqa
 
 
-async def start_background_webhooks_syncing():
-    await asyncio.to_thread(webhooks_syncing)
+async def start_background_tasks():
+    await bootstrap_windmill()
+    await wait_for_webhooks_sync_leadership()
+    await asyncio.gather(
+        start_background_webhooks_syncing(), start_background_tokens_refreshing(), start_background_workers_scaling()
+    )
 
 
-def webhooks_syncing():
+async def start_background_users_syncing() -> None:
+    """Rereads users changed by other worker processes, so user lookups of requests never wait for SQLite."""
     while True:
+        await asyncio.sleep(USERS_STORAGE_SYNC_INTERVAL)
         try:
-            _webhooks_syncing()
+            await asyncio.to_thread(USERS_STORAGE.reload_changed)
         except Exception:  # noqa
-            LOGGER.exception("Exception occurred", stack_info=True)
-            sleep(60)
+            LOGGER.exception("Can not reread users")
 
 
-def _webhooks_syncing():
-    workspace = "nextcloud"
+async def start_background_tokens_refreshing() -> None:
+    """Keeps tokens of active users valid, so their requests do not wait for a login. Runs in the sync leader."""
+    while True:
+        await asyncio.sleep(TOKEN_REFRESH_INTERVAL * random.uniform(0.8, 1.2))  # noqa
+        try:
+            user_emails = await asyncio.to_thread(USERS_STORAGE.get_tokens_to_refresh)
+        except Exception:  # noqa
+            LOGGER.exception("Can not read tokens to refresh")
+            continue
+        for user_email in user_emails:
+            try:
+                await refresh_user_token(user_email)
+            except Exception as e:  # noqa
+                TOKEN_LIFECYCLE_STATS["failed"] += 1
+                LOGGER.warning("Can not refresh the token of %s: %s", user_email, e)
+            await asyncio.sleep(1 / TOKEN_REFRESH_RATE)
+
 
+async def refresh_user_token(user_email: str) -> None:
+    async with USER_LOCKS[user_email], workers_lock(get_user_lock_name(user_email)):
+        user = await asyncio.to_thread(USERS_STORAGE.reload, user_email)
+        if user is None:
+            return
+        TOKEN_LIFECYCLE_STATS["checked"] += 1
+        if not await _check_token(user["token"]):
+            await issue_user_token(user_email, user["password"])
+            TOKEN_LIFECYCLE_STATS["renewed"] += 1
+        elif not user["persistent"]:
+            if not (token := await create_persistent_token(user["token"])):
+                raise RuntimeError("Windmill did not create a persistent token")
+            await add_user_to_storage(user_email, user["password"], token, True)
+            TOKEN_LIFECYCLE_STATS["upgraded"] += 1
+        else:
+            await asyncio.to_thread(USERS_STORAGE.mark_validated, user_email)
+
+
+class WorkersScalingSample(typing.NamedTuple):
+    queued: int
+    wait_time: float  # seconds the oldest queued job waits
+    cpu_usage: float | None  # share of the CPU limit used since the previous sample
+    memory_available: int | None
+
+
+def decide_workers_scaling(workers: int, sample: WorkersScalingSample, state: dict) -> tuple[int, str]:
+    """Returns the change of the number of workers (-1, 0 or 1) and its reason, ``state`` keeps the hysteresis."""
+    busy = sample.queued > workers * WORKERS_SCALE_UP_QUEUE or sample.wait_time > WORKERS_SCALE_UP_WAIT
+    state["busy_samples"] = state["busy_samples"] + 1 if busy else 0
+    state["idle_samples"] = state["idle_samples"] + 1 if sample.queued == 0 else 0
+    if monotonic() - state["changed"] < WORKERS_SCALING_COOLDOWN:
+        return 0, "cooldown"
+    if state["busy_samples"] >= WORKERS_SCALE_UP_SAMPLES:
+        if workers >= state["max_workers"]:
+            return 0, "maximum number of workers"
+        if sample.cpu_usage is not None and sample.cpu_usage > WORKERS_MAX_CPU_USAGE:
+            return 0, f"CPU usage is {sample.cpu_usage:.0%}"
+        if sample.memory_available is not None and sample.memory_available < WORKERS_MIN_FREE_MEMORY:
+            return 0, f"only {sample.memory_available // 1024 // 1024} MiB of memory is available"
+        return 1, f"{sample.queued} jobs queued, the oldest one waits {sample.wait_time:.1f}s"
+    if state["idle_samples"] >= WORKERS_SCALE_DOWN_SAMPLES and workers > state["base_workers"]:
+        return -1, f"queue was empty for {state['idle_samples']} samples"
+    return 0, ""
+
+
+async def get_windmill_queue_state(workspace: str) -> tuple[int, float]:
+    """Returns the number of queued jobs of the workspace and how long the oldest of them waits."""
+    client = get_upstream_client()
+    headers = {"Authorization": f"Bearer {await get_valid_user_token(DEFAULT_USER_EMAIL)}"}
+    r = await client.get(f"/api/w/{workspace}/jobs/queue/count", headers=headers)
+    r.raise_for_status()
+    queued = r.json()["database_length"]
+    if not queued:
+        return 0, 0.0
+    r = await client.get(
+        f"/api/w/{workspace}/jobs/queue/list",
+        params={"running": "false", "order_desc": "false", "per_page": 1},
+        headers=headers,
+    )
+    r.raise_for_status()
+    jobs = r.json()
+    if not jobs or not (scheduled_for := jobs[0].get("scheduled_for") or jobs[0].get("created_at")):
+        return queued, 0.0
+    return queued, max(time.time() - datetime.fromisoformat(scheduled_for.replace("Z", "+00:00")).timestamp(), 0.0)
+
+
+async def start_background_workers_scaling() -> None:
+    """Adds and removes Windmill worker processes depending on the job queue. Runs in the sync leader."""
+    if not WINDMILL_WORKERS_AUTOSCALE:
+        return
+    if not WORKERS_SCALING_STATE["max_workers"]:
+        WORKERS_SCALING_STATE["max_workers"] = max(int(get_cpu_limit() * 2), WINDMILL_BASE_WORKERS)
+    await asyncio.to_thread(stop_orphaned_windmill_workers)
+    cpu_limit = get_cpu_limit()
+    cpu_time, sample_time = read_cpu_time(), monotonic()
     while True:
-        nc = NextcloudApp()
-        if not nc.enabled_state:
-            print("ExApp is disabled, sleeping for 5 minutes")
-            sleep(5 * 60)
+        await asyncio.sleep(WORKERS_SCALING_INTERVAL)
+        try:
+            queued, wait_time = await get_windmill_queue_state("nextcloud")
+        except Exception as e:  # noqa
+            LOGGER.warning("Can not read the Windmill job queue: %s", e)
             continue
-        LOGGER.debug("Running workflow sync")
-        token = get_valid_user_token_sync(DEFAULT_USER_EMAIL)
-        flow_paths = get_flow_paths(workspace, token)
-        LOGGER.debug("flow_paths:\n%s", flow_paths)
-        expected_listeners = get_expected_listeners(workspace, token, flow_paths)
-        LOGGER.debug("expected_listeners:\n%s", json.dumps(expected_listeners, indent=4))
-        registered_listeners = get_registered_listeners()
-        LOGGER.debug("get_registered_listeners:\n%s", json.dumps(registered_listeners, indent=4))
-        for expected_listener in expected_listeners:
-            expected_listener["filters"] = _preprocess_webhook_event_filter(expected_listener["filters"])
-            registered_listeners_for_uri = get_registered_listeners_for_uri(
-                expected_listener["webhook"], registered_listeners
-            )
-            for event in expected_listener["events"]:
-                listener = next(filter(lambda listener: listener["event"] == event, registered_listeners_for_uri), None)
-                if listener is not None:
-                    listener["eventFilter"] = _preprocess_webhook_event_filter(listener["eventFilter"])
-                    if listener["eventFilter"] != expected_listener["filters"]:
-                        LOGGER.debug("before update_listener:\n%s", json.dumps(listener))
-                        update_listener(listener, expected_listener["filters"], token)
-                else:
-                    register_listener(event, expected_listener["filters"], expected_listener["webhook"], token)
-        for registered_listener in registered_listeners:
-            if registered_listener["appId"] == nc.app_cfg.app_name:  # noqa
-                if (
-                    next(
-                        filter(
-                            lambda expected_listener: registered_listener["uri"] == expected_listener["webhook"]
-                            and registered_listener["event"] in expected_listener["events"],
-                            expected_listeners,
-                        ),
-                        None,
-                    )
-                    is None
-                ):
-                    delete_listener(registered_listener)
-        sleep(30)
+        previous_cpu_time, previous_sample_time = cpu_time, sample_time
+        cpu_time, sample_time = read_cpu_time(), monotonic()
+        cpu_usage = None
+        if cpu_time is not None and previous_cpu_time is not None:
+            cpu_usage = (cpu_time - previous_cpu_time) / (sample_time - previous_sample_time) / cpu_limit
+        sample = WorkersScalingSample(queued, wait_time, cpu_usage, get_memory_available())
+        await apply_workers_scaling(sample)
+
+
+async def apply_workers_scaling(sample: WorkersScalingSample) -> None:
+    for process in [i for i in WINDMILL_WORKER_PROCESSES if i.returncode is not None]:
+        LOGGER.warning("Windmill worker process %d exited with code %d", process.pid, process.returncode)
+        WINDMILL_WORKER_PROCESSES.remove(process)
+    workers = WINDMILL_BASE_WORKERS + len(WINDMILL_WORKER_PROCESSES)
+    change, reason = decide_workers_scaling(workers, sample, WORKERS_SCALING_STATE)
+    WORKERS_SCALING_STATE.update({"workers": workers, **sample._asdict()})
+    if not change:
+        return
+    if change > 0:
+        await start_windmill_worker()
+        WORKERS_SCALING_STATE["scaled_up"] += 1
+    else:
+        process = WINDMILL_WORKER_PROCESSES.pop()
+        task = asyncio.create_task(stop_windmill_worker(process))
+        WINDMILL_WORKERS_STOPPING.add(task)
+        task.add_done_callback(WINDMILL_WORKERS_STOPPING.discard)
+        WORKERS_SCALING_STATE["scaled_down"] += 1
+    await asyncio.to_thread(save_windmill_workers_pids)
+    WORKERS_SCALING_STATE.update(
+        {"workers": workers + change, "changed": monotonic(), "busy_samples": 0, "idle_samples": 0}
+    )
+    decision = {"time": time.time(), "workers": workers + change, "reason": reason, **sample._asdict()}
+    WORKERS_SCALING_DECISIONS.append(decision)
+    LOGGER.info("Windmill workers: %d -> %d, %s", workers, workers + change, reason)
+
+
+async def start_windmill_worker() -> None:
+    process = await asyncio.create_subprocess_exec(
+        *WINDMILL_WORKER_COMMAND, env={**os.environ, "MODE": "worker", "NUM_WORKERS": "1"}
+    )
+    WINDMILL_WORKER_PROCESSES.append(process)
+
+
+async def stop_windmill_worker(process: asyncio.subprocess.Process) -> None:
+    if process.returncode is not None:
+        return
+    process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), WORKERS_STOP_TIMEOUT)
+    except asyncio.TimeoutError:
+        LOGGER.warning("Windmill worker process %d did not stop in time, killing it", process.pid)
+        process.kill()
+        await process.wait()
+
+
+async def stop_windmill_workers() -> None:
+    processes = list(WINDMILL_WORKER_PROCESSES)
+    WINDMILL_WORKER_PROCESSES.clear()
+    for process in processes:
+        WINDMILL_WORKERS_STOPPING.add(asyncio.create_task(stop_windmill_worker(process)))
+    if WINDMILL_WORKERS_STOPPING:
+        await asyncio.wait(WINDMILL_WORKERS_STOPPING, timeout=10)
+    if processes:
+        await asyncio.to_thread(save_windmill_workers_pids)
+
+
+def save_windmill_workers_pids() -> None:
+    WINDMILL_WORKERS_PIDS_PATH.write_text(json.dumps([i.pid for i in WINDMILL_WORKER_PROCESSES]))
+
+
+def stop_orphaned_windmill_workers() -> None:
+    """Stops workers started by a previous sync leader that exited without stopping them."""
+    try:
+        pids = json.loads(WINDMILL_WORKERS_PIDS_PATH.read_text())
+    except (OSError, ValueError):
+        return
+    for pid in pids:
+        try:
+            cmdline = Path(f"/proc/{pid}/cmdline").read_bytes().split(b"\0")
+        except OSError:
+            continue
+        if cmdline and Path(cmdline[0].decode()).name == Path(WINDMILL_WORKER_COMMAND[0]).name:
+            LOGGER.info("Stopping orphaned Windmill worker process %d", pid)
+            with contextlib.suppress(OSError):
+                os.kill(pid, signal.SIGTERM)
+    WINDMILL_WORKERS_PIDS_PATH.unlink(missing_ok=True)
+
+
+def get_workers_scaling_stats() -> dict:
+    return {**WORKERS_SCALING_STATE, "decisions": list(WORKERS_SCALING_DECISIONS)}
+
+
+async def preprovision_users(report_progress: typing.Callable[[int], typing.Awaitable] | None = None) -> None:
+    """Creates Windmill accounts of Nextcloud users before their first visit, resuming after the last checkpoint."""
+    lock = FileLock(LOCKS_PATH.joinpath("preprovision.lock"))  # one job for all worker processes
+    if PREPROVISION_STATE["running"] or not lock.acquire():
+        LOGGER.info("Pre-provisioning of users is already running")
+        return
+    PREPROVISION_STATE.update({"running": True, "created": 0, "failed": 0, "error": ""})
+    try:
+        while STARTUP_STATE["stage"] != "ready":
+            await asyncio.sleep(1)
+        source = "all" if PREPROVISION_GROUP == "*" else f"group:{PREPROVISION_GROUP}"
+        user_ids = await get_nextcloud_user_ids()
+        last_user_id = await asyncio.to_thread(USERS_STORAGE.get_preprovision_progress, source)
+        # Users added or removed since the checkpoint do not shift the position of those not handled yet.
+        start_index = bisect.bisect_right(user_ids, last_user_id) if last_user_id else 0
+        PREPROVISION_STATE.update({"source": source, "total": len(user_ids), "done": start_index})
+        LOGGER.info("Pre-provisioning %d users of %s after %r", len(user_ids), source, last_user_id)
+        semaphore = asyncio.Semaphore(PREPROVISION_CONCURRENCY)
+        for index in range(start_index, len(user_ids), PREPROVISION_PAGE_SIZE):
+            page = user_ids[index : index + PREPROVISION_PAGE_SIZE]
+            await asyncio.gather(*(preprovision_user(i, semaphore) for i in page))
+            PREPROVISION_STATE["done"] = index + len(page)
+            await asyncio.to_thread(USERS_STORAGE.set_preprovision_progress, source, page[-1])
+            if report_progress is not None:
+                await report_progress(min(PREPROVISION_STATE["done"] * 100 // len(user_ids), 99))
+        await asyncio.to_thread(USERS_STORAGE.set_preprovision_progress, source, None)
+        LOGGER.info("Pre-provisioning finished: %s", PREPROVISION_STATE)
+    except Exception as e:  # noqa
+        LOGGER.exception("Pre-provisioning of users failed")
+        PREPROVISION_STATE["error"] = str(e)
+    finally:
+        PREPROVISION_STATE["running"] = False
+        lock.release()
+
+
+async def get_nextcloud_user_ids() -> list[str]:
+    nc = get_nextcloud_client()
+    if PREPROVISION_GROUP != "*":
+        return sorted(await nextcloud_call("group_members", nc.users_groups.get_members(PREPROVISION_GROUP)))
+    user_ids = []
+    while True:
+        page = await nextcloud_call("users", nc.users.get_list(limit=PREPROVISION_PAGE_SIZE, offset=len(user_ids)))
+        user_ids.extend(page)
+        if len(page) < PREPROVISION_PAGE_SIZE:
+            return sorted(user_ids)  # the order of the checkpoint
+
+
+async def preprovision_user(user_id: str, semaphore: asyncio.Semaphore) -> None:
+    user_name = get_windmill_username(user_id)
+    if get_user_email(user_name) in USERS_STORAGE:
+        return
+    async with semaphore:
+        try:
+            await ensure_windmill_user(user_name, True)
+            PREPROVISION_STATE["created"] += 1
+        except Exception as e:  # noqa
+            PREPROVISION_STATE["failed"] += 1
+            LOGGER.warning("Can not pre-provision user %s: %s", user_id, e)
+
+
+async def wait_for_webhooks_sync_leadership() -> None:
+    """Returns when this worker process holds the lock of the webhooks sync, it is held until the process exits."""
+    while not WEBHOOKS_SYNC_LOCK.acquire():
+        await asyncio.sleep(WEBHOOKS_SYNC_LEADER_RETRY_INTERVAL * random.uniform(0.8, 1.2))  # noqa
+    LOGGER.info("Worker %d runs the webhooks sync", os.getpid())
+    # The previous leader could have changed the storage after this process read it. Requests made before
+    # are dropped, the first pass checks all flows anyway.
+    await asyncio.to_thread(FLOWS_CACHE.reload)
+    await asyncio.to_thread(FLOWS_CACHE.pop_sync_requests)
+    WEBHOOKS_SYNC_STATE["leader"] = True
+
+
+async def start_background_webhooks_syncing():
+    workspace = "nextcloud"
+    failures = 0
+    flow_paths = None
+    while True:
+        try:
+            await webhooks_sync_pass(workspace, flow_paths)
+            failures = 0
+            timeout = WEBHOOKS_SYNC_INTERVAL
+        except Exception:  # noqa
+            LOGGER.exception("Exception occurred", stack_info=True)
+            failures += 1
+            timeout = min(5 * 2 ** (failures - 1), WEBHOOKS_SYNC_INTERVAL)
+        flow_paths = await wait_for_webhooks_sync_request(timeout * random.uniform(0.8, 1.2))  # noqa
+        if failures and flow_paths is not None:
+            flow_paths.add("")  # paths of the failed pass are lost, so check all flows
+
+
+def request_webhooks_sync(flow_path: str = "") -> None:
+    """Asks the webhooks sync to check the flow soon, empty ``flow_path`` means that all flows should be checked."""
+    if not WEBHOOKS_SYNC_STATE["leader"]:
+        # The sync runs in another worker process (or is not started yet), it reads requests from the database.
+        _t = asyncio.get_running_loop().run_in_executor(None, FLOWS_CACHE.add_sync_request, flow_path)  # noqa
+        return
+    WEBHOOKS_SYNC_REQUESTS.add(flow_path)
+    WEBHOOKS_SYNC_EVENT.set()
+
+
+async def wait_for_webhooks_sync_request(timeout: float) -> set[str] | None:
+    """Returns requested flow paths, or ``None`` if nothing was requested during ``timeout`` seconds."""
+    end_time = monotonic() + timeout
+    while not WEBHOOKS_SYNC_REQUESTS:
+        wait_time = end_time - monotonic()
+        if wait_time <= 0:
+            return None
+        if EXAPP_WORKERS > 1:
+            wait_time = min(wait_time, WEBHOOKS_SYNC_REQUESTS_POLL_INTERVAL)
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(WEBHOOKS_SYNC_EVENT.wait(), wait_time)
+        if EXAPP_WORKERS > 1:
+            WEBHOOKS_SYNC_REQUESTS.update(await asyncio.to_thread(FLOWS_CACHE.pop_sync_requests))
+    await asyncio.sleep(WEBHOOKS_SYNC_DEBOUNCE)  # editors save flows in bursts, handle them in one go
+    WEBHOOKS_SYNC_EVENT.clear()
+    WEBHOOKS_SYNC_REQUESTS.update(await asyncio.to_thread(FLOWS_CACHE.pop_sync_requests))
+    flow_paths = set(WEBHOOKS_SYNC_REQUESTS)
+    WEBHOOKS_SYNC_REQUESTS.clear()
+    return flow_paths
+
+
+async def webhooks_sync_pass(workspace: str, flow_paths: set[str] | None) -> None:
+    if flow_paths and WEBHOOKS_SYNC_FORCE in flow_paths:
+        WEBHOOKS_SYNC_STATE["applied_state"] = ""
+        NEXTCLOUD_ENABLED_STATE["time"] = float("-inf")
+        flow_paths = None
+    if not await get_nextcloud_enabled_state():
+        LOGGER.debug("ExApp is disabled, skipping workflow sync")
+        return
+    start_time = perf_counter()
+    result = "error"
+    try:
+        result = await _webhooks_sync_pass(workspace, flow_paths)
+    finally:
+        WEBHOOKS_SYNC_DURATION.observe(perf_counter() - start_time, result)
+        WEBHOOKS_SYNC_FLOWS.set(value=len(FLOWS_CACHE.paths()))
+
+
+async def _webhooks_sync_pass(workspace: str, flow_paths: set[str] | None) -> str:
+    LOGGER.debug("Running workflow sync, requested flows: %s", flow_paths)
+    token = await get_valid_user_token(DEFAULT_USER_EMAIL)
+    if flow_paths and "" not in flow_paths:
+        expected_listeners, failed_webhooks = await refresh_flows_cache_paths(workspace, token, flow_paths)
+    else:
+        expected_listeners, failed_webhooks = await refresh_flows_cache(workspace, token)
+    LOGGER.debug("expected_listeners:\n%s", LazyJSON(expected_listeners))
+    desired_state = hashlib.blake2b(json.dumps(expected_listeners, sort_keys=True).encode()).hexdigest()
+    # Listeners in Nextcloud can also be changed by someone else, so they are compared from time to time anyway.
+    if (
+        not failed_webhooks
+        and desired_state == WEBHOOKS_SYNC_STATE["applied_state"]
+        and monotonic() - WEBHOOKS_SYNC_STATE["full_sync_time"] < WEBHOOKS_FULL_SYNC_INTERVAL
+    ):
+        LOGGER.debug("Expected listeners did not change, skipping")
+        return "unchanged"
+    await reconcile_listeners(expected_listeners, failed_webhooks, token, get_nextcloud_client().app_cfg.app_name)
+    if failed_webhooks:
+        return "partial"
+    WEBHOOKS_SYNC_STATE["applied_state"] = desired_state
+    WEBHOOKS_SYNC_STATE["full_sync_time"] = monotonic()
+    return "reconciled"
+
+
+async def refresh_flows_cache(workspace: str, token: str) -> tuple[list[dict], set[str]]:
+    """Refetches added and changed flows, returns expected listeners and webhooks of flows that failed to load."""
+    flows = await get_flows(workspace, token)
+    changed_paths = [path for path, version in flows.items() if FLOWS_CACHE.get_version(path) != version]
+    removed_paths = [path for path in FLOWS_CACHE.paths() if path not in flows]
+    LOGGER.debug("flows: %d, changed: %d, removed: %d", len(flows), len(changed_paths), len(removed_paths))
+    listeners, failed_webhooks = await get_flow_listeners(workspace, token, changed_paths)
+    await asyncio.to_thread(
+        FLOWS_CACHE.update,
+        {path: (flows[path], listener) for path, (_, listener) in listeners.items()},
+        removed_paths,
+    )
+    return FLOWS_CACHE.listeners(), failed_webhooks
+
+
+async def get_expected_listeners(workspace: str, token: str) -> tuple[list[dict], set[str]]:
+    """Same as ``refresh_flows_cache``, but fetched flows are not stored and the flows cache is not changed."""
+    flows = await get_flows(workspace, token)
+    changed_paths = [path for path, version in flows.items() if FLOWS_CACHE.get_version(path) != version]
+    listeners, failed_webhooks = await get_flow_listeners(workspace, token, changed_paths)
+    expected_listeners = [i for _, i in listeners.values() if i is not None]
+    for path in flows.keys() - set(changed_paths):
+        if (listener := FLOWS_CACHE.get_listener(path)) is not None:
+            expected_listeners.append(listener)
+    return expected_listeners, failed_webhooks
+
+
+async def refresh_flows_cache_paths(workspace: str, token: str, flow_paths: set[str]) -> tuple[list[dict], set[str]]:
+    """Same as ``refresh_flows_cache`` but refetches only the specified flows."""
+    listeners, failed_webhooks = await get_flow_listeners(workspace, token, list(flow_paths))
+    changed = {path: (version, listener) for path, (version, listener) in listeners.items() if version is not None}
+    removed_paths = [path for path, (version, _) in listeners.items() if version is None]
+    await asyncio.to_thread(FLOWS_CACHE.update, changed, removed_paths)
+    if removed_paths:  # the flow could have been renamed, so the new path is only visible in the list of flows
+        return await refresh_flows_cache(workspace, token)
+    return FLOWS_CACHE.listeners(), failed_webhooks
+
+
+class ListenerChange(typing.NamedTuple):
+    action: str  # "create", "update" or "delete"
+    uri: str
+    event: str
+    event_filter: list | dict
+    listener_id: int | None = None
+
+
+def index_expected_listeners(expected_listeners: list[dict]) -> dict[tuple[str, str], list | dict]:
+    expected = {}
+    for expected_listener in expected_listeners:
+        event_filter = _preprocess_webhook_event_filter(expected_listener["filters"])
+        for event in expected_listener["events"]:
+            expected[(expected_listener["webhook"], event)] = event_filter
+    return expected
+
+
+def plan_listeners_changes(
+    expected_listeners: list[dict], registered_listeners: list[dict], failed_webhooks: set[str], app_name: str
+) -> list[ListenerChange]:
+    expected = index_expected_listeners(expected_listeners)
+    plan = []
+    registered = {}
+    for listener in registered_listeners:
+        if listener["appId"] != app_name:
+            continue
+        key = (listener["uri"], listener["event"])
+        if key in registered:  # the same listener is registered twice, the flow would run twice for each event
+            plan.append(ListenerChange("delete", listener["uri"], listener["event"], [], listener["id"]))
+            continue
+        registered[key] = listener
+    for (uri, event), event_filter in expected.items():
+        listener = registered.get((uri, event))
+        if listener is None:
+            plan.append(ListenerChange("create", uri, event, event_filter))
+        elif _preprocess_webhook_event_filter(listener["eventFilter"]) != event_filter:
+            plan.append(ListenerChange("update", uri, event, event_filter, listener["id"]))
+    for (uri, event), listener in registered.items():
+        # Listeners of flows that could not be fetched during this pass are kept as they are.
+        if (uri, event) not in expected and uri not in failed_webhooks:
+            plan.append(ListenerChange("delete", uri, event, [], listener["id"]))
+    return plan
+
+
+async def apply_listeners_changes(plan: list[ListenerChange], token: str) -> list[dict]:
+    """Applies changes concurrently, retrying failed ones. Returns the result and duration of each change."""
+    semaphore = asyncio.Semaphore(WEBHOOKS_APPLY_CONCURRENCY)
+
+    async def _apply(change: ListenerChange) -> dict:
+        async with semaphore:
+            start_time = perf_counter()
+            ok = False
+            attempt = 0
+            while not ok and attempt <= WEBHOOKS_APPLY_RETRIES:
+                if attempt:
+                    await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+                attempt += 1
+                try:
+                    await apply_listener_change(change, token)
+                    ok = True
+                except Exception as e:  # noqa
+                    LOGGER.warning("Can not %s listener %s - %s (attempt %d): %s", *change[:3], attempt, e)
+            WEBHOOKS_LISTENER_CHANGES.inc(change.action, "ok" if ok else "failed")
+            return {"change": change._asdict(), "ok": ok, "attempts": attempt, "time": perf_counter() - start_time}
+
+    return list(await asyncio.gather(*(_apply(i) for i in plan)))
+
+
+async def apply_listener_change(change: ListenerChange, token: str) -> None:
+    if change.action == "create":
+        await register_listener(change.event, change.event_filter, change.uri, token)
+    elif change.action == "update":
+        await update_listener(
+            {"id": change.listener_id, "uri": change.uri, "event": change.event}, change.event_filter, token
+        )
+    else:
+        await delete_listener({"id": change.listener_id})
+
+
+async def reconcile_listeners(
+    expected_listeners: list[dict], failed_webhooks: set[str], token: str, app_name: str
+) -> None:
+    registered_listeners = await get_registered_listeners()
+    LOGGER.debug("get_registered_listeners:\n%s", LazyJSON(registered_listeners))
+    plan = plan_listeners_changes(expected_listeners, registered_listeners, failed_webhooks, app_name)
+    results = await apply_listeners_changes(plan, token)
+    if failed_changes := [i for i in results if not i["ok"]]:
+        raise RuntimeError(f"{len(failed_changes)} of {len(plan)} listener changes failed")
+
+
+async def plan_webhooks_sync(workspace: str) -> dict:
+    """Computes what the webhooks sync would change, without changing anything."""
+    timings = {}
+    start_time = perf_counter()
+    token = await get_valid_user_token(DEFAULT_USER_EMAIL)
+    expected_listeners, failed_webhooks = await get_expected_listeners(workspace, token)
+    timings["flows"] = perf_counter() - start_time
+    start_time = perf_counter()
+    registered_listeners = await get_registered_listeners()
+    timings["registered_listeners"] = perf_counter() - start_time
+    start_time = perf_counter()
+    plan = plan_listeners_changes(
+        expected_listeners, registered_listeners, failed_webhooks, get_nextcloud_client().app_cfg.app_name
+    )
+    timings["plan"] = perf_counter() - start_time
+    return {
+        "plan": [i._asdict() for i in plan],
+        "failed_webhooks": sorted(failed_webhooks),
+        "expected_listeners": len(expected_listeners),
+        "registered_listeners": len(registered_listeners),
+        "timings": timings,
+    }
 
 
 def _preprocess_webhook_event_filter(event_filter):
@@ -387,102 +3045,147 @@ def _preprocess_webhook_event_filter(event_filter):
     return event_filter
 
 
-def get_flow_paths(workspace: str, token: str) -> list[str]:
-    method = "GET"
+async def get_flows(workspace: str, token: str) -> dict[str, str]:
+    """Returns the version of each flow in the workspace: its edit time, or hash of its listing if there is none."""
     path = f"w/{workspace}/flows/list"
-    flow_paths = []
-    with httpx.Client() as client:
-        url = f"http://127.0.0.1:8000/api/{path}"
-        headers = {"Authorization": f"Bearer {token}"}
-        response = client.request(
-            method=method,
-            url=url,
-            params={"per_page": 100},
-            headers=headers,
+    flows = {}
+    page = 1
+    while True:
+        response = await get_upstream_client().get(
+            f"/api/{path}",
+            params={"page": page, "per_page": FLOWS_PAGE_SIZE},
+            headers={"Authorization": f"Bearer {token}"},
         )
-        LOGGER.debug("%s %s -> %s", method, path, response.status_code)
-        try:
-            response_data = json.loads(response.content)
-            for flow in response_data:
-                flow_paths.append(flow["path"])
-        except json.JSONDecodeError:
-            LOGGER.exception("Error parsing JSON", stack_info=True)
-    return flow_paths
+        LOGGER.debug("GET %s(page=%d) -> %s", path, page, response.status_code)
+        # An incomplete list would remove the listeners of the missing flows, so the whole pass fails instead.
+        if response.status_code >= 400:
+            raise RuntimeError(f"get_flows: {response.status_code} {response.text}")
+        response_data = response.json()
+        for flow in response_data:
+            flows[flow["path"]] = (
+                flow.get("edited_at") or hashlib.blake2b(json.dumps(flow, sort_keys=True).encode()).hexdigest()
+            )
+        if len(response_data) < FLOWS_PAGE_SIZE:
+            return flows
+        page += 1
+
+
+async def get_flow_listeners(
+    workspace: str, token: str, flow_paths: list[str]
+) -> tuple[dict[str, tuple[str | None, dict | None]], set[str]]:
+    """Returns versions and expected listeners of the flows, and webhooks of the flows that could not be fetched."""
+    semaphore = asyncio.Semaphore(WEBHOOKS_SYNC_CONCURRENCY)
+
+    async def _get_flow_listener(flow_path: str) -> tuple[str | None, dict | None]:
+        async with semaphore:
+            return await get_flow_listener(workspace, token, flow_path)
+
+    listeners = {}
+    failed_webhooks = set()
+    results = await asyncio.gather(*(_get_flow_listener(i) for i in flow_paths), return_exceptions=True)
+    for flow_path, result in zip(flow_paths, results, strict=True):
+        if isinstance(result, Exception):
+            LOGGER.error("Can not fetch flow %s: %s", flow_path, result)
+            failed_webhooks.add(get_flow_webhook(workspace, flow_path))
+        else:
+            listeners[flow_path] = result
+    return listeners, failed_webhooks
 
 
-def get_expected_listeners(workspace: str, token: str, flow_paths: list[str]) -> list[dict]:
-    flows = []
-    for flow_path in flow_paths:
-        with httpx.Client() as client:
-            method = "GET"
-            path = f"w/{workspace}/flows/get/{flow_path}"
-            url = f"http://127.0.0.1:8000/api/{path}"
-            headers = {"Authorization": f"Bearer {token}"}
-            response = client.request(
-                method=method,
-                url=url,
-                params={"per_page": 100},
-                headers=headers,
-            )
-            LOGGER.debug("%s %s -> %s", method, path, response.status_code)
-            try:
-                response_data = json.loads(response.content)
-            except json.JSONDecodeError:
-                LOGGER.exception("Error parsing JSON", stack_info=True)
-                return []
-            if not response_data["value"].get("modules", []):
-                LOGGER.debug("Flow %s has no modules in it, skipping,", flow_path)
-                return flows
-            first_module = response_data["value"]["modules"][0]
-            if (
-                first_module.get("summary", "") == "CORE:LISTEN_TO_EVENT"
-                and first_module["value"]["input_transforms"]["events"]["type"] == "static"
-                and first_module["value"]["input_transforms"]["filters"]["type"] == "static"
-            ):
-                webhook = f"/api/w/{workspace}/jobs/run/f/{flow_path}"
-                input_transforms = first_module["value"]["input_transforms"]
-                flows.append(
-                    {
-                        "webhook": webhook,
-                        "filters": input_transforms["filters"]["value"],
-                        # Remove backslashes from the beginning to yield canonical reference
-                        "events": [
-                            event[1:] if event.startswith("\\") else event
-                            for event in input_transforms["events"]["value"]
-                        ],
-                    }
-                )
-    return flows
+def get_flow_webhook(workspace: str, flow_path: str) -> str:
+    return f"/api/w/{workspace}/jobs/run/f/{flow_path}"
 
 
-def get_registered_listeners_for_uri(webhook: str, registered_listeners: list) -> list:
-    return [listener for listener in registered_listeners if listener["uri"] == webhook]
+async def get_flow_listener(workspace: str, token: str, flow_path: str) -> tuple[str | None, dict | None]:
+    """Returns the flow version (``None`` if there is no such flow) and the listener expected by the flow."""
+    path = f"w/{workspace}/flows/get/{flow_path}"
+    response = await get_upstream_client().get(f"/api/{path}", headers={"Authorization": f"Bearer {token}"})
+    LOGGER.debug("GET %s -> %s", path, response.status_code)
+    if response.status_code == 404:
+        return None, None  # flow was removed
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.status_code} {response.text}")
+    flow = response.json()
+    if isinstance(flow, dict) and flow.get("archived"):
+        return None, None  # archived flows are still returned here, but not in the list of flows
+    version = flow.get("edited_at", "") if isinstance(flow, dict) else ""
+    return version, parse_flow_listener(workspace, flow_path, flow)
 
 
-def register_listener(event, event_filter, webhook, token: str) -> dict:
-    LOGGER.debug("%s - %s: %s", webhook, event, json.dumps(event_filter, indent=4))
+def parse_flow_listener(workspace: str, flow_path: str, flow: dict) -> dict | None:
+    try:
+        if not flow["value"].get("modules", []):
+            LOGGER.debug("Flow %s has no modules in it, skipping,", flow_path)
+            return None
+        first_module = flow["value"]["modules"][0]
+        if (
+            first_module.get("summary", "") != "CORE:LISTEN_TO_EVENT"
+            or first_module["value"]["input_transforms"]["events"]["type"] != "static"
+            or first_module["value"]["input_transforms"]["filters"]["type"] != "static"
+        ):
+            return None
+        input_transforms = first_module["value"]["input_transforms"]
+        return {
+            "webhook": get_flow_webhook(workspace, flow_path),
+            "filters": input_transforms["filters"]["value"],
+            # Remove backslashes from the beginning to yield canonical reference
+            "events": [event[1:] if event.startswith("\\") else event for event in input_transforms["events"]["value"]],
+        }
+    except (KeyError, TypeError, AttributeError):
+        LOGGER.exception("Flow %s has unexpected structure, skipping", flow_path)
+        return None
+
+
+def get_nextcloud_client() -> AsyncNextcloudApp:
+    """Returns the Nextcloud client shared by the webhooks sync, so all its requests reuse the same connections."""
+    global NEXTCLOUD_CLIENT
+    if NEXTCLOUD_CLIENT is None:
+        NEXTCLOUD_CLIENT = AsyncNextcloudApp()
+    return NEXTCLOUD_CLIENT
+
+
+async def nextcloud_call(name: str, coro: typing.Awaitable) -> typing.Any:
+    stats = NEXTCLOUD_STATS.setdefault(name, {"calls": 0, "errors": 0, "time": 0.0})
+    stats["calls"] += 1
+    start_time = perf_counter()
     try:
-        r = NextcloudApp().webhooks.register(
+        return await coro
+    except Exception:
+        stats["errors"] += 1
+        raise
+    finally:
+        stats["time"] += perf_counter() - start_time
+
+
+async def get_nextcloud_enabled_state() -> bool:
+    if monotonic() - NEXTCLOUD_ENABLED_STATE["time"] > NEXTCLOUD_ENABLED_STATE_TTL:
+        NEXTCLOUD_ENABLED_STATE["value"] = await nextcloud_call("enabled_state", get_nextcloud_client().enabled_state)
+        NEXTCLOUD_ENABLED_STATE["time"] = monotonic()
+    return NEXTCLOUD_ENABLED_STATE["value"]
+
+
+async def register_listener(event, event_filter, webhook, token: str) -> dict:
+    LOGGER.debug("%s - %s: %s", webhook, event, LazyJSON(event_filter))
+    r = await nextcloud_call(
+        "register_listener",
+        get_nextcloud_client().webhooks.register(
             "POST",
             webhook,
             event,
             event_filter=event_filter,
             auth_method="header",
             auth_data={"Authorization": f"Bearer {token}"},
-        )
-    except NextcloudException:
-        LOGGER.exception("Exception during registering webhook", stack_info=True)
-        return {}
-    LOGGER.debug(json.dumps(r._raw_data, indent=4))  # noqa
+        ),
+    )
+    LOGGER.debug("%s", LazyJSON(r._raw_data))  # noqa
     return r._raw_data  # noqa
 
 
-def update_listener(registered_listener: dict, event_filter, token: str) -> dict:
-    LOGGER.debug(
-        "%s - %s: %s", registered_listener["uri"], registered_listener["event"], json.dumps(event_filter, indent=4)
-    )
-    try:
-        r = NextcloudApp().webhooks.update(
+async def update_listener(registered_listener: dict, event_filter, token: str) -> dict:
+    LOGGER.debug("%s - %s: %s", registered_listener["uri"], registered_listener["event"], LazyJSON(event_filter))
+    r = await nextcloud_call(
+        "update_listener",
+        get_nextcloud_client().webhooks.update(
             registered_listener["id"],
             "POST",
             registered_listener["uri"],
@@ -490,33 +3193,33 @@ def update_listener(registered_listener: dict, event_filter, token: str) -> dict
             event_filter=event_filter,
             auth_method="header",
             auth_data={"Authorization": f"Bearer {token}"},
-        )
-    except NextcloudException:
-        LOGGER.exception("Exception during updating webhook", stack_info=True)
-        return {}
-    LOGGER.debug(json.dumps(r._raw_data, indent=4))  # noqa
+        ),
+    )
+    LOGGER.debug("%s", LazyJSON(r._raw_data))  # noqa
     return r._raw_data  # noqa
 
 
-def get_registered_listeners():
-    nc = NextcloudApp()
-    r = nc.ocs("GET", "/ocs/v1.php/apps/webhook_listeners/api/v1/webhooks")
-    for i in r:  # we need the same format as in `get_expected_listeners(workspace, token, flow_paths)`
+async def get_registered_listeners():
+    r = await nextcloud_call(
+        "get_registered_listeners",
+        get_nextcloud_client().ocs("GET", "/ocs/v1.php/apps/webhook_listeners/api/v1/webhooks"),
+    )
+    for i in r:  # we need the same format as in `parse_flow_listener(workspace, flow_path, flow)`
         if not i["eventFilter"]:
             i["eventFilter"] = None  # replace [] with None
     return r
 
 
-def delete_listener(registered_listener: dict) -> bool:
-    r = NextcloudApp().webhooks.unregister(registered_listener["id"])
+async def delete_listener(registered_listener: dict) -> bool:
+    r = await nextcloud_call("delete_listener", get_nextcloud_client().webhooks.unregister(registered_listener["id"]))
     if r:
         LOGGER.debug("removed registered listener with id=%d", registered_listener["id"])
     return r
 
 
-def create_nextcloud_auth_variable() -> bool:
-    r = httpx.post(
-        url="http://127.0.0.1:8000/api/w/nextcloud/variables/create",
+async def create_nextcloud_auth_variable() -> bool:
+    r = await get_upstream_client().post(
+        url="/api/w/nextcloud/variables/create",
         cookies={"token": USERS_STORAGE["admin@windmill.dev"]["token"]},
         json={
             "path": "u/admin/exapp_token",
@@ -532,9 +3235,9 @@ def create_nextcloud_auth_variable() -> bool:
     return True
 
 
-def update_nextcloud_auth_variable() -> bool:
-    r = httpx.post(
-        url="http://127.0.0.1:8000/api/w/nextcloud/variables/update/u/admin/exapp_token",
+async def update_nextcloud_auth_variable() -> bool:
+    r = await get_upstream_client().post(
+        url="/api/w/nextcloud/variables/update/u/admin/exapp_token",
         cookies={"token": USERS_STORAGE["admin@windmill.dev"]["token"]},
         json={"value": os.environ["APP_SECRET"]},
     )
@@ -544,9 +3247,9 @@ def update_nextcloud_auth_variable() -> bool:
     return True
 
 
-def create_nextcloud_auth_resource() -> bool:
-    r = httpx.post(
-        url="http://127.0.0.1:8000/api/w/nextcloud/resources/create",
+async def create_nextcloud_auth_resource() -> bool:
+    r = await get_upstream_client().post(
+        url="/api/w/nextcloud/resources/create",
         cookies={"token": USERS_STORAGE["admin@windmill.dev"]["token"]},
         json={
             "path": "u/admin/exapp_resource",
@@ -562,9 +3265,10 @@ def create_nextcloud_auth_resource() -> bool:
     return True
 
 
-def create_nextcloud_resource():
-    r = httpx.get(
-        url="http://127.0.0.1:8000/api/w/nextcloud/variables/exists/u/admin/exapp_token",
+async def ensure_nextcloud_auth_variable() -> None:
+    client = get_upstream_client()
+    r = await client.get(
+        url="/api/w/nextcloud/variables/exists/u/admin/exapp_token",
         cookies={"token": USERS_STORAGE["admin@windmill.dev"]["token"]},
     )
     if r.status_code >= 400:
@@ -572,35 +3276,42 @@ def create_nextcloud_resource():
         return
     if r.text.lower() == "false":
         LOGGER.info("Creating Nextcloud Auth variable")
-        if create_nextcloud_auth_variable() is False:
-            return
-    else:
-        r = httpx.get(
-            url="http://127.0.0.1:8000/api/w/nextcloud/variables/get_value/u/admin/exapp_token",
-            cookies={"token": USERS_STORAGE["admin@windmill.dev"]["token"]},
-        )
-        if r.status_code >= 400:
-            LOGGER.critical("Can not get Nextcloud Auth Variable value: %s %s", r.status_code, r.text)
-            return
-        if r.text != os.environ["APP_SECRET"]:
-            LOGGER.info("Updating Nextcloud Auth variable")
-            if update_nextcloud_auth_variable() is False:
-                return
+        await create_nextcloud_auth_variable()
+        return
+    r = await client.get(
+        url="/api/w/nextcloud/variables/get_value/u/admin/exapp_token",
+        cookies={"token": USERS_STORAGE["admin@windmill.dev"]["token"]},
+    )
+    if r.status_code >= 400:
+        LOGGER.critical("Can not get Nextcloud Auth Variable value: %s %s", r.status_code, r.text)
+        return
+    if r.text != os.environ["APP_SECRET"]:
+        LOGGER.info("Updating Nextcloud Auth variable")
+        await update_nextcloud_auth_variable()
+
 
-    r = httpx.get(
-        url="http://127.0.0.1:8000/api/w/nextcloud/resources/exists/u/admin/exapp_resource",
+async def ensure_nextcloud_auth_resource() -> None:
+    r = await get_upstream_client().get(
+        url="/api/w/nextcloud/resources/exists/u/admin/exapp_resource",
         cookies={"token": USERS_STORAGE["admin@windmill.dev"]["token"]},
     )
     if r.status_code >= 400:
         LOGGER.critical("Can not check for Nextcloud Auth Resource: %s %s", r.status_code, r.text)
+        return
     if r.text.lower() == "false":
         LOGGER.info("Creating Nextcloud Auth Resource")
-        create_nextcloud_auth_resource()
+        await create_nextcloud_auth_resource()
+
+
+async def create_nextcloud_resource() -> None:
+    # The resource only refers to the variable by its path, so both can be checked at the same time.
+    await asyncio.gather(ensure_nextcloud_auth_variable(), ensure_nextcloud_auth_resource())
 
 
 if __name__ == "__main__":
-    initialize_windmill()
-    create_nextcloud_resource()
     # Current working dir is set for the Service we are wrapping, so change we first for ExApp default one
     os.chdir(Path(__file__).parent)
-    run_app(APP, log_level="info")  # Calling wrapper around `uvicorn.run`.
+    # Worker processes import the application by its name.
+    run_app(
+        "main:APP" if EXAPP_WORKERS > 1 else APP, log_level="info", workers=EXAPP_WORKERS
+    )  # Calling wrapper around `uvicorn.run`.
@@ -0,0 +1,123 @@
+"""Tunes the embedded PostgreSQL to the container limits and to the connection pools of Windmill.
+
+Runs from ``init_pgsql.sh`` before PostgreSQL and Windmill start. The settings are written to ``postgresql.auto.conf``,
+the file of ``ALTER SYSTEM``, other settings already in it are kept.
+
+    python3 tune_pgsql.py --data-dir /nc_app_flow_data/pgsql
+    python3 tune_pgsql.py --dry-run
+"""
+
+import argparse
+import contextlib
+import os
+import sys
+from pathlib import Path
+
+from container_limits import get_cpu_limit, get_memory_limit
+
+MB = 1024 * 1024
+WINDMILL_WORKERS_AUTOSCALE = os.environ.get("WINDMILL_WORKERS_AUTOSCALE", "0").lower() in ("1", "true", "yes")
+PGSQL_MEMORY_SHARE = float(os.environ.get("PGSQL_MEMORY_SHARE", "0.25"))  # the rest is left to Windmill and its jobs
+# Pool sizes of Windmill processes when DATABASE_CONNECTIONS is not set: the standalone process (server and NUM_WORKERS
+# workers) and each `MODE=worker` process started by the ExApp autoscaling.
+WINDMILL_SERVER_CONNECTIONS = 50
+WINDMILL_WORKER_CONNECTIONS = 5
+RESERVED_CONNECTIONS = 10  # superuser_reserved_connections, psql and backups
+AUTO_CONF_HEADER = "# Do not edit this file manually!\n# It will be overwritten by the ALTER SYSTEM command.\n"
+
+
+def get_num_workers() -> int:
+    """Workers of the standalone Windmill process, same default as in ``set_workers_num.sh``."""
+    if num_workers := os.environ.get("NUM_WORKERS"):
+        return int(num_workers)
+    if WINDMILL_WORKERS_AUTOSCALE:
+        return 1
+    return len(os.sched_getaffinity(0)) * 2
+
+
+def plan_connections(cpus: float) -> dict[str, int]:
+    """Connections needed by each component, their sum is used as ``max_connections``."""
+    num_workers = get_num_workers()
+    pool_size = int(os.environ.get("DATABASE_CONNECTIONS", "0"))
+    connections = {"windmill": pool_size or WINDMILL_SERVER_CONNECTIONS + num_workers}
+    if WINDMILL_WORKERS_AUTOSCALE:
+        max_workers = int(os.environ.get("WINDMILL_WORKERS_MAX", "0")) or max(int(cpus * 2), num_workers)
+        connections["autoscaled_workers"] = (max_workers - num_workers) * (pool_size or WINDMILL_WORKER_CONNECTIONS)
+    connections["reserved"] = RESERVED_CONNECTIONS
+    return connections
+
+
+def plan_settings(cpus: float, memory: int, max_connections: int) -> dict[str, str]:
+    """Settings for ``memory`` bytes and ``cpus`` CPUs of the container, of which PostgreSQL gets its share."""
+    pgsql_memory = memory * PGSQL_MEMORY_SHARE
+    shared_buffers = min(max(pgsql_memory * 0.4, 32 * MB), 8192 * MB)
+    maintenance_work_mem = min(max(pgsql_memory * 0.05, 16 * MB), 1024 * MB)
+    # A query may use several work_mem buffers, so only half of the connections are expected to use one at a time.
+    work_mem = (pgsql_memory - shared_buffers - maintenance_work_mem) * 2 / max_connections
+    work_mem = min(max(work_mem, 1 * MB), 64 * MB)
+    cpus = max(int(cpus), 1)
+    return {
+        "max_connections": str(max_connections),
+        "shared_buffers": f"{int(shared_buffers // MB)}MB",
+        "effective_cache_size": f"{int(max(memory * 0.5, shared_buffers) // MB)}MB",
+        "work_mem": f"{int(work_mem // 1024)}kB",
+        "maintenance_work_mem": f"{int(maintenance_work_mem // MB)}MB",
+        "max_wal_size": "2GB" if memory >= 8192 * MB else "1GB",
+        "max_worker_processes": str(max(cpus, 8)),
+        "max_parallel_workers": str(cpus),
+        "max_parallel_workers_per_gather": str(min(cpus // 2, 4)),
+        "max_parallel_maintenance_workers": str(min(cpus // 2, 4)),
+    }
+
+
+def write_auto_conf(path: Path, settings: dict[str, str]) -> None:
+    """Replaces ``settings`` in ``postgresql.auto.conf`` the way ``ALTER SYSTEM`` would, keeping its owner."""
+    lines = []
+    if path.exists():
+        for line in path.read_text(encoding="utf-8").splitlines():
+            if line.startswith("#") or line.split("=", 1)[0].strip() not in settings:
+                lines.append(line)
+    else:
+        lines = AUTO_CONF_HEADER.splitlines()
+    lines += [f"{name} = '{value}'" for name, value in settings.items()]
+    owner = (path if path.exists() else path.parent).stat()
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    tmp_path.chmod(0o600)
+    with contextlib.suppress(PermissionError):
+        os.chown(tmp_path, owner.st_uid, owner.st_gid)
+    tmp_path.replace(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", type=Path, help="PostgreSQL data directory")
+    parser.add_argument("--dry-run", action="store_true", help="only print the settings")
+    args = parser.parse_args()
+    if not args.dry_run and not args.data_dir:
+        parser.error("--data-dir is required without --dry-run")
+    cpus, memory = get_cpu_limit(), get_memory_limit()
+    if not memory:
+        print("PostgreSQL tuning skipped: the memory limit is unknown.")
+        return
+    connections = plan_connections(cpus)
+    settings = plan_settings(cpus, memory, sum(connections.values()))
+    print(
+        f"PostgreSQL tuning for {cpus:g} CPUs and {memory // MB} MiB of memory,"
+        f" {int(memory * PGSQL_MEMORY_SHARE // MB)} MiB of it for PostgreSQL:"
+    )
+    print("  connections: " + ", ".join(f"{name} {value}" for name, value in connections.items()))
+    for name, value in settings.items():
+        print(f"  {name} = '{value}'")
+    if args.dry_run:
+        print("Dry run, nothing was written.")
+        return
+    try:
+        write_auto_conf(args.data_dir.joinpath("postgresql.auto.conf"), settings)
+    except OSError as e:
+        sys.exit(f"PostgreSQL tuning failed: {e}")
+    print(f"Written to {args.data_dir.joinpath('postgresql.auto.conf')}")
+
+
+if __name__ == "__main__":
+    main()
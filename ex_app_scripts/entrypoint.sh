@@ -12,9 +12,10 @@ else
     echo "$HOSTNAME is already in /etc/hosts"
 fi
 
-# Execute the custom scripts
-/ex_app_scripts/init_pgsql.sh
+# Execute the custom scripts, the number of workers is needed to tune PostgreSQL
 /ex_app_scripts/set_workers_num.sh
+. /etc/environment
+/ex_app_scripts/init_pgsql.sh
 
 # Reloading environment variables to reflect changes if were
 . /etc/environment
@@ -50,6 +50,19 @@ else
         sudo -u postgres ${PG_BIN}/initdb -D "$DATA_DIR"
     fi
 
+    # Fit PostgreSQL memory and connections to the container and to Windmill, PGSQL_TUNING=dry-run only prints them
+    case "${PGSQL_TUNING:-1}" in
+        0|false|no)
+            echo "PostgreSQL tuning is disabled."
+            ;;
+        dry-run)
+            python3 /ex_app/lib/tune_pgsql.py --dry-run
+            ;;
+        *)
+            python3 /ex_app/lib/tune_pgsql.py --data-dir "$DATA_DIR"
+            ;;
+    esac
+
     echo "Starting PostgreSQL..."
     sudo -u postgres ${PG_BIN}/pg_ctl -D "$DATA_DIR" -l "${DATA_DIR}/logfile" start
 
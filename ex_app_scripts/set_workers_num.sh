@@ -1,8 +1,16 @@
 #!/bin/bash
 
 if [ -z "$NUM_WORKERS" ]; then
-     NUM_WORKERS=$(nproc)
-     NUM_WORKERS=$((NUM_WORKERS * 2))
+    case "$WINDMILL_WORKERS_AUTOSCALE" in
+        1|true|yes)
+            # With autoscaling NUM_WORKERS is the minimum, the ExApp adds workers when jobs wait in the queue
+            NUM_WORKERS=1
+            ;;
+        *)
+            NUM_WORKERS=$(nproc)
+            NUM_WORKERS=$((NUM_WORKERS * 2))
+            ;;
+    esac
 
     # Check if NUM_WORKERS is already in /etc/environment, if not, add it
     if ! grep -q "^export NUM_WORKERS=" /etc/environment; then
@@ -13,3 +21,16 @@ if [ -z "$NUM_WORKERS" ]; then
 else
     echo "NUM_WORKERS is already set to: $NUM_WORKERS"
 fi
+
+if [ -z "$EXAPP_WORKERS" ]; then
+    EXAPP_WORKERS=1
+
+    # Check if EXAPP_WORKERS is already in /etc/environment, if not, add it
+    if ! grep -q "^export EXAPP_WORKERS=" /etc/environment; then
+        echo "export EXAPP_WORKERS=\"$EXAPP_WORKERS\"" >> /etc/environment
+    fi
+
+    echo "EXAPP_WORKERS was not set. It is now set to: $EXAPP_WORKERS"
+else
+    echo "EXAPP_WORKERS is already set to: $EXAPP_WORKERS"
+fi
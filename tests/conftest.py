@@ -0,0 +1,23 @@
+"""ExApp configuration is read on import of `main`, so it is set here before the tests import it."""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+STORAGE_DIR = tempfile.mkdtemp(prefix="flow-tests-")
+os.environ.update(
+    {
+        "APP_ID": "flow",
+        "APP_SECRET": "tests",
+        "APP_VERSION": "1.0.0",
+        "APP_PORT": "23000",
+        "AA_VERSION": "3.0.0",
+        "APP_PERSISTENT_STORAGE": STORAGE_DIR,
+        "NEXTCLOUD_URL": "http://127.0.0.1:18099",
+        "WINDMILL_URL": "http://127.0.0.1:18000",
+    }
+)
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR.joinpath("ex_app", "lib")))
+sys.path.insert(0, str(ROOT_DIR.joinpath("benchmarks")))
@@ -0,0 +1,50 @@
+import asyncio
+
+import pytest
+
+import main
+
+
+def run_admission(scenario):
+    async def _run():
+        controller = main.AdmissionController(10, 2, 100, main.ADMISSION_CLASSES)
+        return await scenario(controller)
+
+    return asyncio.run(_run())
+
+
+def test_user_at_limit_does_not_block_others():
+    async def _scenario(controller):
+        await controller.acquire("interactive", "alice", 1)
+        await controller.acquire("interactive", "alice", 1)
+        alice_waiting = asyncio.create_task(controller.acquire("interactive", "alice", 0.2))
+        await asyncio.sleep(0)
+        await controller.acquire("interactive", "bob", 0.1)
+        with pytest.raises(main.AdmissionRejectedError):
+            await alice_waiting
+        return controller
+
+    controller = run_admission(_scenario)
+    assert controller.user_in_flight == {"alice": 2, "bob": 1}
+    assert controller.get_stats()["interactive"]["waiting"] == 0
+
+
+def test_users_take_turns_within_class():
+    async def _scenario(controller):
+        controller.limits["interactive"] = 1
+        admitted = []
+
+        async def _request(user):
+            await controller.acquire("interactive", user, 1)
+            admitted.append(user)
+
+        await controller.acquire("interactive", "carol", 1)
+        tasks = [asyncio.create_task(_request(i)) for i in ("alice", "alice", "bob")]
+        await asyncio.sleep(0)
+        for user in ("carol", "alice", "bob"):
+            controller.release("interactive", user)
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        return admitted
+
+    assert run_admission(_scenario) == ["alice", "bob", "alice"]
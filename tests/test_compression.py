@@ -0,0 +1,66 @@
+import asyncio
+import gzip
+import zlib
+
+import brotli
+import pytest
+import zstandard
+
+import main
+
+DATA = b'{"items": [1, 2, 3]}' * 300
+DECOMPRESSORS = {
+    "gzip": lambda: zlib.decompressobj(31).decompress,
+    "br": lambda: brotli.Decompressor().process,
+    "zstd": lambda: zstandard.ZstdDecompressor().decompressobj().decompress,
+}
+
+
+def test_all_encodings_are_available():
+    assert main.PROXY_COMPRESSION_ENCODINGS == ("zstd", "br", "gzip")
+
+
+@pytest.mark.parametrize(
+    ("encoding", "decompress"),
+    [
+        ("gzip", gzip.decompress),
+        ("br", brotli.decompress),
+        ("zstd", lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data)),
+    ],
+)
+def test_compressors_round_trip(encoding, decompress):
+    compress, _, finish = main.create_compressor(encoding)
+    data = b"".join(compress(DATA[i : i + 1000]) for i in range(0, len(DATA), 1000)) + finish()
+    assert decompress(data) == DATA
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+def test_streamed_chunks_are_flushed(encoding):
+    async def upstream():
+        yield b'{"logs": "first"}'
+        yield b'{"logs": "second"}'
+
+    async def read_chunks():
+        decompress = DECOMPRESSORS[encoding]()
+        return [decompress(chunk) async for chunk in main._iter_compressed(upstream(), encoding)]
+
+    # Every chunk can be decompressed as soon as it is received, without waiting for the end of the stream.
+    assert asyncio.run(read_chunks())[:2] == [b'{"logs": "first"}', b'{"logs": "second"}']
+
+
+def test_streams_over_budget_wait_for_next_window(monkeypatch):
+    async def upstream():
+        yield DATA
+        main.COMPRESSION_BUDGET["used"] = main.PROXY_COMPRESSION_CPU_BUDGET  # spent by other responses
+        yield DATA
+
+    async def read_chunks():
+        return [chunk async for chunk in main._iter_compressed(upstream(), "gzip")]
+
+    monkeypatch.setitem(main.COMPRESSION_BUDGET, "window_start", main.monotonic())
+    monkeypatch.setitem(main.COMPRESSION_BUDGET, "used", 0.0)
+    throttled = main.COMPRESSION_STATS["throttled"]
+    start_time = main.monotonic()
+    assert gzip.decompress(b"".join(asyncio.run(read_chunks()))) == DATA * 2
+    assert main.monotonic() - start_time >= 0.9
+    assert main.COMPRESSION_STATS["throttled"] == throttled + 1
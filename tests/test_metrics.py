@@ -0,0 +1,17 @@
+import main
+
+
+def test_proxy_route_labels_are_bounded():
+    assert main.get_proxy_route("/api/w/nextcloud/jobs/list") == "api/w/jobs"
+    assert main.get_proxy_route("/api/w/nextcloud/random_123/x") == "api/w/other"
+    assert main.get_proxy_route("/api/version") == "api/version"
+    assert main.get_proxy_route("/api/random_123") == "api/other"
+    assert main.get_proxy_route("/ws_mp/abc") == "ws_mp"
+    assert main.get_proxy_route("/user/login") == "frontend"
+
+
+def test_label_values_are_escaped():
+    counter = main.Counter("flow_test_escaping", "Test.", ("route",))
+    counter.inc('a"b\\c\nd')
+    assert 'flow_test_escaping_total{route="a\\"b\\\\c\\nd"} 1.0' in main.render_metrics()
+    main.METRICS.remove(counter)
@@ -0,0 +1,26 @@
+import asyncio
+
+import main
+
+
+def test_resumes_after_last_provisioned_user(monkeypatch):
+    provisioned = []
+
+    async def get_nextcloud_user_ids():
+        # "aaron" was added and "bella", the last provisioned user, was removed since the checkpoint.
+        return ["aaron", "alice", "bob", "carol", "dave"]
+
+    async def ensure_windmill_user(user_name, create_missing_user):
+        provisioned.append(user_name)
+        return True
+
+    monkeypatch.setattr(main, "get_nextcloud_user_ids", get_nextcloud_user_ids)
+    monkeypatch.setattr(main, "ensure_windmill_user", ensure_windmill_user)
+    monkeypatch.setitem(main.STARTUP_STATE, "stage", "ready")
+    monkeypatch.setattr(main, "PREPROVISION_PAGE_SIZE", 1)
+    main.USERS_STORAGE.set_preprovision_progress("group:admin", "bella")
+
+    asyncio.run(main.preprovision_users())
+    assert provisioned == ["wapp_bob", "wapp_carol", "wapp_dave"]
+    assert main.PREPROVISION_STATE["done"] == 5
+    assert main.USERS_STORAGE.get_preprovision_progress("group:admin") == ""
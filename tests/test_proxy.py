@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+import httpx
+import pytest
+from starlette.requests import ClientDisconnect
+
+import main
+
+
+class UpstreamStream(httpx.AsyncByteStream):
+    def __init__(self):
+        self.closed = False
+
+    async def __aiter__(self):
+        yield b"body"
+
+    async def aclose(self):
+        self.closed = True
+
+
+def test_upstream_response_closed_when_client_is_gone():
+    stream = UpstreamStream()
+    upstream = httpx.Response(200, stream=stream)
+
+    async def _receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def _send(message):
+        raise OSError("client disconnected")
+
+    response = main.UpstreamStreamingResponse(upstream, status_code=200)
+    with pytest.raises(ClientDisconnect):
+        asyncio.run(response({"type": "http", "asgi": {"spec_version": "2.4"}}, _receive, _send))
+    assert stream.closed
+
+
+def test_upstream_response_closed_after_body():
+    stream = UpstreamStream()
+    upstream = httpx.Response(200, stream=stream)
+    messages = []
+
+    async def _receive():
+        await asyncio.sleep(10)
+
+    async def _send(message):
+        messages.append(message)
+
+    asyncio.run(main.UpstreamStreamingResponse(upstream, status_code=200)({"type": "http"}, _receive, _send))
+    assert b"".join(i.get("body", b"") for i in messages) == b"body"
+    assert stream.closed
+
+
+def test_debug_logs_are_off_by_default():
+    # Arguments of debug lines, such as `LazyJSON`, are then never formatted on the request path.
+    assert not main.LOGGER.isEnabledFor(logging.DEBUG)
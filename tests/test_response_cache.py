@@ -0,0 +1,31 @@
+import asyncio
+from time import monotonic
+
+import main
+
+
+def cache_whoami(key: str) -> None:
+    main.RESPONSE_CACHE.set(key, main.CachedResponse("whoami", monotonic(), monotonic() + 60, 200, {}, b"{}", ""))
+
+
+def test_invalidations_of_other_workers_are_applied(monkeypatch):
+    monkeypatch.setattr(main, "EXAPP_WORKERS", 2)
+    asyncio.run(main.sync_response_cache_invalidations())
+    cache_whoami("whoami-of-user")
+
+    main.RESPONSE_CACHE_GENERATIONS.bump(["whoami"])  # a user change proxied by another worker
+    asyncio.run(main.sync_response_cache_invalidations())
+    assert main.RESPONSE_CACHE.get("whoami-of-user") is not None  # checked at most once per sync interval
+
+    main.RESPONSE_CACHE_SYNC["checked"] = 0.0
+    asyncio.run(main.sync_response_cache_invalidations())
+    assert main.RESPONSE_CACHE.get("whoami-of-user") is None
+
+
+def test_own_invalidations_are_not_applied_twice(monkeypatch):
+    monkeypatch.setattr(main, "EXAPP_WORKERS", 2)
+    asyncio.run(main.invalidate_cached_responses("/api/users/update/someone"))
+    cache_whoami("whoami-of-user")
+    main.RESPONSE_CACHE_SYNC["checked"] = 0.0
+    asyncio.run(main.sync_response_cache_invalidations())
+    assert main.RESPONSE_CACHE.get("whoami-of-user") is not None
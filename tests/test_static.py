@@ -0,0 +1,26 @@
+import asyncio
+
+from starlette.requests import Request
+from starlette.responses import FileResponse
+
+import main
+
+
+def _request(path: str) -> Request:
+    return Request({"type": "http", "method": "GET", "path": f"/{path}", "headers": [], "query_string": b""})
+
+
+def test_frontend_served_from_disk_until_indexed(tmp_path, monkeypatch):
+    tmp_path.joinpath("_app").mkdir()
+    tmp_path.joinpath("_app", "start.js").write_text("console.log('start');" * 100)
+    monkeypatch.setattr(main, "STATIC_FRONTEND_PATH", tmp_path)
+    monkeypatch.setattr(main, "STATIC_ASSETS", {})
+
+    response = asyncio.run(main.proxy_frontend_requests(_request("_app/start.js"), "_app/start.js"))
+    assert isinstance(response, FileResponse)
+    assert response.path == tmp_path.joinpath("_app", "start.js")
+    assert main.get_unindexed_static_file("../etc/passwd") is None
+
+    asyncio.run(main.load_static_assets_index())
+    assert list(main.STATIC_ASSETS) == ["_app/start.js"]
+    assert "gzip" in main.STATIC_ASSETS["_app/start.js"].encodings
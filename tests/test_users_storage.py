@@ -0,0 +1,20 @@
+import main
+
+
+def test_users_changed_by_other_workers_are_reread(tmp_path):
+    db_path = tmp_path.joinpath("storage.db")
+    storage = main.SQLiteUsersStorage(db_path)
+    other_worker_storage = main.SQLiteUsersStorage(db_path)
+    assert not storage.reload_changed()
+
+    other_worker_storage.set("wapp_alice@windmill.dev", "password", "token1")
+    assert "wapp_alice@windmill.dev" not in storage  # lookups never query the database
+    assert storage.reload_changed()
+    assert storage["wapp_alice@windmill.dev"] == {"password": "password", "token": "token1", "persistent": False}
+
+    other_worker_storage.set("wapp_alice@windmill.dev", "password", "token2", True)
+    assert storage.reload_changed()
+    assert storage["wapp_alice@windmill.dev"] == {"password": "password", "token": "token2", "persistent": True}
+    assert not storage.reload_changed()
+    storage.set("wapp_bob@windmill.dev", "password", "token3")
+    assert not storage.reload_changed()  # own changes are already in memory
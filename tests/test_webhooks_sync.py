@@ -0,0 +1,46 @@
+import asyncio
+
+import httpx
+import stub_windmill
+
+import main
+
+
+def test_expected_listeners_do_not_change_flows_cache(monkeypatch):
+    stub_windmill.FLOWS.clear()
+    for i in range(10):
+        stub_windmill.FLOWS[f"f/test/flow{i}"] = {
+            "edited_at": "2024-10-10T00:00:00Z",
+            **stub_windmill._flow_definition(i),
+        }
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub_windmill.APP), base_url="http://windmill")
+    monkeypatch.setattr(main, "UPSTREAM_CLIENT", client)
+    cached_paths = main.FLOWS_CACHE.paths()
+
+    listeners, failed_webhooks = asyncio.run(main.get_expected_listeners("nextcloud", "token"))
+    assert len(listeners) == 4  # every third flow listens to an event
+    assert not failed_webhooks
+    assert main.FLOWS_CACHE.paths() == cached_paths
+
+
+def test_archived_flow_listener_is_removed(monkeypatch):
+    stub_windmill.FLOWS.clear()
+    for i in range(4):
+        stub_windmill.FLOWS[f"f/test/archive{i}"] = {
+            "edited_at": "2024-10-10T00:00:00Z",
+            **stub_windmill._flow_definition(i),
+        }
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub_windmill.APP), base_url="http://windmill")
+    monkeypatch.setattr(main, "UPSTREAM_CLIENT", client)
+    listeners, _ = asyncio.run(main.refresh_flows_cache("nextcloud", "token"))
+    assert [i["webhook"] for i in listeners] == [
+        "/api/w/nextcloud/jobs/run/f/f/test/archive0",
+        "/api/w/nextcloud/jobs/run/f/f/test/archive3",
+    ]
+
+    # Windmill still returns an archived flow from `flows/get`, it is only hidden from `flows/list`.
+    stub_windmill.FLOWS["f/test/archive0"]["archived"] = True
+    listeners, failed_webhooks = asyncio.run(main.refresh_flows_cache_paths("nextcloud", "token", {"f/test/archive0"}))
+    assert [i["webhook"] for i in listeners] == ["/api/w/nextcloud/jobs/run/f/f/test/archive3"]
+    assert not failed_webhooks
+    assert "f/test/archive0" not in main.FLOWS_CACHE.paths()
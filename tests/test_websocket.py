@@ -0,0 +1,82 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+import pytest
+from starlette.applications import Starlette
+from starlette.routing import WebSocketRoute
+from starlette.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import main
+
+STUB_SCRIPT = Path(__file__).resolve().parent.parent.joinpath("benchmarks", "stub_windmill.py")
+STUB_PORT = 18123
+
+
+@pytest.fixture(scope="module")
+def stub_windmill_url():
+    process = subprocess.Popen([sys.executable, str(STUB_SCRIPT), "--port", str(STUB_PORT)])  # noqa: S603
+    url = f"http://127.0.0.1:{STUB_PORT}"
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"{url}/docs", timeout=1)
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@pytest.fixture
+def client(stub_windmill_url, monkeypatch):
+    monkeypatch.setattr(main, "WINDMILL_URL", stub_windmill_url)
+
+    async def _proxy(websocket):
+        await main.proxy_websocket_to_windmill(websocket, websocket.path_params["path"])
+
+    with TestClient(Starlette(routes=[WebSocketRoute("/{path:path}", _proxy)])) as test_client:
+        yield test_client
+
+
+def test_messages_are_proxied_with_the_token(client):
+    client.cookies.set("token", "abc")
+    with client.websocket_connect("/ws/echo") as websocket:
+        websocket.send_text("hello")
+        assert websocket.receive_text() == "hello abc"
+        websocket.send_bytes(b"\x00\x01")
+        assert websocket.receive_bytes() == b"\x00\x01"
+
+
+def test_upstream_close_code_is_passed_on(client):
+    with client.websocket_connect("/ws/echo") as websocket:
+        websocket.send_text("close")
+        with pytest.raises(WebSocketDisconnect) as e:
+            websocket.receive_text()
+    assert e.value.code == 4000
+
+
+def test_idle_connection_is_closed(client, monkeypatch):
+    monkeypatch.setattr(main, "WEBSOCKET_IDLE_TIMEOUT", 0.2)
+    with client.websocket_connect("/ws/echo") as websocket, pytest.raises(WebSocketDisconnect) as e:
+        websocket.receive_text()
+    assert e.value.code == 1001
+
+
+def test_forwarding_errors_are_logged(client, monkeypatch, caplog):
+    monkeypatch.setitem(main.WEBSOCKET_STATS, "failed", 0)
+
+    async def _broken_forwarder(*_args):
+        raise ValueError("bug")
+
+    monkeypatch.setattr(main, "_forward_websocket_client", _broken_forwarder)
+    with client.websocket_connect("/ws/echo") as websocket, pytest.raises(WebSocketDisconnect) as e:
+        websocket.receive_text()
+    assert e.value.code == 1011
+    assert "forwarding failed" in caplog.text
+    assert main.WEBSOCKET_STATS["failed"] == 1
@@ -0,0 +1,65 @@
+import asyncio
+import sys
+
+import httpx
+import stub_windmill
+
+import main
+
+
+def test_workers_follow_stub_queue(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(main, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(main, "WINDMILL_WORKER_COMMAND", [sys.executable, "-c", "import time; time.sleep(60)"])
+    monkeypatch.setattr(main, "WINDMILL_BASE_WORKERS", 1)
+    for key, value in {
+        "base_workers": 1,
+        "max_workers": 3,
+        "busy_samples": 0,
+        "idle_samples": 0,
+        "changed": 0.0,
+    }.items():
+        monkeypatch.setitem(main.WORKERS_SCALING_STATE, key, value)
+
+    async def _token(_user_email):
+        return "token"
+
+    monkeypatch.setattr(main, "get_valid_user_token", _token)
+
+    async def _scenario():
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=stub_windmill.APP), base_url="http://windmill")
+        main.UPSTREAM_CLIENT = client
+        workers = []
+
+        async def _sample(samples: int = 1):
+            for _ in range(samples):
+                clock[0] += main.WORKERS_SCALING_INTERVAL
+                queued, wait_time = await main.get_windmill_queue_state("nextcloud")
+                await main.apply_workers_scaling(main.WorkersScalingSample(queued, wait_time, 0.1, 2**40))
+                workers.append(main.WORKERS_SCALING_STATE["workers"])
+
+        try:
+            await client.post("/_bench/queue", json={"count": 10, "wait": 20})
+            await _sample(main.WORKERS_SCALE_UP_SAMPLES)
+            assert workers[-2:] == [1, 2]  # added after WORKERS_SCALE_UP_SAMPLES busy samples
+            await _sample(int(main.WORKERS_SCALING_COOLDOWN // main.WORKERS_SCALING_INTERVAL) - 1)
+            assert workers[-1] == 2  # cooldown
+            await _sample(10)
+            assert workers[-1] == 3  # WINDMILL_WORKERS_MAX
+            assert len(main.WINDMILL_WORKER_PROCESSES) == 2
+
+            await client.post("/_bench/queue", json={"count": 0})
+            await _sample(main.WORKERS_SCALE_DOWN_SAMPLES - 1)
+            assert workers[-1] == 3
+            await _sample(1)
+            assert workers[-1] == 2  # removed after WORKERS_SCALE_DOWN_SAMPLES idle samples
+            await _sample(main.WORKERS_SCALE_DOWN_SAMPLES * 3)
+            assert workers[-1] == 1  # never below the workers of the Windmill server
+            assert [i["workers"] for i in main.WORKERS_SCALING_DECISIONS][-4:] == [2, 3, 2, 1]
+        finally:
+            await main.stop_windmill_workers()
+            assert not main.WINDMILL_WORKERS_STOPPING
+            main.UPSTREAM_CLIENT = None
+            await client.aclose()
+
+    asyncio.run(_scenario())